@@ -5,9 +5,16 @@ USER_AGENT = None
 from .api import (
     EVEAPIConnection
 )
+from .cache import (
+    MemoryCacheHandler,
+    SqliteCacheHandler,
+)
 from .exceptions import (
     AuthenticationError,
     Error,
     RequestError,
     ServerError,
 )
+from .aio import (
+    AsyncEVEAPIConnection
+)
@@ -0,0 +1,639 @@
+import errno
+import httplib
+import select
+import socket
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import warnings
+from collections import deque
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+from eveapi import DEFAULT_UA, USER_AGENT
+from .cache import _cachekey
+from .context import _RootContext
+from .exceptions import (
+    AuthenticationError,
+    Error,
+    ServerError,
+)
+from .parser import _ParseXML, RowStream
+from .query import _where
+from .scheduler import _priority, _Scheduler
+from .transport import _decompress
+from .workers import _report, _WorkerPool, Future
+
+_WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS, errno.EALREADY,
+               getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK))
+
+
+_PARSERS = 2  # threads parsing responses off the loop
+
+
+class _Return(Exception):
+    # raised by a task generator to deliver its result.
+    def __init__(self, value):
+        self.value = value
+
+
+class _Loop(object):
+    # A select() based event loop running on its own daemon thread. Other
+    # threads hand work to it with call_soon().
+
+    def __init__(self):
+        self._calls = deque()
+        self._lock = threading.Lock()
+        self._active = set()  # connections with I/O in progress
+        self._thread = None
+        self._wakeR, self._wakeW = _socketpair()
+        self._wakeR.setblocking(0)
+        self._wakeW.setblocking(0)
+
+    def call_soon(self, func, *args):
+        self._lock.acquire()
+        try:
+            self._calls.append((func, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        finally:
+            self._lock.release()
+        try:
+            self._wakeW.send("x")
+        except socket.error:
+            pass
+
+    def _run(self):
+        while True:
+            self._lock.acquire()
+            try:
+                calls, self._calls = self._calls, deque()
+            finally:
+                self._lock.release()
+            for func, args in calls:
+                try:
+                    func(*args)
+                except Exception:
+                    # one bad call mustn't stop the loop, and with it every
+                    # request of the connection.
+                    _report("event loop call")
+
+            now = time.time()
+            timeout = 60.0
+            r = [self._wakeR]
+            w = []
+            for conn in list(self._active):
+                if conn.deadline <= now:
+                    conn.fail(socket.timeout("timed out"))
+                    continue
+                timeout = min(timeout, conn.deadline - now)
+                if conn.readable():
+                    r.append(conn)
+                if conn.writable():
+                    w.append(conn)
+
+            try:
+                r, w, x = select.select(r, w, [], max(timeout, 0))
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for conn in w:
+                if conn in self._active:
+                    conn.handle_write()
+            for conn in r:
+                if conn is self._wakeR:
+                    try:
+                        while self._wakeR.recv(4096):
+                            pass
+                    except socket.error:
+                        pass
+                elif conn in self._active:
+                    conn.handle_read()
+
+
+def _socketpair():
+    # socket.socketpair() is not available everywhere, so connect a pair of
+    # loopback sockets by hand.
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        w = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        w.connect(listener.getsockname())
+        r, addr = listener.accept()
+    finally:
+        listener.close()
+    return r, w
+
+
+class _Connection(object):
+    # A single non-blocking HTTP/1.1 connection. Sends one request at a time
+    # and reports back to its pool when the response is complete.
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.sock = None
+        self.state = None
+        self.deadline = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def connect(self):
+        host, port = self.pool.address
+        # note: name resolution blocks, but only happens for new connections.
+        family, socktype, proto, canonname, addr = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(addr)
+        if err and err not in _WOULDBLOCK:
+            raise socket.error(err, errno.errorcode.get(err, "connect failed"))
+        self.state = "connect"
+
+    def send(self, message, future, reused):
+        self.message = self.out = message
+        self.future = future
+        self.reused = reused
+        self.received = False
+        self.buf = ""
+        self.status = None
+        self.body = []
+        self.deadline = time.time() + self.pool.timeout
+        if self.state is None:
+            self.state = "send"
+        self.pool.loop._active.add(self)
+
+    def readable(self):
+        return self.state in ("recv", "handshake-read")
+
+    def writable(self):
+        return self.state in ("connect", "send", "handshake-write")
+
+    def close(self):
+        self.pool.loop._active.discard(self)
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+        self.state = "closed"
+
+    def fail(self, exc):
+        self.close()
+        self.pool._failed(self, exc)
+
+    def handle_write(self):
+        try:
+            if self.state == "connect":
+                err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    raise socket.error(err, errno.errorcode.get(err, "connect failed"))
+                if self.pool.secure:
+                    self.sock = _wrap(self.sock, self.pool.address[0])
+                    self.state = "handshake-write"
+                    self.handshake()
+                else:
+                    self.state = "send"
+            elif self.state == "handshake-write":
+                self.handshake()
+            elif self.state == "send":
+                try:
+                    n = self.sock.send(self.out)
+                except socket.error, e:
+                    if _blocked(e):
+                        return
+                    raise
+                self.out = self.out[n:]
+                if not self.out:
+                    self.state = "recv"
+        except Exception, e:
+            self.fail(e)
+
+    def handshake(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.state = "handshake-read"
+                return
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.state = "handshake-write"
+                return
+            raise
+        self.state = "send"
+
+    def handle_read(self):
+        try:
+            if self.state == "handshake-read":
+                self.handshake()
+                return
+            while self.state == "recv":
+                try:
+                    data = self.sock.recv(65536)
+                except socket.error, e:
+                    if _blocked(e):
+                        return
+                    raise
+                if not data:
+                    self.eof()
+                    return
+                self.received = True
+                self.feed(data)
+        except Exception, e:
+            self.fail(e)
+
+    def eof(self):
+        if self.status is not None and self.mode == "close":
+            self.done(False)
+        elif not self.received and self.reused:
+            # the server closed an idle keep-alive connection under us.
+            self.close()
+            self.pool._retry(self)
+        else:
+            raise httplib.IncompleteRead("".join(self.body))
+
+    def feed(self, data):
+        if self.status is None:
+            self.buf += data
+            i = self.buf.find("\r\n\r\n")
+            if i < 0:
+                return
+            head, data, self.buf = self.buf[:i], self.buf[i+4:], ""
+            lines = head.split("\r\n")
+            try:
+                version, status, reason = (lines[0].split(None, 2) + [""])[:3]
+                self.status = int(status)
+            except ValueError:
+                raise httplib.BadStatusLine(lines[0])
+            self.reason = reason
+            headers = {}
+            for line in lines[1:]:
+                k, sep, v = line.partition(":")
+                headers[k.strip().lower()] = v.strip()
+            self.encoding = headers.get("content-encoding", "").lower()
+            connection = headers.get("connection", "").lower()
+            if version == "HTTP/1.1":
+                self.keepalive = connection != "close"
+            else:
+                self.keepalive = connection == "keep-alive"
+            if headers.get("transfer-encoding", "").lower() == "chunked":
+                self.mode = "chunked"
+                self.chunk = None
+            elif "content-length" in headers:
+                self.mode = "length"
+                self.remaining = int(headers["content-length"])
+            else:
+                self.mode = "close"
+
+        if self.mode == "length":
+            data = data[:self.remaining]
+            self.body.append(data)
+            self.remaining -= len(data)
+            if not self.remaining:
+                self.done(self.keepalive)
+        elif self.mode == "chunked":
+            self.buf += data
+            self.dechunk()
+        else:
+            self.body.append(data)
+
+    def dechunk(self):
+        while True:
+            if self.chunk is None:
+                i = self.buf.find("\r\n")
+                if i < 0:
+                    return
+                self.chunk = int(self.buf[:i].split(";", 1)[0], 16)
+                self.buf = self.buf[i+2:]
+            if self.chunk == 0:
+                # skip trailers, if any.
+                if self.buf.startswith("\r\n"):
+                    self.done(self.keepalive)
+                elif "\r\n\r\n" in self.buf:
+                    self.done(self.keepalive)
+                return
+            if len(self.buf) < self.chunk + 2:
+                return
+            self.body.append(self.buf[:self.chunk])
+            self.buf = self.buf[self.chunk+2:]
+            self.chunk = None
+
+    def done(self, reuse):
+        self.state = None
+        self.pool.loop._active.discard(self)
+        future, result = self.future, (self.status, self.reason, self.encoding, "".join(self.body))
+        self.future = self.body = None
+        # releasing may put this connection straight back to work, so the
+        # result has to be collected before that.
+        self.pool._release(self, reuse)
+        future.set_result(result)
+
+
+def _blocked(e):
+    if ssl is not None and isinstance(e, ssl.SSLError):
+        return e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+    return e.args[0] in _WOULDBLOCK
+
+
+def _wrap(sock, hostname):
+    if hasattr(ssl, "create_default_context"):
+        context = ssl.create_default_context()
+        return context.wrap_socket(sock, server_hostname=hostname, do_handshake_on_connect=False)
+    return ssl.wrap_socket(sock, do_handshake_on_connect=False)
+
+
+class _ConnectionPool(object):
+    # The non-blocking counterpart of transport._ConnectionPool. Limits the
+    # number of simultaneous connections to the server and queues requests
+    # beyond that. Must only be used from the loop thread.
+
+    def __init__(self, loop, address, secure=False, size=64, timeout=60.0):
+        host, sep, port = address[0].partition(":")
+        if len(address) > 1:
+            port = address[1]
+        self.address = (host, int(port or (secure and 443 or 80)))
+        self.loop = loop
+        self.secure = secure
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._busy = 0
+        self._waiting = deque()
+
+    def request(self, message):
+        future = Future()
+        self._waiting.append((future, message, True))
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        while self._waiting and (self._idle or self._busy < self.size):
+            future, message, reuse = self._waiting.popleft()
+            conn = reuse and self._checkout()
+            reused = conn is not None
+            try:
+                if not reused:
+                    conn = _Connection(self)
+                    conn.connect()
+            except Exception:
+                future.set_exception(sys.exc_info())
+                continue
+            self._busy += 1
+            conn.send(message, future, reused)
+
+    def _checkout(self):
+        while self._idle:
+            conn = self._idle.pop()
+            try:
+                if not select.select([conn.sock], [], [], 0)[0]:
+                    return conn
+            except (select.error, socket.error):
+                pass
+            conn.close()
+        return None
+
+    def _release(self, conn, reuse):
+        self._busy -= 1
+        if reuse and len(self._idle) < self.size:
+            self._idle.append(conn)
+        else:
+            conn.close()
+        self._dispatch()
+
+    def _retry(self, conn):
+        self._busy -= 1
+        self._waiting.appendleft((conn.future, conn.message, False))
+        self._dispatch()
+
+    def _failed(self, conn, exc):
+        self._busy -= 1
+        future = conn.future
+        conn.future = None
+        if future is not None:
+            future.set_exception((type(exc), exc, None))
+        self._dispatch()
+
+
+class _AsyncRootContext(_RootContext):
+    # Calls made through this context (and any context derived from it) are
+    # executed on the connection's event loop and return Future objects.
+    # So do stream() and query(): the document is downloaded in full first,
+    # the Future's result is then a RowStream over it, or the result.
+
+    def __call__(self, path, **kw):
+        self._convert(kw)
+        # identical calls that are already in progress are not sent again,
+        # they share that one's Future instead.
+        key = _cachekey(self._host, path + ".xml.aspx", kw)
+        self._lock.acquire()
+        try:
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._inflight[key] = self._start(path, kw)
+            else:
+                return future
+        finally:
+            self._lock.release()
+        future.add_done_callback(lambda future: self._forget(key))
+        return future
+
+    def _forget(self, key):
+        self._lock.acquire()
+        try:
+            del self._inflight[key]
+        finally:
+            self._lock.release()
+
+    def _stream(self, path, rowset, kw):
+        return self._start(path, kw, stream=rowset)
+
+    def _query(self, path, where, kw):
+        return self._start(path, kw, where=_where(where))
+
+    def _start(self, path, kw, stream=None, where=None):
+        self._convert(kw)
+        if not USER_AGENT:
+            warnings.warn("No User-Agent set! Please use the set_user_agent() module-level function "
+                          "before accessing the EVE API.", stacklevel=4)
+
+        # the priority is that of the calling thread, see batch().
+        future = Future()
+        self._loop.call_soon(_Task, self._loop, self._fetch(path + ".xml.aspx", kw, stream, where, _priority()), future)
+        return future
+
+    def _fetch(self, path, kw, stream=None, where=None, priority=0):
+        # task generator. yielding a Future suspends the task until it is
+        # done, yielding anything else hands that value straight back.
+        cache = self._handler
+        if cache:
+            response = yield cache.retrieve(self._host, path, kw)
+        else:
+            response = None
+
+        if response is None:
+            if self._scheduler is not None:
+                # wait for our turn under the connection's rate limits,
+                # without holding up the loop.
+                yield self._scheduler.submit(kw.get("keyID", kw.get("userID")), priority)
+
+            if self._proxy is None:
+                req = path
+            else:
+                req = self._scheme+'://'+self._host+path
+
+            headers = ["Host: %s" % self._host, "User-Agent: %s" % (USER_AGENT or DEFAULT_UA),
+                       "Accept-Encoding: gzip, deflate"]
+            if kw:
+                body = urllib.urlencode(kw)
+                headers += ["Content-type: application/x-www-form-urlencoded", "Content-Length: %d" % len(body)]
+                message = "POST %s HTTP/1.1\r\n%s\r\n\r\n%s" % (req, "\r\n".join(headers), body)
+            else:
+                message = "GET %s HTTP/1.1\r\n%s\r\n\r\n" % (req, "\r\n".join(headers))
+
+            status, reason, encoding, response = yield self._pool.request(message)
+            if status != 200:
+                if status == httplib.NOT_FOUND:
+                    raise AttributeError("'%s' not available on API server (404 Not Found)" % path)
+                elif status == httplib.FORBIDDEN:
+                    raise AuthenticationError(status, 'HTTP 403 - Forbidden')
+                else:
+                    raise ServerError(status, "'%s' request failed (%s)" % (path, reason))
+            # the parser takes gzip compressed documents as-is, and so do
+            # cache handlers with storeCompressed set.
+            if encoding == "deflate" or (encoding == "gzip" and cache and not getattr(cache, "storeCompressed", False)):
+                response = _decompress(response, encoding)
+            # like with the blocking client, streamed and queried documents
+            # aren't stored.
+            store = bool(cache) and stream is None and where is None
+        else:
+            store = False
+
+        if stream is not None:
+            raise _Return(RowStream(response, stream, True, None, where))
+
+        retrieve_fallback = cache and getattr(cache, "retrieve_fallback", False)
+        try:
+            # on a worker thread, parsing a large document on the loop would
+            # hold up all other requests.
+            result = yield self._parsers.submit(_ParseXML, response, True, None, where)
+        except Error, e:
+            if not retrieve_fallback:
+                raise
+            fallback = yield retrieve_fallback(self._host, path, kw, reason=e)
+            if fallback is None:
+                raise
+            raise _Return(fallback)
+
+        if store:
+            yield cache.store(self._host, path, kw, response, result._meta)
+        raise _Return(result)
+
+
+class _Task(object):
+    # drives a task generator on the loop, resolving future with its result.
+
+    def __init__(self, loop, gen, future):
+        self.loop = loop
+        self.gen = gen
+        self.future = future
+        self.step(None, None)
+
+    def step(self, value, exc_info):
+        while True:
+            try:
+                if exc_info:
+                    value = self.gen.throw(*exc_info)
+                else:
+                    value = self.gen.send(value)
+            except _Return, r:
+                value, exc_info = r.value, None
+                break
+            except StopIteration:
+                value, exc_info = None, None
+                break
+            except Exception:
+                value, exc_info = None, sys.exc_info()
+                break
+
+            if isinstance(value, Future):
+                value.add_done_callback(self.resume)
+                return
+            exc_info = None
+
+        # outside the handlers, so that done callbacks that raise aren't
+        # taken for the task failing.
+        if exc_info:
+            self.future.set_exception(exc_info)
+        else:
+            self.future.set_result(value)
+
+    def resume(self, future):
+        if future._exc_info:
+            self.loop.call_soon(self.step, None, future._exc_info)
+        else:
+            self.loop.call_soon(self.step, future._result, None)
+
+
+def AsyncEVEAPIConnection(url="api.eveonline.com", cacheHandler=None, proxy=None, proxySSL=False, maxConnections=64,
+                          timeout=60.0, rateLimit=0, keyRateLimit=0):
+    """
+    Creates an API object through which you can call remote functions
+    without blocking. It works exactly like the object returned by
+    EVEAPIConnection(), except that calls return a Future instead of the
+    result. Call the future's result() method to wait for the result, or
+    register a callback with its add_done_callback() method.
+
+    All requests made through this object (and any contexts derived from
+    it) share a single event loop thread and a pool of up to maxConnections
+    non-blocking keep-alive connections. Requests that take longer than
+    timeout seconds fail with socket.timeout. Requests held back by
+    rateLimit or keyRateLimit wait without holding up the others, and
+    responses are parsed on worker threads. Identical calls made while one
+    is in progress share its Future.
+
+    The stream() and query() methods of contexts also return a Future, of
+    a RowStream or the result, once the document has been downloaded.
+
+    cacheHandler - same as for EVEAPIConnection(), except that retrieve(),
+                   store() and retrieve_fallback() may return a Future to
+                   complete the operation asynchronously. These methods are
+                   called on the event loop thread, so they should never
+                   block for long.
+
+    See EVEAPIConnection() for the other arguments.
+    """
+    from eveapi import api
+
+    if not url.startswith("http"):
+        url = "https://" + url
+    p = urlparse.urlparse(url, "https")
+    path = p.path
+    if path and path[-1] == "/":
+        path = path[:-1]
+    ctx = _AsyncRootContext(None, path, {}, {})
+    ctx._handler = cacheHandler
+    ctx._scheme = p.scheme
+    ctx._host = p.netloc
+    ctx._proxy = proxy or api.proxy
+    ctx._proxySSL = proxySSL or api.proxySSL
+    ctx._loop = _Loop()
+    ctx._parsers = _WorkerPool(_PARSERS)
+    ctx._inflight = {}
+    ctx._lock = threading.Lock()
+    if rateLimit or keyRateLimit:
+        ctx._scheduler = _Scheduler(rateLimit, keyRateLimit)
+    if ctx._proxy is None:
+        ctx._pool = _ConnectionPool(ctx._loop, (ctx._host,), ctx._scheme == "https", maxConnections, timeout)
+    else:
+        ctx._pool = _ConnectionPool(ctx._loop, ctx._proxy, ctx._proxySSL, maxConnections, timeout)
+    return ctx
@@ -1,7 +1,11 @@
 import urlparse
 
-from .context import _RootContext
-from .parser import _autocast
+from . import parser
+from .context import _Refresher, _RootContext
+from .parser import _autocast, _casts, _columntypes
+from .scheduler import _Scheduler
+from .transport import _ConnectionPool
+from .workers import _SingleFlight
 
 proxy = None
 proxySSL = False
@@ -13,9 +17,48 @@ def set_cast_func(func):
     The function must have 2 arguments; key and value. It should return a
     value or object of the type appropriate for the given attribute name/key.
     func may be None and will cause the default _autocast function to be used.
+    A custom function is called for every value, the column types set with
+    set_column_type() are not used then.
     """
-    global _castfunc
-    _castfunc = _autocast if func is None else func
+    parser._castfunc = _autocast if func is None else func
+
+
+def set_lazy_cast(lazy):
+    """
+    If lazy is True, the values in rowsets parsed from then on are cast when
+    they are first read, rather than all at once while parsing. This saves
+    time when only a few of the columns of large rowsets are used, and makes
+    no other difference: each value is cast once, and to the same result.
+    """
+    parser._lazycast = bool(lazy)
+
+
+def set_columnar(columnar):
+    """
+    If columnar is True, rowsets parsed from then on store their values by
+    column rather than by row: ints and floats in arrays, other values once
+    per distinct value. This takes far less memory for large rowsets, and
+    Select() and SortBy() on a single column are faster. Reading rows is
+    slower, and changes made to them are not kept in the rowset.
+    Values are never cast lazily in columnar rowsets.
+    """
+    parser._columnar = bool(columnar)
+
+
+def set_column_type(column, type):
+    """
+    Sets the type of the values of rowset columns with the given name.
+    type must be one of int, float, datetime.datetime and str, or None to
+    have the type inferred from the values in the first rows of a rowset.
+    Values that can't be converted to the type are cast as usual.
+    Many of the columns used by the API are known already.
+    """
+    if type is None:
+        _columntypes.pop(column, None)
+    elif type in _casts:
+        _columntypes[column] = _casts[type]
+    else:
+        raise ValueError("unsupported column type: %r" % (type,))
 
 
 def set_user_agent(user_agent_string):
@@ -26,7 +69,8 @@ def set_user_agent(user_agent_string):
     USER_AGENT = user_agent_string
 
 
-def EVEAPIConnection(url="api.eveonline.com", cacheHandler=None, proxy=None, proxySSL=False):
+def EVEAPIConnection(url="api.eveonline.com", cacheHandler=None, proxy=None, proxySSL=False, poolSize=4,
+                     idleTimeout=30.0, staleTime=0, refreshAhead=0, refreshThreads=1, rateLimit=0, keyRateLimit=0):
     """
     Creates an API object through which you can call remote functions.
 
@@ -39,6 +83,32 @@ def EVEAPIConnection(url="api.eveonline.com", cacheHandler=None, proxy=None, pro
 
     proxySSL - True if the proxy requires SSL, False otherwise.
 
+    poolSize - maximum number of idle keep-alive connections kept open for
+               reuse by this object and all contexts derived from it.
+
+    idleTimeout - seconds after which an idle connection is no longer reused.
+
+    staleTime - seconds after expiry during which a cached document is still
+                returned. A fresh copy is fetched in the background when that
+                happens, so callers don't have to wait for the server.
+                Requires the cache handler to implement retrieve_stale().
+
+    refreshAhead - seconds before expiry from which cached documents are
+                   refreshed in the background when requested, so that
+                   frequently used documents never expire.
+                   Requires the cache handler to implement retrieve_stale().
+
+    refreshThreads - number of threads used for background refreshes.
+
+    rateLimit - maximum number of requests per second sent to the server by
+                this object and all contexts derived from it, or 0 for no
+                limit. Up to a second's worth may be sent at once.
+
+    keyRateLimit - same as rateLimit, but for each API key (keyID) apart.
+                   When requests have to wait for these limits, those of
+                   regular calls go before those of batch() calls and
+                   background refreshes, and the keys take turns.
+
     cacheHandler - an object which must support the following interface:
 
          retrieve(host, path, params)
@@ -50,7 +120,7 @@ def EVEAPIConnection(url="api.eveonline.com", cacheHandler=None, proxy=None, pro
              The method MUST return one of the following types:
 
               None - if your cache did not contain this entry
-              str/unicode - eveapi will parse this as XML
+              str/unicode - eveapi will parse this as (gzipped) XML
               Element - previously stored object as provided to store()
               file-like object - eveapi will read() XML from the stream.
 
@@ -63,6 +133,30 @@ def EVEAPIConnection(url="api.eveonline.com", cacheHandler=None, proxy=None, pro
              the object, unless you pickle the object. Note that this method
              will only be called if you returned None in the retrieve() for
              this object.
+
+             If the handler has a storeCompressed attribute set to True, doc
+             is passed exactly as the server sent it, which may be gzip
+             compressed. retrieve() may return such documents unchanged.
+
+         open_store(host, path, params)  [optional]
+
+             Called before a document is requested from the server. May
+             return None, or a file-like object to which eveapi will write
+             the document as it arrives, while it is being parsed. If the
+             document is successfully parsed, store() is called with this
+             object as doc. Otherwise its close() method is called to let
+             the handler know it won't be stored.
+
+         retrieve_stale(host, path, params)  [optional]
+
+             Used instead of retrieve() when staleTime or refreshAhead is
+             set. Must return None if there's no such entry in the cache,
+             or a (doc, expires) tuple where doc is the cached document as
+             retrieve() would return it, even if it has expired, and expires
+             is the time.time() at which the entry expires.
+
+    eveapi.MemoryCacheHandler is a ready-made, thread-safe implementation
+    of this interface.
     """
 
     if not url.startswith("http"):
@@ -76,4 +170,15 @@ def EVEAPIConnection(url="api.eveonline.com", cacheHandler=None, proxy=None, pro
     ctx._host = p.netloc
     ctx._proxy = proxy or globals()["proxy"]
     ctx._proxySSL = proxySSL or globals()["proxySSL"]
+    ctx._inflight = _SingleFlight()
+    if rateLimit or keyRateLimit:
+        ctx._scheduler = _Scheduler(rateLimit, keyRateLimit)
+    if staleTime or refreshAhead:
+        ctx._staleTime = staleTime
+        ctx._refreshAhead = refreshAhead
+        ctx._refresher = _Refresher(refreshThreads)
+    if ctx._proxy is None:
+        ctx._pool = _ConnectionPool((ctx._host,), ctx._scheme == "https", poolSize, idleTimeout)
+    else:
+        ctx._pool = _ConnectionPool(ctx._proxy, ctx._proxySSL, poolSize, idleTimeout)
     return ctx
@@ -0,0 +1,119 @@
+from datetime import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .columnar import _ColumnStore, _NumberColumn
+
+
+def _require():
+    if numpy is None:
+        raise RuntimeError("this requires the numpy module")
+
+
+def _missing(value):
+    return value is None or value == ""
+
+
+def _toarray(values):
+    # converts a column's values to the most specific array type that can
+    # hold all of them. Missing values (None and "") become NaN or NaT in
+    # float and datetime columns, anything else makes it an object array.
+    values = list(values)
+    try:
+        array = numpy.array(values)
+    except (ValueError, OverflowError, TypeError):
+        pass
+    else:
+        # only numbers, the most common case.
+        if array.ndim == 1 and array.dtype.kind in "if":
+            return array.astype(numpy.int64 if array.dtype.kind == "i" else numpy.float64, copy=False)
+    present = [value for value in values if not _missing(value)]
+    kinds = set(map(type, present))
+    holes = len(present) != len(values)
+    try:
+        if kinds and kinds <= set([int, long]) and not holes:
+            return numpy.array(values, dtype=numpy.int64)
+        if kinds and kinds <= set([int, long, float]):
+            return numpy.array([numpy.nan if _missing(value) else value for value in values], dtype=numpy.float64)
+        if kinds == set([datetime]):
+            return numpy.array([None if _missing(value) else value for value in values], dtype="datetime64[s]")
+    except OverflowError:
+        pass
+    array = numpy.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def _column(rowset, column):
+    # the values of the named column as an array.
+    _require()
+    i = rowset._cols.index(column)
+    rows = rowset._rows
+    if isinstance(rows, _ColumnStore) and len(rows):
+        values = rows.column(i)
+        if isinstance(values, _NumberColumn) and not values.other:
+            # straight from the column's array.
+            return numpy.frombuffer(values.values, dtype=values.values.typecode).copy()
+    return _toarray(rowset.Select(column))
+
+
+def _toarrays(rowset, columns, structured):
+    _require()
+    columns = columns or rowset._cols
+    arrays = [_column(rowset, column) for column in columns]
+    if not structured:
+        return dict(zip(columns, arrays))
+    result = numpy.empty(len(rowset), dtype=[(str(column), array.dtype) for column, array in zip(columns, arrays)])
+    for column, array in zip(columns, arrays):
+        result[str(column)] = array
+    return result
+
+
+_reductions = {
+    "sum": "add",
+    "min": "minimum",
+    "max": "maximum",
+}
+
+
+def _aggregate(rowset, how, column, by, where):
+    # sum, min, max or mean of a column, either over all rows or per value
+    # of the by column as a dict. where is an optional boolean array
+    # selecting the rows to use.
+    values = _column(rowset, column)
+    if by is not None:
+        keys = _column(rowset, by)
+    if where is not None:
+        where = numpy.asarray(where, dtype=bool)
+        values = values[where]
+        if by is not None:
+            keys = keys[where]
+
+    if by is None:
+        if how == "mean":
+            result = values.mean()
+        else:
+            result = getattr(numpy, _reductions[how]).reduce(values)
+        return result.item() if isinstance(result, numpy.generic) else result
+
+    if not len(values):
+        return {}
+    unique, inverse = numpy.unique(keys, return_inverse=True)
+    if values.dtype.kind == "f" and how in ("sum", "mean"):
+        result = numpy.bincount(inverse, values, len(unique))
+        if how == "mean":
+            result /= numpy.bincount(inverse, None, len(unique))
+    else:
+        # group the values by key, in their original order within each
+        # group, and reduce each group.
+        order = numpy.argsort(inverse, kind="mergesort")
+        starts = numpy.searchsorted(inverse[order], numpy.arange(len(unique)))
+        values = values[order]
+        if how == "mean":
+            result = numpy.add.reduceat(values, starts) / numpy.bincount(inverse).astype(numpy.float64)
+        else:
+            result = getattr(numpy, _reductions[how]).reduceat(values, starts)
+    return dict(zip(unique.tolist(), result.tolist()))
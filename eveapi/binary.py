@@ -0,0 +1,537 @@
+import cPickle
+import struct
+import sys
+from array import array
+from datetime import datetime, timedelta
+from itertools import izip
+from operator import attrgetter
+
+from .containers import (
+    _columns,
+    _keyindex,
+    Element,
+    FilterRowset,
+    IndexRowset,
+    OrderedRowset,
+    Rowset,
+)
+
+_MAGIC = "\x00EVB"
+_VERSION = 1
+
+_EPOCH = datetime(1970, 1, 1)
+_uint = struct.Struct("<I")
+_int64 = struct.Struct("<q")
+_double = struct.Struct("<d")
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+
+
+def _arraytype(codes, size):
+    # the array typecode of the given size, blocks of numbers are read and
+    # written as arrays where the platform has one.
+    for code in codes:
+        if array(code).itemsize == size:
+            return code
+    return None
+
+# struct format: array typecode, or None.
+_arraytypes = {
+    "q": _arraytype("lqi", 8),
+    "d": _arraytype("d", 8),
+    "B": _arraytype("B", 1),
+    "H": _arraytype("H", 2),
+    "I": _arraytype("ILH", 4),
+}
+_swap = sys.byteorder != "little"
+
+
+def _packarray(fmt, values):
+    # values as little-endian numbers of the given struct format.
+    code = _arraytypes[fmt]
+    if code is None:
+        return struct.pack("<%d%s" % (len(values), fmt), *values)
+    values = array(code, values)
+    if _swap:
+        values.byteswap()
+    return values.tostring()
+
+
+def _unpackarray(fmt, data, pos, n):
+    # the list of n little-endian numbers of the given struct format in data
+    # at pos, and the position after them.
+    code = _arraytypes[fmt]
+    if code is None:
+        end = pos + struct.calcsize("<%d%s" % (n, fmt))
+        return list(struct.unpack_from("<%d%s" % (n, fmt), data, pos)), end
+    values = array(code)
+    end = pos + values.itemsize * n
+    values.fromstring(data[pos:end])
+    if _swap:
+        values.byteswap()
+    return values.tolist(), end
+
+_tzinfo = attrgetter("tzinfo")
+_microseconds = attrgetter("microseconds")
+
+
+def _micros(value):
+    # microseconds since the epoch of a naive datetime.
+    delta = value - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _isdate(value):
+    return type(value) is datetime and value.tzinfo is None
+
+
+def _ispacked(value):
+    return type(value) is str and value[:4] == _MAGIC
+
+
+class _Writer(object):
+
+    def __init__(self):
+        self.out = []
+        self.memo = {}  # id of Elements and rowsets: their number
+
+    def value(self, value):
+        out = self.out
+        t = type(value)
+        if t is unicode:
+            value = value.encode("utf-8")
+            out.append("u" + _uint.pack(len(value)))
+            out.append(value)
+        elif t is int:
+            out.append("i" + _int64.pack(value))
+        elif t is str:
+            out.append("s" + _uint.pack(len(value)))
+            out.append(value)
+        elif t is float:
+            out.append("f" + _double.pack(value))
+        elif value is None:
+            out.append("N")
+        elif t is bool:
+            out.append("T" if value else "F")
+        elif _isdate(value):
+            out.append("d" + _int64.pack(_micros(value)))
+        elif t is long:
+            if _INT64_MIN <= value <= _INT64_MAX:
+                out.append("i" + _int64.pack(value))
+            else:
+                value = str(value)
+                out.append("L" + _uint.pack(len(value)))
+                out.append(value)
+        elif isinstance(value, (Element, Rowset, FilterRowset)):
+            self.object(value)
+        elif isinstance(value, list):
+            out.append("l" + _uint.pack(len(value)))
+            for item in value:
+                self.value(item)
+        elif t is tuple:
+            out.append("t" + _uint.pack(len(value)))
+            for item in value:
+                self.value(item)
+        elif t is dict:
+            out.append("m" + _uint.pack(len(value)))
+            for item in value.iteritems():
+                self.value(item[0])
+                self.value(item[1])
+        else:
+            value = cPickle.dumps(value, 2)
+            out.append("p" + _uint.pack(len(value)))
+            out.append(value)
+
+    def object(self, obj):
+        # Elements and rowsets are numbered in the order they're written,
+        # and written once. They're referred to by number after that, as
+        # results do to their document with _meta.
+        out = self.out
+        n = self.memo.get(id(obj))
+        if n is not None:
+            out.append("r" + _uint.pack(n))
+            return
+        self.memo[id(obj)] = len(self.memo)
+
+        if isinstance(obj, Element):
+            items = obj.__dict__.items()
+            out.append("E" + _uint.pack(len(items)))
+            for name, value in items:
+                self.value(name)
+                self.value(value)
+            return
+
+        if isinstance(obj, FilterRowset):
+            out.append("G")
+            if obj.key2:
+                rows = [row for group in obj._items.itervalues() for row in group.itervalues()]
+            else:
+                rows = [row for group in obj._items.itervalues() for row in group]
+            self.value(obj.key2)
+        elif isinstance(obj, OrderedRowset):
+            out.append("O")
+            rows = obj._rows
+        elif isinstance(obj, IndexRowset):
+            out.append("X")
+            rows = obj._rows
+        else:
+            out.append("S")
+            rows = obj._rows
+        self.value(getattr(obj, "key", None) if isinstance(obj, FilterRowset) else getattr(obj, "_key", None))
+        self.value(obj.__dict__.get("_name"))
+        self.value(tuple(obj._cols))
+        self.rows(rows)
+
+    def rows(self, rows):
+        out = self.out
+        rows = list(rows)
+        widths = map(len, rows)
+        width = max(widths) if rows else 0
+        ragged = widths.count(width) != len(rows)
+        out.append(_uint.pack(len(rows)) + _uint.pack(width) + ("w" if ragged else "-"))
+        if ragged:
+            # rows with values missing at the end are padded with None.
+            out.append(_packarray("H", widths))
+            rows = [row if len(row) == width else list(row) + [None] * (width - len(row)) for row in rows]
+        if rows:
+            for values in izip(*rows):
+                self.column(values)
+
+    def column(self, values):
+        # a column of values, as a block of the type most of them have.
+        # those of other types are written after it, with their position.
+        n = len(values)
+        types = map(type, values)
+        kinds = set(types)
+        if len(kinds) == 1:
+            t = types[0]
+            counts = {t: n}
+        else:
+            counts = {}
+            for t in kinds:
+                counts[t] = types.count(t)
+            t = max(counts, key=counts.get)
+        if counts[t] * 2 < n or t not in _blocks:
+            self.generic(values)
+            return
+
+        pack, placeholder = _blocks[t]
+        if t is datetime and (counts[t] != n or any(map(_tzinfo, values))):
+            # only naive datetimes go in the block.
+            typed = [_isdate(value) for value in values]
+        elif counts[t] == n:
+            typed = None
+        else:
+            typed = [vt is t for vt in types]
+        if typed is None:
+            # the usual case, all values of the one type.
+            block = pack(values, n)
+            other = ()
+        else:
+            block = pack([value if ok else placeholder for value, ok in izip(values, typed)], n)
+            other = [i for i, ok in enumerate(typed) if not ok]
+        if block is None:
+            # strings containing the separator.
+            self.generic(values)
+            return
+        out = self.out
+        out.extend(block)
+        out.append(_uint.pack(len(other)))
+        for i in other:
+            out.append(_uint.pack(i))
+            self.value(values[i])
+
+    def generic(self, values):
+        self.out.append("v")
+        for value in values:
+            self.value(value)
+
+
+# the pack functions return the tag and data of a column block, or None
+# if the values can't be stored in one.
+
+def _packints(values, n):
+    return "I", _packarray("q", values)
+
+
+def _packfloats(values, n):
+    return "F", _packarray("d", values)
+
+
+def _packdates(values, n):
+    # integers since the epoch: seconds if all dates are whole seconds, as
+    # those of the API are, which are quicker to make again. microseconds
+    # otherwise.
+    deltas = [value - _EPOCH for value in values]
+    if any(map(_microseconds, deltas)):
+        return "D", "u" + _packarray("q", [(d.days * 86400 + d.seconds) * 1000000 + d.microseconds for d in deltas])
+    return "D", "s" + _packarray("q", [d.days * 86400 + d.seconds for d in deltas])
+
+
+def _dates(stamps, unit):
+    # the datetimes of a block of dates.
+    if unit == "s":
+        try:
+            return map(datetime.utcfromtimestamp, stamps)
+        except (ValueError, OverflowError):
+            # out of the platform's range.
+            return [_EPOCH + timedelta(0, stamp) for stamp in stamps]
+    if unit == "u":
+        return [_EPOCH + timedelta(0, 0, stamp) for stamp in stamps]
+    raise ValueError("unknown date unit %r" % unit)
+
+
+def _joined(values, separator):
+    # strings separated by NUL, which API strings don't contain.
+    text = separator.join(values)
+    if text.count(separator) != len(values) - 1:
+        return None
+    if type(text) is unicode:
+        text = text.encode("utf-8")
+    return _uint.pack(len(text)) + text
+
+
+def _packstrings(values, n):
+    # columns of names and such have few distinct values. those are stored
+    # once, the rows get their number.
+    separator = u"\x00" if type(values[0]) is unicode else "\x00"
+    distinct = set(values)
+    if len(distinct) * 2 <= n:
+        strings = sorted(distinct)
+        codes = dict(izip(strings, xrange(len(strings))))
+        text = _joined(strings, separator)
+        tag = "C" if separator is u"\x00" else "c"
+        size = "B" if len(codes) <= 0x100 else "H" if len(codes) <= 0x10000 else "I"
+        return text and (tag, size + _uint.pack(len(codes)) + text + _packarray(size, map(codes.__getitem__, values)))
+    text = _joined(values, separator)
+    return text and ("U" if separator is u"\x00" else "B", text)
+
+_blocks = {
+    # type: (pack function, placeholder for values of other types)
+    int: (_packints, 0),
+    float: (_packfloats, 0.0),
+    datetime: (_packdates, _EPOCH),
+    unicode: (_packstrings, u""),
+    str: (_packstrings, ""),
+}
+
+
+def dumps(obj):
+    """
+    Returns obj, usually a document as passed to the store() method of cache
+    handlers or a result returned by a call, as a string in a compact binary
+    format. Cache handlers may return such strings from retrieve() as-is.
+    Loading them takes a small fraction of the time parsing the XML does.
+    Compared to pickle (cPickle, protocol 2), dumping a large journal takes
+    about half the time and loading it about the same, and the string is
+    about 40% smaller.
+
+    Rowsets are stored by column, with the column names once and then the
+    values of each column as an array of ints, floats, dates (as integers)
+    or strings if most of them are of that type. Results keep their _meta
+    document. Values of other types than those, and lists, tuples and dicts
+    of them, are pickled.
+    """
+    writer = _Writer()
+    writer.out.append(_MAGIC + chr(_VERSION))
+    writer.value(obj)
+    return "".join(writer.out)
+
+
+def _pack(value):
+    # value on its own, without the header.
+    writer = _Writer()
+    writer.value(value)
+    return "".join(writer.out)
+
+
+class _Reader(object):
+    # data may be any buffer, such as an mmap.
+
+    def __init__(self, data, pos=5):
+        self.data = data
+        self.pos = pos
+        self.objects = []
+        self.dates = {}  # microseconds: datetime, dates tend to repeat
+
+    def uint(self):
+        value = _uint.unpack_from(self.data, self.pos)[0]
+        self.pos += 4
+        return value
+
+    def string(self):
+        n = self.uint()
+        value = self.data[self.pos:self.pos + n]
+        if len(value) != n:
+            raise ValueError("truncated")
+        self.pos += n
+        return value
+
+    def date(self, micros):
+        value = self.dates.get(micros)
+        if value is None:
+            value = self.dates[micros] = _EPOCH + timedelta(microseconds=micros)
+        return value
+
+    def value(self):
+        tag = self.data[self.pos]
+        self.pos += 1
+        if tag == "u":
+            return self.string().decode("utf-8")
+        if tag == "i":
+            value = _int64.unpack_from(self.data, self.pos)[0]
+            self.pos += 8
+            return value
+        if tag == "s":
+            return self.string()
+        if tag == "f":
+            value = _double.unpack_from(self.data, self.pos)[0]
+            self.pos += 8
+            return value
+        if tag == "N":
+            return None
+        if tag == "T":
+            return True
+        if tag == "F":
+            return False
+        if tag == "d":
+            value = _int64.unpack_from(self.data, self.pos)[0]
+            self.pos += 8
+            return self.date(value)
+        if tag == "L":
+            return long(self.string())
+        if tag == "l":
+            return [self.value() for i in xrange(self.uint())]
+        if tag == "t":
+            return tuple([self.value() for i in xrange(self.uint())])
+        if tag == "m":
+            n = self.uint()
+            result = {}
+            for i in xrange(n):
+                key = self.value()
+                result[key] = self.value()
+            return result
+        if tag == "p":
+            return cPickle.loads(self.string())
+        if tag == "r":
+            return self.objects[self.uint()]
+        if tag == "E":
+            obj = Element()
+            self.objects.append(obj)
+            n = self.uint()
+            for i in xrange(n):
+                name = self.value()
+                obj.__dict__[name] = self.value()
+            return obj
+        if tag in "GOXS":
+            return self.rowset(tag)
+        raise ValueError("unknown tag %r" % tag)
+
+    def rowset(self, kind):
+        n = len(self.objects)
+        self.objects.append(None)
+        key2 = self.value() if kind == "G" else None
+        key = self.value()
+        name = self.value()
+        cols = _columns(self.value())
+        rows, columns = self.rows()
+        if kind == "G":
+            obj = FilterRowset(cols, rows, key, key2)
+        elif kind == "O":
+            obj = OrderedRowset(cols, rows, key)
+        elif kind == "X":
+            ki, composite = _keyindex(cols, key)
+            if columns and not composite:
+                # the index in one go, from the key column.
+                obj = IndexRowset(cols, rows, key, dict(izip(columns[ki], rows)))
+            else:
+                obj = IndexRowset(cols, rows, key)
+        else:
+            obj = Rowset(cols, rows)
+        if name is not None:
+            obj._name = name
+        self.objects[n] = obj
+        return obj
+
+    def rows(self):
+        # the rows, and their columns if all rows have all of them.
+        count = self.uint()
+        width = self.uint()
+        ragged = self.data[self.pos] == "w"
+        self.pos += 1
+        if ragged:
+            widths, self.pos = _unpackarray("H", self.data, self.pos, count)
+        if not count:
+            return [], None
+        columns = [self.column(count) for i in xrange(width)]
+        rows = map(list, izip(*columns))
+        if ragged:
+            rows = [row if w == width else row[:w] for row, w in izip(rows, widths)]
+            columns = None
+        return rows, columns
+
+    def column(self, n):
+        data = self.data
+        tag = data[self.pos]
+        self.pos += 1
+        if tag == "v":
+            return [self.value() for i in xrange(n)]
+        if tag == "I":
+            values, self.pos = _unpackarray("q", data, self.pos, n)
+        elif tag == "F":
+            values, self.pos = _unpackarray("d", data, self.pos, n)
+        elif tag == "D":
+            unit = data[self.pos]
+            stamps, self.pos = _unpackarray("q", data, self.pos + 1, n)
+            distinct = set(stamps)
+            if len(distinct) * 2 < n:
+                # each distinct date made once.
+                distinct = list(distinct)
+                dates = dict(izip(distinct, _dates(distinct, unit)))
+                values = map(dates.__getitem__, stamps)
+            else:
+                values = _dates(stamps, unit)
+        elif tag == "U":
+            values = self.string().decode("utf-8").split(u"\x00")
+        elif tag == "B":
+            values = self.string().split("\x00")
+        elif tag in "Cc":
+            size = data[self.pos]
+            self.pos += 1
+            count = self.uint()
+            text = self.string()
+            strings = (text.decode("utf-8") if tag == "C" else text).split(u"\x00" if tag == "C" else "\x00")
+            if len(strings) != count:
+                raise ValueError("column has %d strings, expected %d" % (len(strings), count))
+            if size not in _arraytypes:
+                raise ValueError("unknown code size %r" % size)
+            codes, self.pos = _unpackarray(size, data, self.pos, n)
+            values = map(strings.__getitem__, codes)
+        else:
+            raise ValueError("unknown column type %r" % tag)
+        if len(values) != n:
+            raise ValueError("column has %d values, expected %d" % (len(values), n))
+        for i in xrange(self.uint()):
+            i = self.uint()
+            values[i] = self.value()
+        return values
+
+
+def loads(data):
+    """
+    Returns the object stored in data by dumps(). Rowsets come back with
+    their rows in lists, also those that were stored by column in memory.
+    Raises ValueError if data isn't in this format or is of a newer version.
+
+    Values that were pickled are unpickled, which can run arbitrary code:
+    only load data from a source you trust, such as your own cache.
+    """
+    if not _ispacked(data):
+        raise ValueError("not an eveapi.binary string")
+    version = ord(data[4:5] or "\x00")
+    if version != _VERSION:
+        raise ValueError("unsupported eveapi.binary version %d" % version)
+    try:
+        return _Reader(data).value()
+    except (struct.error, IndexError, UnicodeDecodeError), e:
+        raise ValueError("corrupt eveapi.binary string: %s" % e)
@@ -0,0 +1,267 @@
+import hashlib
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from .binary import dumps
+from .exceptions import ServerError
+from .parser import _ParseXML
+from .transport import _GZIP_MAGIC
+
+
+def _cachekey(host, path, params):
+    # (host, path, params) in a hashable form that doesn't depend on the
+    # order or type of the parameters, e.g. characterID=1 and "1" are equal.
+    items = []
+    for k, v in params.iteritems():
+        if not isinstance(v, basestring):
+            v = str(v)
+        items.append((k, v))
+    items.sort()
+    return host, path, tuple(items)
+
+
+def _cachedfor(obj):
+    # number of seconds the document may be cached for. The server's clock
+    # may be off, so this is relative to the document's currentTime rather
+    # than to the local time.
+    delta = obj.cachedUntil - obj.currentTime
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def _sizeof(doc):
+    if isinstance(doc, basestring):
+        return len(doc)
+    return getattr(doc, "size", 0)
+
+
+class _Counter(object):
+    # stands in for the document when only its size is of interest.
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def close(self):
+        pass
+
+
+class MemoryCacheHandler(object):
+    """
+    Thread-safe in-memory cache handler for EVEAPIConnection().
+
+    Documents are cached until their cachedUntil time (corrected for the
+    difference between the server's clock and the local clock). When the
+    cache holds more than maxEntries documents or more than about maxBytes
+    worth of XML, the least recently used entries are evicted. Expired
+    entries are kept until evicted, so they can be served with the
+    staleTime and refreshAhead options of EVEAPIConnection().
+
+    If storeObjects is True (the default), the parsed result is cached
+    instead of the XML, so cache hits skip parsing altogether. Note that
+    this means every cache hit returns the same result object, so callers
+    must not modify it (e.g. SortBy() on a rowset sorts it for everyone).
+    Otherwise the XML is cached, compressed if the server sent it that way.
+    """
+
+    def __init__(self, maxEntries=1000, maxBytes=64*1024*1024, storeObjects=True):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.storeObjects = storeObjects
+        self.storeCompressed = not storeObjects
+        self._entries = OrderedDict()  # key: (expires, size, doc or obj)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def retrieve(self, host, path, params):
+        entry = self._get(host, path, params)
+        if entry is None or time.time() >= entry[0]:
+            return None
+        return entry[2]
+
+    def retrieve_stale(self, host, path, params):
+        entry = self._get(host, path, params)
+        if entry is None:
+            return None
+        return entry[2], entry[0]
+
+    def _get(self, host, path, params):
+        key = _cachekey(host, path, params)
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() < entry[0]:
+                # re-insert to mark as most recently used. expired entries
+                # are left to age out, they may still be used by
+                # retrieve_stale().
+                del self._entries[key]
+                self._entries[key] = entry
+            return entry
+        finally:
+            self._lock.release()
+
+    def open_store(self, host, path, params):
+        if self.storeObjects:
+            # no need for eveapi to hold on to the XML just so we can
+            # measure it.
+            return _Counter()
+        return None
+
+    def store(self, host, path, params, doc, obj):
+        cachedFor = _cachedfor(obj)
+        if cachedFor <= 0:
+            return
+
+        size = _sizeof(doc)
+        entry = (time.time() + cachedFor, size, obj if (self.storeObjects or not isinstance(doc, basestring)) else doc)
+        key = _cachekey(host, path, params)
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = entry
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.maxEntries or self._bytes > self.maxBytes):
+                key, old = self._entries.popitem(last=False)
+                self._bytes -= old[1]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._bytes = 0
+        finally:
+            self._lock.release()
+
+
+class SqliteCacheHandler(object):
+    """
+    Cache handler that keeps documents in an SQLite database file, so any
+    number of threads and processes on the same machine can share a single
+    cache. Documents are stored compressed (as they were received if the
+    server sent them gzip compressed) and are served until their cachedUntil
+    time (corrected for the server's clock skew).
+
+    If fallback is True, an expired document is served when the API server
+    reports a server error (ServerError) instead of the requested document.
+
+    If binary is True, parsed results are stored in the format of
+    eveapi.binary rather than as XML, so cache hits take much less time.
+
+    Expired documents are not removed automatically, use these methods for
+    maintenance:
+
+      purge(olderThan=0)
+        Deletes documents that expired more than olderThan seconds ago.
+        Returns the number of documents deleted.
+
+      vacuum()
+        Reclaims unused space in the database file.
+    """
+
+    storeCompressed = True
+
+    def __init__(self, filename, fallback=True, timeout=30.0, binary=False):
+        if sqlite3 is None:
+            raise RuntimeError("SqliteCacheHandler requires the sqlite3 module")
+        self.filename = filename
+        self.fallback = fallback
+        self.binary = binary
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _db(self):
+        # sqlite connections can't be shared by threads or forked processes,
+        # so every thread in every process gets its own.
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.filename, timeout=self.timeout, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS documents "
+                       "(key TEXT PRIMARY KEY, expires REAL NOT NULL, doc BLOB NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS documents_expires ON documents (expires)")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _key(self, host, path, params):
+        host, path, items = _cachekey(host, path, params)
+        # as UTF-8 bytes, parameters may be non-ASCII byte strings.
+        key = "\n".join([_utf8(host), _utf8(path)] + ["%s=%s" % (_utf8(k), _utf8(v)) for k, v in items])
+        return hashlib.sha1(key).hexdigest()
+
+    def retrieve(self, host, path, params):
+        row = self._db().execute("SELECT doc FROM documents WHERE key=? AND expires>?",
+                                 (self._key(host, path, params), time.time())).fetchone()
+        if row is None:
+            return None
+        return _unpack(row[0])
+
+    def retrieve_stale(self, host, path, params):
+        row = self._db().execute("SELECT doc, expires FROM documents WHERE key=?",
+                                 (self._key(host, path, params),)).fetchone()
+        if row is None:
+            return None
+        return _unpack(row[0]), row[1]
+
+    def retrieve_fallback(self, host, path, params, reason):
+        if not (self.fallback and isinstance(reason, ServerError)):
+            return None
+        row = self._db().execute("SELECT doc FROM documents WHERE key=?", (self._key(host, path, params),)).fetchone()
+        if row is None:
+            return None
+        return _ParseXML(_unpack(row[0]), True, None)
+
+    def open_store(self, host, path, params):
+        if self.binary:
+            # the XML isn't needed.
+            return _Counter()
+        return None
+
+    def store(self, host, path, params, doc, obj):
+        cachedFor = _cachedfor(obj)
+        if cachedFor <= 0:
+            return
+        if self.binary:
+            doc = dumps(obj)
+        elif not isinstance(doc, str):
+            return
+        if doc[:2] != _GZIP_MAGIC:
+            doc = zlib.compress(doc)
+        self._db().execute("INSERT OR REPLACE INTO documents (key, expires, doc) VALUES (?, ?, ?)",
+                           (self._key(host, path, params), time.time() + cachedFor, buffer(doc)))
+
+    def purge(self, olderThan=0):
+        return self._db().execute("DELETE FROM documents WHERE expires<=?", (time.time() - olderThan,)).rowcount
+
+    def vacuum(self):
+        self._db().execute("VACUUM")
+
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode("utf-8")
+    return s
+
+
+def _unpack(blob):
+    # gzip compressed documents are stored as received, and can be handed to
+    # the parser as-is. anything else (XML or eveapi.binary) was compressed
+    # by store().
+    doc = str(blob)
+    if doc[:2] == _GZIP_MAGIC:
+        return doc
+    return zlib.decompress(doc)
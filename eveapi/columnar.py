@@ -0,0 +1,381 @@
+from array import array
+from itertools import izip
+
+
+_EXACT = 2 ** 53  # ints up to this are exact as floats
+
+
+class _NumberColumn(object):
+    # ints or floats in an array. values of other types are kept in a dict
+    # by position instead, with a 0 in the array as placeholder. A column of
+    # ints is widened to floats at the first float, like numbers in a numpy
+    # array are, so its ints are read back as floats from then on.
+
+    def __init__(self, typecode, type):
+        self.values = array(typecode)
+        self.type = type
+        self.other = {}
+
+    def append(self, value):
+        t = type(value)
+        if t is self.type:
+            self.values.append(value)
+        elif t is float and self.type is int:
+            self._widen()
+            self.values.append(value)
+        elif t is int and self.type is float and -_EXACT <= value <= _EXACT:
+            self.values.append(value)
+        else:
+            self.other[len(self.values)] = value
+            self.values.append(0)
+
+    def _widen(self):
+        values = self.values
+        self.values = array("d", values)
+        self.type = float
+        for i, value in enumerate(values):
+            if not -_EXACT <= value <= _EXACT and i not in self.other:
+                self.other[i] = value
+
+    def extend(self, values):
+        if set(map(type, values)) == set([self.type]):
+            self.values.extend(array(self.values.typecode, values))
+        else:
+            for value in values:
+                self.append(value)
+
+    def pad(self, count):
+        self.values.extend(array(self.values.typecode, [0]) * count)
+
+    def pop(self):
+        value = self.values.pop()
+        return self.other.pop(len(self.values), value)
+
+    def __getitem__(self, i):
+        if self.other and i in self.other:
+            return self.other[i]
+        return self.values[i]
+
+    def __iter__(self):
+        if not self.other:
+            return iter(self.values)
+        return (self.other.get(i, value) for i, value in enumerate(self.values))
+
+    def take(self, positions):
+        column = _NumberColumn(self.values.typecode, self.type)
+        if self.other:
+            for i in positions:
+                column.append(self[i])
+        else:
+            values = self.values
+            column.values = array(values.typecode, [values[i] for i in positions])
+        return column
+
+    def __getstate__(self):
+        return (self.values.typecode, self.type, self.values.tostring(), self.other)
+
+    def __setstate__(self, state):
+        typecode, self.type, values, self.other = state
+        self.values = array(typecode)
+        self.values.fromstring(values)
+
+
+class _EncodedColumn(object):
+    # any other values, dictionary encoded: each distinct value is stored
+    # once, rows hold its number. Code 0 is None, used for padding too.
+
+    def __init__(self):
+        self.codes = array("i")
+        self.values = [None]
+        self.lookup = {(type(None), None): 0}
+
+    def append(self, value):
+        self.extend((value,))
+
+    def extend(self, values):
+        # values are looked up with their type, so that 1 and 1.0 or u"a"
+        # and "a" aren't confused.
+        lookup = self.lookup
+        codes = []
+        for value in values:
+            key = (type(value), value)
+            try:
+                code = lookup[key]
+            except KeyError:
+                code = lookup[key] = len(self.values)
+                self.values.append(value)
+            except TypeError:
+                # unhashable, can't be shared.
+                code = len(self.values)
+                self.values.append(value)
+            codes.append(code)
+        self.codes.extend(array("i", codes))
+
+    def pad(self, count):
+        self.codes.extend(array("i", [0]) * count)
+
+    def pop(self):
+        return self.values[self.codes.pop()]
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+    def __iter__(self):
+        return (self.values[code] for code in self.codes)
+
+    def take(self, positions):
+        column = _EncodedColumn()
+        codes = self.codes
+        column.codes = array("i", [codes[i] for i in positions])
+        column.values = self.values
+        column.lookup = self.lookup
+        return column
+
+    def __getstate__(self):
+        return (self.codes.tostring(), self.values)
+
+    def __setstate__(self, state):
+        codes, self.values = state
+        self.codes = array("i")
+        self.codes.fromstring(codes)
+        self.lookup = {}
+        for code, value in enumerate(self.values):
+            try:
+                self.lookup.setdefault((type(value), value), code)
+            except TypeError:
+                pass
+
+
+def _column(value):
+    # picks the column type for a column of which value is the first value.
+    if type(value) is int:
+        return _NumberColumn("l", int)
+    if type(value) is float:
+        return _NumberColumn("d", float)
+    return _EncodedColumn()
+
+
+class _ColumnStore(object):
+    # Stands in for the list of rows (Rowset._rows) of a columnar rowset.
+    # Values are kept by column, rows are lists built when they're read, so
+    # changes to such a list don't end up in the store.
+    #
+    # Appended rows are kept as they are until there are _BATCH of them, or
+    # the rows are used otherwise, and then added to the columns in one go.
+    # The parser relies on this, it may still add values to the last row, so
+    # that one is kept back when a batch is added.
+
+    _BATCH = 256
+
+    def __init__(self):
+        self._columns = []
+        self._widths = array("H")  # number of values in each row
+        self._count = 0
+        self._pending = []
+        self.version = 0  # changes when rows are moved around
+
+    def _flush(self, keep=0):
+        rows = self._pending
+        if len(rows) <= keep:
+            return
+        if keep:
+            rows, self._pending = rows[:-keep], rows[-keep:]
+        else:
+            self._pending = []
+        columns = self._columns
+        widths = map(len, rows)
+        for i in xrange(len(columns), max(widths)):
+            column = _column(rows[widths.index(max(widths))][i])
+            column.pad(self._count)
+            columns.append(column)
+        if min(widths) == len(columns):
+            for i, column in enumerate(columns):
+                column.extend([row[i] for row in rows])
+        else:
+            for row in rows:
+                for column, value in izip(columns, row):
+                    column.append(value)
+                for column in columns[len(row):]:
+                    column.pad(1)
+        self._widths.extend(array("H", widths))
+        self._count += len(rows)
+
+    def append(self, row):
+        self._pending.append(row)
+        if len(self._pending) > self._BATCH:
+            self._flush(1)
+
+    def __len__(self):
+        return self._count + len(self._pending)
+
+    def _row(self, i):
+        columns = self._columns
+        width = self._widths[i]
+        if width != len(columns):
+            columns = columns[:width]
+        return [column[i] for column in columns]
+
+    def __getitem__(self, i):
+        if type(i) is slice:
+            self._flush()
+            return self.take(xrange(*i.indices(self._count)))
+        if self._pending and (i == -1 or i == len(self) - 1):
+            return self._pending[-1]
+        self._flush()
+        if i < 0:
+            i += self._count
+            if i < 0:
+                raise IndexError("list index out of range")
+        elif i >= self._count:
+            raise IndexError("list index out of range")
+        return self._row(i)
+
+    def __getslice__(self, i, j):
+        return self[i:j]
+
+    def __iter__(self):
+        self._flush()
+        for i in xrange(self._count):
+            yield self._row(i)
+
+    def column(self, i):
+        # iterable over the values in the i-th column.
+        self._flush()
+        if not self._count:
+            return ()
+        if i >= len(self._columns):
+            raise IndexError("list index out of range")
+        return self._columns[i]
+
+    def pop(self, i=-1):
+        if self._pending and (i == -1 or i == len(self) - 1):
+            return self._pending.pop()
+        self._flush()
+        row = self[i]
+        if i == -1 or i == self._count - 1:
+            for column in self._columns:
+                column.pop()
+            self._widths.pop()
+            self._count -= 1
+        else:
+            if i < 0:
+                i += self._count
+            self._replace(range(i) + range(i + 1, self._count))
+        return row
+
+    def take(self, positions):
+        # a new store with the rows at the given positions.
+        self._flush()
+        positions = list(positions)
+        store = _ColumnStore()
+        store._columns = [column.take(positions) for column in self._columns]
+        widths = self._widths
+        store._widths = array("H", [widths[i] for i in positions])
+        store._count = len(positions)
+        return store
+
+    def _replace(self, positions):
+        store = self.take(positions)
+        self._columns, self._widths, self._count = store._columns, store._widths, store._count
+        self.version += 1
+
+    def sort(self, cmp=None, key=None, reverse=False):
+        rows = list(self)
+        if key is None:
+            order = sorted(xrange(len(rows)), cmp, rows.__getitem__, reverse)
+        else:
+            order = sorted(xrange(len(rows)), cmp, lambda i: key(rows[i]), reverse)
+        self._replace(order)
+
+    def sortcolumn(self, i, reverse=False):
+        # same as sort(key=lambda row: row[i], reverse=reverse), without
+        # building the rows.
+        values = list(self.column(i))
+        self._replace(sorted(xrange(self._count), key=values.__getitem__, reverse=reverse))
+
+    def __iadd__(self, rows):
+        for row in rows:
+            self.append(list(row))
+        return self
+
+    def __getstate__(self):
+        self._flush()
+        return (self._columns, self._widths.tostring(), self._count)
+
+    def __setstate__(self, state):
+        self._columns, widths, self._count = state
+        self._widths = array("H")
+        self._widths.fromstring(widths)
+        self._pending = []
+        self.version = 0
+
+
+class _ColumnIndex(object):
+    # Stands in for IndexRowset._items on columnar rowsets. Maps keys to the
+    # positions of rows, and builds the rows when they're asked for. The
+    # positions are worked out again once the store's rows have moved.
+
+    def __init__(self, store, ki, composite):
+        self._store = store
+        self._ki = ki
+        self._composite = composite
+        self._build()
+
+    def _build(self):
+        store = self._store
+        if not len(store):
+            keys = ()
+        elif self._composite:
+            keys = izip(*[store.column(k) for k in self._ki])
+        else:
+            keys = store.column(self._ki)
+        self._positions = dict((key, i) for i, key in enumerate(keys))
+        self._version = store.version
+
+    def _get(self):
+        if self._version != self._store.version:
+            self._build()
+        return self._positions
+
+    def __setitem__(self, key, row):
+        # only called by IndexRowset.append(), row is the last one.
+        self._get()[key] = len(self._store) - 1
+
+    def get(self, key, default=None):
+        i = self._get().get(key)
+        if i is None:
+            return default
+        return self._store[i]
+
+    def __getitem__(self, key):
+        return self._store[self._get()[key]]
+
+    def __contains__(self, key):
+        return key in self._get()
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self._get())
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def keys(self):
+        return self._get().keys()
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        for i in self._get().itervalues():
+            yield self._store[i]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for key, i in self._get().iteritems():
+            yield key, self._store[i]
+
+    def items(self):
+        return list(self.iteritems())
@@ -1,4 +1,10 @@
 import copy
+import operator
+from bisect import bisect_left, bisect_right
+
+from .arrays import _aggregate, _toarrays
+from .columnar import _ColumnIndex, _ColumnStore
+from .query import _bind, _conditions
 
 
 class Element(object):
@@ -9,6 +15,58 @@ class Element(object):
 _fmt = u"%s:%s".__mod__
 
 
+class _Columns(tuple):
+    # The column names of a rowset, in order, with a map of name to position
+    # for constant time lookups. A Rowset shares its _Columns with every Row
+    # and every rowset derived from it, so it must never be changed. When
+    # the columns change, the rowset gets a new one.
+
+    def __new__(cls, names=()):
+        self = tuple.__new__(cls, names)
+        positions = {}
+        for i, name in enumerate(self):
+            positions.setdefault(name, i)
+        self.positions = positions
+        return self
+
+    def index(self, name):
+        try:
+            return self.positions[name]
+        except (KeyError, TypeError):
+            raise ValueError("%r is not a column" % (name,))
+
+    def __contains__(self, name):
+        try:
+            return name in self.positions
+        except TypeError:
+            return False
+
+    def __add__(self, other):
+        return _Columns(tuple(self) + tuple(other))
+
+    def __reduce__(self):
+        return _Columns, (tuple(self),)
+
+
+def _columns(cols):
+    # returns cols as _Columns. lists of names may be passed in by users,
+    # and come from objects pickled by older versions.
+    if type(cols) is _Columns:
+        return cols
+    return _Columns(cols or ())
+
+
+def _keyindex(cols, key):
+    # returns (positions, composite) for a key of one column name or of
+    # several separated by commas, in which case positions is a list.
+    try:
+        if "," in key:
+            return [cols.index(k) for k in key.split(",")], True
+        return cols.index(key), False
+    except ValueError:
+        raise ValueError("Rowset has no column %s" % key)
+
+
 class Row(object):
     # A Row is a single database record associated with a Rowset.
     # The fields in the record are accessed as attributes by their respective
@@ -17,8 +75,10 @@ class Row(object):
     # To conserve resources, Row objects are only created on-demand. This is
     # typically done by Rowsets (e.g. when iterating over the rowset).
 
+    __slots__ = ("_cols", "_row")
+
     def __init__(self, cols=None, row=None):
-        self._cols = cols or []
+        self._cols = _columns(cols)
         self._row = row or []
 
     def __nonzero__(self):
@@ -36,20 +96,20 @@ class Row(object):
         return cmp(self._cols, other._cols) or cmp(self._row, other._row)
 
     def __hasattr__(self, this):
-        if this in self._cols:
-            return self._cols.index(this) < len(self._row)
-        return False
+        i = self._cols.positions.get(this)
+        return i is not None and i < len(self._row)
 
     __contains__ = __hasattr__
 
     def get(self, this, default=None):
-        if (this in self._cols) and (self._cols.index(this) < len(self._row)):
-            return self._row[self._cols.index(this)]
+        i = self._cols.positions.get(this)
+        if i is not None and i < len(self._row):
+            return self._row[i]
         return default
 
     def __getattr__(self, this):
         try:
-            return self._row[self._cols.index(this)]
+            return self._row[self._cols.positions[this]]
         except:
             raise AttributeError(this)
 
@@ -59,6 +119,16 @@ class Row(object):
     def __str__(self):
         return "Row(" + ','.join(map(_fmt, zip(self._cols, self._row))) + ")"
 
+    def __getstate__(self):
+        return (self._cols, self._row)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # pickled by an older version, when rows had a __dict__.
+            state = (state["_cols"], state["_row"])
+        cols, self._row = state
+        self._cols = _columns(cols)
+
 
 class Rowset(object):
     """
@@ -77,6 +147,18 @@ class Rowset(object):
         Returns a FilterRowset keyed on given column. FilterRowset objects
         can be accessed like dicts. See FilterRowset class below.
 
+      OrderedBy(column)
+        Returns an OrderedRowset of the rows in order of given column, for
+        range queries. See OrderedRowset class below.
+
+      The indexes built by IndexedBy(), GroupedBy() and OrderedBy() are
+      kept by the rowset, so asking for them again is cheap. They're kept
+      up to date when rows are added with append() or +=, and dropped
+      when the rowset is sorted. The IndexRowsets, FilterRowsets and
+      OrderedRowsets handed out share them, so they have the rows added
+      since too, up to the sort. The Rowsets of the groups of a
+      FilterRowset are copies, changing them doesn't change the index.
+
       SortBy(column, reverse=True)
         Sorts rowset in-place on given column. for a descending sort,
         specify reversed=True.
@@ -90,16 +172,95 @@ class Rowset(object):
         If only one column is requested, then just the column value is
         provided instead of the values tuple.
         When row=True, each result will be decorated with the entire row.
+
+      Where(conditions, column=value)
+        Returns a Query for the rows that meet all of the given conditions,
+        which are (column, operator, value) tuples, operator being one of
+        "==", "!=", "<", "<=", ">", ">=", "in" and "not in". Keyword
+        arguments are short for ("column", "==", value). For example:
+          rowset.Where(("amount", "<", 0), refTypeID=54).Select("refID")
+        The rows are only looked at once the query is used. See Query
+        class below.
+
+      Cursor()
+        Iterates over the rowset like a for loop does, except that the same
+        Row object is yielded every time, pointed at the next row. This is
+        faster, but each Row is only valid until the next is produced.
+
+      Filter(mask)
+        Returns a new rowset with the rows for which mask, a sequence of
+        booleans with an item for each row, holds a true value.
+
+      Join(other, on, how="inner")
+        Returns a new rowset with the rows of this rowset combined with the
+        rows of the other rowset that have the same value in column on.
+        on may also be a (column, othercolumn) tuple if the names differ,
+        and either may be several names separated by commas. The rows have
+        the columns of this rowset followed by those of the other except
+        its key columns; names that are taken get a "_2" suffix (or "_3",
+        and so on). With how="inner", rows without a match are left out.
+        With how="left", they are kept with None for the other columns.
+        If the other rowset is an IndexRowset on the key, or already has
+        an index on it from IndexedBy(), that index is used. Otherwise it
+        is grouped by the key, and the groups kept for later joins.
+
+    The following methods require numpy:
+
+      ToNumpy(columns, structured=False)
+        Returns a dict of numpy arrays with the values of the given columns
+        (all if none are given), or a structured array if structured=True.
+        Columns of ints, floats or dates get arrays of int64, float64 or
+        datetime64; missing values ("" or None) in the latter two are NaN
+        and NaT. Other columns get object arrays.
+        Filter() takes expressions on these arrays, for example:
+          rowset.Filter(rowset.ToNumpy("amount")["amount"] < 0)
+
+      Sum(column, by=None, where=None)
+      Min(column, by=None, where=None)
+      Max(column, by=None, where=None)
+      Mean(column, by=None, where=None)
+        Returns the sum, minimum, maximum or mean of the values in column.
+        If by is the name of a column, returns a dict mapping each value of
+        that column to the result for the rows with that value instead.
+        where may be a boolean array to select the rows to include, like
+        the mask passed to Filter().
     """
 
     def IndexedBy(self, column):
-        return IndexRowset(self._cols, self._rows, column)
+        return IndexRowset(self._cols, self._rows, column, self._index(column, "unique"))
 
     def GroupedBy(self, column):
-        return FilterRowset(self._cols, self._rows, column)
+        return FilterRowset(self._cols, None, column, dict=self._index(column, "group"))
+
+    def OrderedBy(self, column):
+        return self._index(column, "ordered")
+
+    def _index(self, key, kind):
+        # returns the index of the given kind on key, built on first use:
+        #   "unique": a dict mapping each key to its row.
+        #   "group": a dict mapping each key to the list of its rows.
+        #   "ordered": an OrderedRowset.
+        entry = self._indexes.get((key, kind))
+        if entry is not None:
+            return entry[0]
+        ki, composite = _keyindex(self._cols, key)
+        rows = self._rows
+        if kind == "ordered":
+            index = OrderedRowset(self._cols, rows, key)
+        elif kind == "unique" and isinstance(rows, _ColumnStore):
+            index = _ColumnIndex(rows, ki, composite)
+        else:
+            index = {}
+            _addrows(index, kind, ki, composite, rows)
+        self._indexes[(key, kind)] = (index, kind, ki, composite)
+        return index
 
     def SortBy(self, column, reverse=False):
         ix = self._cols.index(column)
+        if isinstance(self._rows, _ColumnStore):
+            self._rows.sortcolumn(ix, reverse)
+            self._invalidate()
+            return
         self.sort(key=lambda e: e[ix], reverse=reverse)
 
     def SortedBy(self, column, reverse=False):
@@ -110,6 +271,11 @@ class Rowset(object):
     def Select(self, *columns, **options):
         if len(columns) == 1:
             i = self._cols.index(columns[0])
+            # column stores and snapshots can hand out a column at once.
+            if hasattr(self._rows, "column") and not options.get("row", False):
+                for value in self._rows.column(i):
+                    yield value
+                return
             if options.get("row", False):
                 for line in self._rows:
                     yield (line, line[i])
@@ -125,23 +291,126 @@ class Rowset(object):
                 for line in self._rows:
                     yield [line[x] for x in i]
 
+    def Filter(self, mask):
+        if len(mask) != len(self._rows):
+            raise ValueError("mask has %d items, rowset has %d rows" % (len(mask), len(self._rows)))
+        if isinstance(self._rows, _ColumnStore):
+            rows = self._rows.take([i for i, keep in enumerate(mask) if keep])
+        else:
+            rows = [row for row, keep in zip(self._rows, mask) if keep]
+        return self._derive(rows)
+
+    def Where(self, *conditions, **equalities):
+        return Query(self, _conditions(conditions, equalities))
+
+    def Join(self, other, on, how="inner"):
+        if how not in ("inner", "left"):
+            raise ValueError("unknown join type %r" % (how,))
+        if isinstance(on, basestring):
+            on = (on, on)
+        ki, composite = _keyindex(self._cols, on[0])
+        oki, ocomposite = _keyindex(other._cols, on[1])
+        if composite != ocomposite or (composite and len(ki) != len(oki)):
+            raise ValueError("join keys have different numbers of columns")
+
+        # the other rowset's columns, except its key.
+        okey = oki if ocomposite else [oki]
+        keep = [i for i in xrange(len(other._cols)) if i not in okey]
+        cols = list(self._cols)
+        taken = set(cols)
+        for i in keep:
+            name = other._cols[i]
+            n = 2
+            while name in taken:
+                name = "%s_%d" % (other._cols[i], n)
+                n += 1
+            taken.add(name)
+            cols.append(name)
+
+        entry = other._indexes.get((on[1], "unique"))
+        if entry is not None:
+            index, unique = entry[0], True
+        else:
+            index, unique = other._index(on[1], "group"), False
+        missing = [None] * len(keep)
+        rows = []
+        for row in self._rows:
+            key = tuple([row[k] for k in ki]) if composite else row[ki]
+            match = index.get(key)
+            if match is None:
+                if how == "left":
+                    rows.append(row + missing)
+            elif unique:
+                rows.append(row + [match[i] for i in keep])
+            else:
+                for match in match:
+                    rows.append(row + [match[i] for i in keep])
+        return Rowset(cols, rows)
+
+    def ToNumpy(self, *columns, **options):
+        return _toarrays(self, columns, options.get("structured", False))
+
+    def Sum(self, column, by=None, where=None):
+        return _aggregate(self, "sum", column, by, where)
+
+    def Min(self, column, by=None, where=None):
+        return _aggregate(self, "min", column, by, where)
+
+    def Max(self, column, by=None, where=None):
+        return _aggregate(self, "max", column, by, where)
+
+    def Mean(self, column, by=None, where=None):
+        return _aggregate(self, "mean", column, by, where)
+
+    def Cursor(self):
+        row = Row(self._cols)
+        # the loop target is the row's data, there's nothing else to do.
+        for row._row in self._rows:
+            yield row
+
     def __init__(self, cols=None, rows=None):
-        self._cols = cols or []
-        self._rows = rows or []
+        self._cols = _columns(cols)
+        self._rows = [] if rows is None else rows
+        self._indexes = {}  # (key, kind): (index, kind, ki, composite)
 
     def append(self, row):
-        if isinstance(row, list):
-            self._rows.append(row)
-        elif isinstance(row, Row) and len(row._cols) == len(self._cols):
-            self._rows.append(row._row)
-        else:
+        if isinstance(row, Row) and len(row._cols) == len(self._cols):
+            row = row._row
+        elif not isinstance(row, list):
             raise TypeError("incompatible row type")
+        self._rows.append(row)
+        for index, kind, ki, composite in self._indexes.itervalues():
+            _addrows(index, kind, ki, composite, (row,))
+
+    def _invalidate(self):
+        # drops the indexes after the rows have been reordered.
+        self._indexes.clear()
+
+    def _addable(self, other):
+        if not isinstance(other, Rowset):
+            raise TypeError("rowset instance expected")
+        if tuple(other._cols) != tuple(self._cols):
+            raise ValueError("rowsets have different columns")
+        return other._rows
 
     def __add__(self, other):
-        if isinstance(other, Rowset):
-            if len(other._cols) == len(self._cols):
-                self._rows += other._rows
-        raise TypeError("rowset instance expected")
+        rows = self._addable(other)
+        return self._derive(list(self._rows) + list(rows))
+
+    def __iadd__(self, other):
+        # extends the rows in place, in time proportional to the rows added.
+        rows = self._addable(other)
+        if rows is self._rows:
+            rows = list(rows)
+        if isinstance(self._rows, _ColumnStore):
+            # its indexes map keys to positions, which append() keeps track of.
+            for row in rows:
+                self.append(list(row))
+            return self
+        self._rows += rows
+        for index, kind, ki, composite in self._indexes.itervalues():
+            _addrows(index, kind, ki, composite, rows)
+        return self
 
     def __nonzero__(self):
         return not not self._rows
@@ -152,13 +421,23 @@ class Rowset(object):
     def copy(self):
         return self[:]
 
+    def _derive(self, rows):
+        # a rowset of the same kind with other rows.
+        return Rowset(self._cols, rows)
+
     def __getitem__(self, ix):
         if type(ix) is slice:
-            return Rowset(self._cols, self._rows[ix])
+            return self._derive(self._rows[ix])
         return Row(self._cols, self._rows[ix])
 
+    def __iter__(self):
+        cols = self._cols
+        for row in self._rows:
+            yield Row(cols, row)
+
     def sort(self, *args, **kw):
         self._rows.sort(*args, **kw)
+        self._invalidate()
 
     def __str__(self):
         return ("Rowset(columns=[%s], rows=%d)" % (','.join(self._cols), len(self)))
@@ -167,7 +446,115 @@ class Rowset(object):
         return (self._cols, self._rows)
 
     def __setstate__(self, state):
-        self._cols, self._rows = state
+        cols, self._rows = state
+        self._cols = _columns(cols)
+        self._indexes = {}
+
+
+class Query(object):
+    """
+    The rows of a rowset that meet a number of conditions, as returned by
+    Rowset.Where(). The rowset is searched every time the query is used,
+    so it reflects changes made to the rowset since.
+
+    Queries support iteration (yielding Row objects) and len(), as well as
+    the following methods:
+
+      Where(conditions, column=value)
+        Returns a new query for the rows of this one that also meet the
+        given conditions.
+
+      Select(columns, row=False)
+        Same as Rowset.Select(), for the matching rows only.
+
+      ToRowset()
+        Returns a new rowset of the same kind as the one queried, with the
+        matching rows.
+
+    An "==" condition on a column for which the rowset keeps an index (see
+    IndexedBy() and GroupedBy()) looks the rows up in that index instead
+    of checking every row.
+    """
+
+    def __init__(self, rowset, conditions):
+        for column, func, value in conditions:
+            if column not in rowset._cols:
+                raise ValueError("Rowset has no column %s" % column)
+        self._rowset = rowset
+        self._conditions = conditions
+
+    def Where(self, *conditions, **equalities):
+        return Query(self._rowset, self._conditions + _conditions(conditions, equalities))
+
+    def _rows(self):
+        # the matching rows, as a list or as a column store.
+        rowset = self._rowset
+        rows = rowset._rows
+        tests = _bind(self._conditions, rowset._cols)
+        if isinstance(rows, _ColumnStore):
+            # one column at a time, without building rows.
+            positions = xrange(len(rows))
+            for i, func, value in tests:
+                column = rows.column(i)
+                positions = [j for j in positions if func(column[j], value)]
+            return rows.take(positions)
+
+        for n, (i, func, value) in enumerate(tests):
+            if func is not operator.eq:
+                continue
+            column = rowset._cols[i]
+            group = rowset._indexes.get((column, "group"))
+            unique = rowset._indexes.get((column, "unique"))
+            try:
+                if group is not None:
+                    rows = group[0].get(value, ())
+                elif unique is not None:
+                    row = unique[0].get(value)
+                    rows = () if row is None else (row,)
+                else:
+                    continue
+            except TypeError:
+                # unhashable value, can't be looked up.
+                continue
+            del tests[n]
+            break
+        for i, func, value in tests:
+            rows = [row for row in rows if func(row[i], value)]
+        return list(rows)
+
+    def Select(self, *columns, **options):
+        return Rowset(self._rowset._cols, self._rows()).Select(*columns, **options)
+
+    def ToRowset(self):
+        return self._rowset._derive(self._rows())
+
+    def __iter__(self):
+        cols = self._rowset._cols
+        for row in self._rows():
+            yield Row(cols, row)
+
+    def __len__(self):
+        return len(self._rows())
+
+    def __str__(self):
+        return "Query(%s, conditions=%d)" % (self._rowset, len(self._conditions))
+
+
+def _addrows(index, kind, ki, composite, rows):
+    # adds rows to an index as built by Rowset._index().
+    for row in rows:
+        if composite:
+            key = tuple([row[k] for k in ki])
+        else:
+            key = row[ki]
+        if kind == "unique":
+            index[key] = row
+        elif kind == "ordered":
+            index._insert(key, row)
+        elif key in index:
+            index[key].append(row)
+        else:
+            index[key] = [row]
 
 
 class IndexRowset(Rowset):
@@ -190,42 +577,142 @@ class IndexRowset(Rowset):
             raise KeyError(key)
         return Row(self._cols, row)
 
-    def __init__(self, cols=None, rows=None, key=None):
-        try:
-            if "," in key:
-                self._ki = ki = [cols.index(k) for k in key.split(",")]
-                self.composite = True
-            else:
-                self._ki = ki = cols.index(key)
-                self.composite = False
-        except IndexError:
-            raise ValueError("Rowset has no column %s" % key)
-
+    def __init__(self, cols=None, rows=None, key=None, items=None):
+        # items may be an existing index on key for rows.
+        cols = _columns(cols)
+        self._ki, self.composite = _keyindex(cols, key)
         Rowset.__init__(self, cols, rows)
         self._key = key
+        if items is None:
+            items = self._index(key, "unique")
+        self._items = items
+        self._invalidate()
+
+    def _invalidate(self):
+        # the primary index is always kept.
+        self._indexes.clear()
+        self._indexes[(self._key, "unique")] = (self._items, "unique", self._ki, self.composite)
 
+    def _derive(self, rows):
+        return IndexRowset(self._cols, rows, self._key)
+
+    def __getstate__(self):
+        return (Rowset.__getstate__(self), self._items, self._ki)
+
+    def __setstate__(self, state):
+        state, self._items, self._ki = state
+        Rowset.__setstate__(self, state)
+        # the key isn't pickled, but follows from the columns.
+        self.composite = type(self._ki) is list
         if self.composite:
-            self._items = dict((tuple([row[k] for k in ki]), row) for row in self._rows)
+            self._key = ",".join([self._cols[k] for k in self._ki])
         else:
-            self._items = dict((row[ki], row) for row in self._rows)
+            self._key = self._cols[self._ki]
+        self._invalidate()
 
-    def __getitem__(self, ix):
-        if type(ix) is slice:
-            return IndexRowset(self._cols, self._rows[ix], self._key)
-        return Rowset.__getitem__(self, ix)
 
-    def append(self, row):
-        Rowset.append(self, row)
-        if self.composite:
-            self._items[tuple([row[k] for k in self._ki])] = row
+class OrderedRowset(Rowset):
+    """
+    An OrderedRowset holds the rows of a rowset in order of a column (or
+    of several, separated by commas), and finds rows by that column in
+    O(log n). It shares the rows with the rowset it was made from.
+
+    The interface is the same as Rowset, except that it can't be sorted in
+    place, and rows added with append() are put in their place. It provides these
+    additional methods:
+
+      Range(lo=None, hi=None)
+        Returns a Rowset of the rows with lo <= key <= hi, in key order.
+        Either bound may be None for no bound.
+
+      TopN(n)
+        Returns a Rowset of the n rows with the highest keys, highest first.
+
+      Floor(key [, default])
+        Returns the Row with the highest key <= key.
+
+      Ceiling(key [, default])
+        Returns the Row with the lowest key >= key.
+
+      If there's no such row, Floor and Ceiling raise KeyError unless a
+      default value was specified.
+    """
+
+    def __init__(self, cols=None, rows=None, key=None):
+        cols = _columns(cols)
+        ki, composite = _keyindex(cols, key)
+        if composite:
+            keyed = [(tuple([row[k] for k in ki]), row) for row in rows or ()]
         else:
-            self._items[row[self._ki]] = row
+            keyed = [(row[ki], row) for row in rows or ()]
+        # a stable sort on the key alone, rows needn't be comparable.
+        keyed.sort(key=lambda item: item[0])
+        Rowset.__init__(self, cols, [row for k, row in keyed])
+        self._keys = [k for k, row in keyed]
+        self._key = key
+
+    def _insert(self, key, row):
+        i = bisect_right(self._keys, key)
+        self._keys.insert(i, key)
+        self._rows.insert(i, row)
+
+    def append(self, row):
+        if isinstance(row, Row) and len(row._cols) == len(self._cols):
+            row = row._row
+        elif not isinstance(row, list):
+            raise TypeError("incompatible row type")
+        ki, composite = _keyindex(self._cols, self._key)
+        self._insert(tuple([row[k] for k in ki]) if composite else row[ki], row)
+        for index, kind, ki, composite in self._indexes.itervalues():
+            _addrows(index, kind, ki, composite, (row,))
+
+    def __iadd__(self, other):
+        for row in list(self._addable(other)):
+            self.append(row)
+        return self
+
+    def sort(self, *args, **kw):
+        raise TypeError("OrderedRowset is always in key order")
+
+    def SortedBy(self, column, reverse=False):
+        rs = Rowset(self._cols, self._rows[:])
+        rs.SortBy(column, reverse)
+        return rs
+
+    def _derive(self, rows):
+        return OrderedRowset(self._cols, rows, self._key)
+
+    def Range(self, lo=None, hi=None):
+        start = 0 if lo is None else bisect_left(self._keys, lo)
+        end = len(self._keys) if hi is None else bisect_right(self._keys, hi)
+        return Rowset(self._cols, self._rows[start:end])
+
+    def TopN(self, n):
+        rows = self._rows[max(len(self._rows) - n, 0):]
+        rows.reverse()
+        return Rowset(self._cols, rows)
+
+    def Floor(self, key, *default):
+        i = bisect_right(self._keys, key)
+        if i:
+            return Row(self._cols, self._rows[i - 1])
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def Ceiling(self, key, *default):
+        i = bisect_left(self._keys, key)
+        if i < len(self._rows):
+            return Row(self._cols, self._rows[i])
+        if default:
+            return default[0]
+        raise KeyError(key)
 
     def __getstate__(self):
-        return (Rowset.__getstate__(self), self._items, self._ki)
+        return (Rowset.__getstate__(self), self._keys, self._key)
 
     def __setstate__(self, state):
-        state, self._items, self._ki = state
+        state, self._keys, self._key = state
         Rowset.__setstate__(self, state)
 
 
@@ -261,7 +748,7 @@ class FilterRowset(object):
                     else:
                         items[id] = {row[idfield2]: row}
 
-        self._cols = cols
+        self._cols = _columns(cols)
         self.key = key
         self.key2 = key2
         self._bind()
@@ -276,7 +763,7 @@ class FilterRowset(object):
         self.__iter__ = items.__iter__
 
     def copy(self):
-        return FilterRowset(self._cols[:], None, self.key, self.key2, dict=copy.deepcopy(self._items))
+        return FilterRowset(self._cols, None, self.key, self.key2, dict=copy.deepcopy(self._items))
 
     def get(self, key, default=[]):
         try:
@@ -287,14 +774,17 @@ class FilterRowset(object):
         return default
 
     def __getitem__(self, i):
+        # copies, the lists may be those of an index kept by a rowset.
         if self.key2:
-            return IndexRowset(self._cols, None, self.key2, self._items.get(i, {}))
+            return IndexRowset(self._cols, None, self.key2, dict(self._items.get(i, {})))
 
-        return Rowset(self._cols, self._items.get(i))
+        rows = self._items.get(i)
+        return Rowset(self._cols, rows if rows is None else list(rows))
 
     def __getstate__(self):
-        return (self._cols, self._rows, self._items, self.key, self.key2)
+        return (self._cols, None, self._items, self.key, self.key2)
 
     def __setstate__(self, state):
-        self._cols, self._rows, self._items, self.key, self.key2 = state
+        cols, self._rows, self._items, self.key, self.key2 = state
+        self._cols = _columns(cols)
         self._bind()
@@ -1,6 +1,11 @@
 import httplib
+import Queue
+import threading
+import time
 import urllib
 import warnings
+from collections import deque
+from cStringIO import StringIO
 
 from eveapi import DEFAULT_UA, USER_AGENT
 from .exceptions import (
@@ -8,11 +13,66 @@ from .exceptions import (
     Error,
     ServerError
 )
-from .parser import _ParseXML
+from .cache import _cachekey
+from .paging import PageWalker
+from .parser import _ParseXML, RowStream
+from .query import _where
+from .scheduler import _priority, _prioritized, BULK
+from .transport import _Decompressor, _Tee
+from .workers import _WorkerPool
 
 _listtypes = (list, tuple, dict)
 
 
+class _PooledResponse(object):
+    # file-like wrapper that hands the connection back to the pool as soon as
+    # the response body has been read in full.
+
+    def __init__(self, pool, conn, response):
+        self._pool = pool
+        self._conn = conn
+        self._response = response
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        if self._conn is not None and (not data or self._response.isclosed()):
+            self._pool.release(self._conn, self._response)
+            self._conn = None
+        return data
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn, self._response)
+            self._conn = None
+
+
+class _Refresher(object):
+    # Refreshes cached documents on background threads, making sure the same
+    # document isn't being refreshed more than once at a time.
+
+    def __init__(self, threads):
+        self._workers = _WorkerPool(threads)
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def schedule(self, key, func, *args):
+        self._lock.acquire()
+        try:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        finally:
+            self._lock.release()
+        self._workers.submit(func, *args).add_done_callback(lambda future: self._done(key))
+
+    def _done(self, key):
+        self._lock.acquire()
+        try:
+            self._pending.discard(key)
+        finally:
+            self._lock.release()
+
+
 class _Context(object):
 
     def __init__(self, root, path, parentDict, newKeywords=None):
@@ -53,6 +113,32 @@ class _Context(object):
         # now let the root context handle it further
         return self._root(self._path, **kw)
 
+    def stream(self, rowset, **kw):
+        # Same as calling this context, except that it returns a RowStream
+        # that yields the rows of the named rowset while they're being
+        # parsed, instead of the result. Streamed calls make use of cached
+        # documents, but their results are not stored in the cache.
+        for k, v in self.parameters.iteritems():
+            if k not in kw:
+                kw[k] = v
+        return self._root._stream(self._path, rowset, kw)
+
+    def query(self, where, **kw):
+        # Same as calling this context, except that rows of the rowsets named
+        # in where that don't meet the conditions given for them are left out
+        # while parsing (see ParseXML()). Like streamed calls, queries make
+        # use of cached documents, but their results are not stored.
+        for k, v in self.parameters.iteritems():
+            if k not in kw:
+                kw[k] = v
+        return self._root._query(self._path, where, kw)
+
+    def walk(self, rowset=None, rowCount=None, stopID=None, since=None, maxRows=None, seen=None, **kw):
+        # Returns a PageWalker that walks back through the pages of a call
+        # that takes fromID and rowCount parameters, such as WalletJournal,
+        # until one of the given stop conditions is met. See PageWalker.
+        return PageWalker(self, rowset, rowCount, stopID, since, maxRows, seen, kw)
+
 
 class _AuthContext(_Context):
 
@@ -68,6 +154,8 @@ class _AuthContext(_Context):
 
 
 class _RootContext(_Context):
+    _staleTime = _refreshAhead = 0
+    _scheduler = None
 
     def auth(self, **kw):
         if len(kw) == 2 and (("keyID" in kw and "vCode" in kw) or ("userID" in kw and "apiKey" in kw)):
@@ -77,46 +165,103 @@ class _RootContext(_Context):
     def setcachehandler(self, handler):
         self._root._handler = handler
 
-    def __call__(self, path, **kw):
+    def batch(self, calls, concurrency=8, ordered=False, priority=BULK):
+        # Runs many calls concurrently on a pool of worker threads.
+        #
+        # calls is an iterable of (path, params) pairs, where path is relative
+        # to this connection (e.g. "char/AccountBalance"), or (context, params)
+        # pairs, where context is any context object obtained from this
+        # connection (e.g. auth.char.WalletJournal). Calls go through the
+        # cache handler and parser exactly like regular calls do.
+        #
+        # Yields (call, result) tuples as calls finish, or in the order they
+        # were given if ordered is True. If a call raised an exception, result
+        # is the exception instance instead. At most concurrency calls are in
+        # flight at once; consider raising the connection's poolSize to match.
+        #
+        # When the connection has rate limits, requests that are held back
+        # are sent in order of priority, lowest first. Regular calls have
+        # priority 0, background refreshes 1, like batches by default.
+        return _batch(self._root, calls, concurrency, ordered, priority)
+
+    def _convert(self, kw):
         # convert list type arguments to something the API likes
         for k, v in kw.iteritems():
             if isinstance(v, _listtypes):
                 kw[k] = ','.join(map(str, list(v)))
 
-        cache = self._root._handler
+    def _stream(self, path, rowset, kw):
+        self._convert(kw)
+        return self._request(path + ".xml.aspx", kw, stream=rowset)
+
+    def _query(self, path, where, kw):
+        self._convert(kw)
+        return self._request(path + ".xml.aspx", kw, where=_where(where))
 
-        # now send the request
+    def __call__(self, path, **kw):
+        self._convert(kw)
+
+        # now send the request. identical requests that are already in
+        # progress on other threads are not sent again, instead we wait for
+        # that one to finish and share its result.
         path += ".xml.aspx"
+        return self._inflight.do(_cachekey(self._host, path, kw), self._request, path, kw)
+
+    def _retrieve(self, cache, path, kw):
+        retrieve_stale = (self._staleTime or self._refreshAhead) and getattr(cache, "retrieve_stale", None)
+        if not retrieve_stale:
+            return cache.retrieve(self._host, path, kw)
+
+        # serve expired documents for up to _staleTime seconds, and refresh
+        # documents that have expired (or are about to) in the background.
+        entry = retrieve_stale(self._host, path, kw)
+        if entry is None:
+            return None
+        doc, expires = entry
+        now = time.time()
+        if now >= expires + self._staleTime:
+            return None
+        if now >= expires - self._refreshAhead:
+            self._refresher.schedule(_cachekey(self._host, path, kw), self._request, path, kw.copy(), True)
+        return doc
+
+    def _request(self, path, kw, refresh=False, stream=None, where=None):
+        cache = self._root._handler
+        pooled = sink = None
+        store = buffered = False
+        stored = []
 
-        if cache:
-            response = cache.retrieve(self._host, path, kw)
+        if cache and not refresh:
+            response = self._retrieve(cache, path, kw)
         else:
             response = None
 
         if response is None:
             if not USER_AGENT:
-                warnings.warn("No User-Agent set! Please use the set_user_agent() module-level function before accessing the EVE API.", stacklevel=3)
+                warnings.warn("No User-Agent set! Please use the set_user_agent() module-level function "
+                              "before accessing the EVE API.", stacklevel=5)
 
             if self._proxy is None:
                 req = path
-                if self._scheme == "https":
-                    conn = httplib.HTTPSConnection(self._host)
-                else:
-                    conn = httplib.HTTPConnection(self._host)
             else:
                 req = self._scheme+'://'+self._host+path
-                if self._proxySSL:
-                    conn = httplib.HTTPSConnection(*self._proxy)
-                else:
-                    conn = httplib.HTTPConnection(*self._proxy)
 
+            if self._scheduler is not None:
+                # wait for our turn under the connection's rate limits.
+                # background refreshes go after everything else.
+                self._scheduler.acquire(kw.get("keyID", kw.get("userID")), BULK if refresh else _priority())
+
+            headers = {"User-Agent": USER_AGENT or DEFAULT_UA, "Accept-Encoding": "gzip, deflate"}
             if kw:
-                conn.request("POST", req, urllib.urlencode(kw), {"Content-type": "application/x-www-form-urlencoded", "User-Agent": USER_AGENT or DEFAULT_UA})
+                headers["Content-type"] = "application/x-www-form-urlencoded"
+                conn, response = self._pool.request("POST", req, urllib.urlencode(kw), headers)
             else:
-                conn.request("GET", req, "", {"User-Agent": USER_AGENT or DEFAULT_UA})
+                conn, response = self._pool.request("GET", req, "", headers)
 
-            response = conn.getresponse()
             if response.status != 200:
+                # drain the error page so the connection can be reused.
+                response.read()
+                self._pool.release(conn, response)
                 if response.status == httplib.NOT_FOUND:
                     raise AttributeError("'%s' not available on API server (404 Not Found)" % path)
                 elif response.status == httplib.FORBIDDEN:
@@ -124,24 +269,103 @@ class _RootContext(_Context):
                 else:
                     raise ServerError(response.status, "'%s' request failed (%s)" % (path, response.reason))
 
-            if cache:
+            encoding = (response.getheader("Content-Encoding") or "").strip().lower()
+            if encoding not in ("gzip", "deflate"):
+                encoding = None
+
+            # the parser reads straight from the socket, the connection is
+            # returned to the pool once it's done.
+            response = pooled = _PooledResponse(self._pool, conn, response)
+
+            if cache and stream is None and where is None:
+                # the document is copied to the cache as it's being parsed,
+                # either straight into the handler's storage if it supports
+                # that, or into a buffer to be passed to store() afterwards.
+                # cache handlers that can take gzip compressed documents get
+                # them exactly as they arrived.
                 store = True
-                response = response.read()
-            else:
-                store = False
-        else:
-            store = False
+                open_store = getattr(cache, "open_store", None)
+                sink = open_store and open_store(self._host, path, kw)
+                if sink is None:
+                    sink = StringIO()
+                    buffered = True
+                if encoding == "gzip" and getattr(cache, "storeCompressed", False):
+                    response = _Decompressor(_Tee(response, sink))
+                elif encoding:
+                    response = _Tee(_Decompressor(response, encoding), sink)
+                else:
+                    response = _Tee(response, sink)
+            elif encoding:
+                response = _Decompressor(response, encoding)
 
-        retrieve_fallback = cache and getattr(cache, "retrieve_fallback", False)
-        if retrieve_fallback:
-            # implementor is handling fallbacks...
-            try:
-                return _ParseXML(response, True, store and (lambda obj: cache.store(self._host, path, kw, response, obj)))
-            except Error, e:
-                response = retrieve_fallback(self._host, path, kw, reason=e)
-                if response is not None:
-                    return response
+        if stream is not None:
+            # the connection is returned to the pool by the stream.
+            return RowStream(response, stream, True, pooled, where)
+
+        def storeFunc(obj):
+            cache.store(self._host, path, kw, sink.getvalue() if buffered else sink, obj)
+            stored.append(True)
+
+        try:
+            return _ParseXML(response, True, store and storeFunc, where)
+        except Error, e:
+            retrieve_fallback = cache and getattr(cache, "retrieve_fallback", False)
+            if not retrieve_fallback:
                 raise
-        else:
-            # implementor is not handling fallbacks...
-            return _ParseXML(response, True, store and (lambda obj: cache.store(self._host, path, kw, response, obj)))
+            # implementor is handling fallbacks...
+            response = retrieve_fallback(self._host, path, kw, reason=e)
+            if response is not None:
+                return response
+            raise
+        finally:
+            if pooled is not None:
+                # no-op unless parsing bailed out before the end of the
+                # response, in which case the connection is discarded.
+                pooled.close()
+            if store and not (buffered or stored):
+                # tell the handler its copy is not going to be stored.
+                sink.close()
+
+
+def _batchcall(root, call):
+    target, kw = call
+    kw = dict(kw or {})
+    if isinstance(target, _Context):
+        return target(**kw)
+    return root(root._path + "/" + target.strip("/"), **kw)
+
+
+def _batch(root, calls, concurrency, ordered, priority):
+    workers = _WorkerPool(concurrency)
+    finished = Queue.Queue()
+    pending = deque()
+    calls = iter(calls)
+    try:
+        while True:
+            # keep the workers busy, but don't run too far ahead of the
+            # consumer so huge (or endless) iterables are fine.
+            for call in calls:
+                future = workers.submit(_prioritized, priority, _batchcall, root, call)
+                future.call = call
+                if not ordered:
+                    future.add_done_callback(finished.put)
+                pending.append(future)
+                if len(pending) >= 2 * concurrency:
+                    break
+
+            if not pending:
+                return
+
+            if ordered:
+                future = pending.popleft()
+            else:
+                future = finished.get()
+                pending.remove(future)
+
+            e = future.exception()
+            if e is None:
+                yield future.call, future.result()
+            else:
+                yield future.call, e
+    finally:
+        workers.shutdown()
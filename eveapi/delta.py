@@ -0,0 +1,136 @@
+from .containers import _addrows, _keyindex, IndexRowset, Rowset
+
+
+def _same(a, b):
+    # compares row values, nested rowsets (e.g. the contents of assets) by
+    # their columns and rows rather than by identity.
+    if len(a) != len(b):
+        return False
+    for x, y in zip(a, b):
+        if x == y:
+            continue
+        if not (isinstance(x, Rowset) and isinstance(y, Rowset)):
+            return False
+        if tuple(x._cols) != tuple(y._cols) or len(x) != len(y):
+            return False
+        for r, s in zip(x._rows, y._rows):
+            if r != s and not _same(r, s):
+                return False
+    return True
+
+
+class Delta(object):
+    """
+    The differences between two versions of a keyed rowset, as returned by
+    diff(). Its attributes are IndexRowsets on the same key:
+
+      added
+        The new rows with keys that weren't in the old version.
+
+      removed
+        The old rows with keys that aren't in the new version. Always empty
+        if the new version is partial.
+
+      changed
+        The new rows of keys that were in the old version with other values.
+
+    A Delta is true if there are any differences, len() is their number.
+    It provides one method:
+
+      Apply(rowset)
+        Changes rowset, an IndexRowset of the old version, into the new
+        one in place: added rows are put in front (where the newest rows of
+        journals are), changed rows are updated, removed rows are dropped.
+        The time this takes grows with the number of differences, except
+        for dropping rows. Returns rowset.
+    """
+
+    def __init__(self, cols, key, added, removed, changed):
+        self.added = IndexRowset(cols, added, key)
+        self.removed = IndexRowset(cols, removed, key)
+        self.changed = IndexRowset(cols, changed, key)
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    def __repr__(self):
+        return "<Delta: %d added, %d removed, %d changed>" % (len(self.added), len(self.removed), len(self.changed))
+
+    def Apply(self, rowset):
+        if not isinstance(rowset._rows, list):
+            raise TypeError("rowset can't be changed in place")
+        if tuple(rowset._cols) != tuple(self.added._cols):
+            raise ValueError("rowsets have different columns")
+        items = rowset._index(self.added._key, "unique")
+        ki, composite = _keyindex(rowset._cols, self.added._key)
+
+        if self.changed:
+            for row in self.changed._rows:
+                old = items[tuple([row[k] for k in ki]) if composite else row[ki]]
+                # the same list is in all indexes, only those on other
+                # columns than the key may be out of date.
+                old[:] = row
+            rowset._invalidate()
+
+        if self.removed:
+            drop = set()
+            for key in self.removed._items:
+                row = items.pop(key, None)
+                if row is not None:
+                    drop.add(id(row))
+            rowset._rows[:] = [row for row in rowset._rows if id(row) not in drop]
+            rowset._invalidate()
+
+        if self.added:
+            rows = [row[:] for row in self.added._rows]
+            rowset._rows[:0] = rows
+            for index, kind, i, c in rowset._indexes.itervalues():
+                # added to the indexes last, so these rows come first.
+                _addrows(index, kind, i, c, rows)
+        return rowset
+
+
+def diff(old, new, key=None, partial=False):
+    """
+    Compares two versions of a keyed rowset, such as the assets of a
+    character from two responses of AssetList, and returns a Delta. Rows
+    are matched by key, which defaults to the key of new (refID,
+    transactionID, itemID), using the rowsets' indexes on it.
+
+    If partial is True, new holds only the newest rows, such as the pages
+    of a journal walked up to the first row seen before, so keys missing
+    from it aren't removed. The time this takes then grows with the size of
+    new only. For example, to keep a journal up to date:
+
+      delta = diff(journal, auth.char.WalletJournal.walk(seen=journal).Merge(), partial=True)
+      delta.Apply(journal)
+    """
+    if key is None:
+        key = getattr(new, "_key", None) or getattr(old, "_key", None)
+        if key is None:
+            raise ValueError("rowsets have no key to compare by")
+    if tuple(old._cols) != tuple(new._cols):
+        raise ValueError("rowsets have different columns")
+    cols = new._cols
+    ki, composite = _keyindex(cols, key)
+    if old is new:
+        return Delta(cols, key, [], [], [])
+
+    before = old._index(key, "unique")
+    added = []
+    changed = []
+    for row in new._rows:
+        k = tuple([row[i] for i in ki]) if composite else row[ki]
+        previous = before.get(k)
+        if previous is None:
+            added.append(row)
+        elif previous != row and not _same(previous, row):
+            changed.append(row)
+
+    removed = []
+    if not partial:
+        after = new._index(key, "unique")
+        for row in old._rows:
+            if (tuple([row[i] for i in ki]) if composite else row[ki]) not in after:
+                removed.append(row)
+    return Delta(cols, key, added, removed, changed)
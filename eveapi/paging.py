@@ -0,0 +1,167 @@
+from .containers import _keyindex, Rowset
+from .workers import _WorkerPool, Future
+
+_MAXROWS = 2560  # the most rows the server returns per page
+
+
+class PageWalker(object):
+    """
+    Walks back through the pages of calls that take fromID and rowCount
+    parameters, such as char/WalletJournal and corp/WalletTransactions, as
+    returned by the walk() method of contexts. Each page is requested with
+    fromID set to the lowest key (refID, transactionID) of the one before,
+    and the walk stops at a page with fewer rows than asked for (rowCount,
+    up to the server's maximum of 2560, or the server's default).
+
+    Iterating over a PageWalker yields the Rows of all pages, newest first.
+    A PageWalker can be used once, either that way or with one of:
+
+      Pages()
+        Yields a rowset for each page.
+
+      Merge()
+        Returns a single rowset (of the same kind as the pages) with the
+        rows of all pages.
+
+    The walk also stops at the first row that meets any of the conditions
+    given to walk():
+      stopID - the row's key is stopID or lower, e.g. the highest key of
+               a previous walk.
+      since - the row is from before this datetime.
+      maxRows - this many rows have been yielded already.
+      seen - the row's key is in seen, a rowset with the rows of a previous
+             walk (or any other container of keys). See eveapi.delta.
+    Rows from later pages that were on an earlier page already are skipped.
+
+    Pages are requested like any other call, through the cache handler, so
+    walking again before the pages expire costs no requests. The next page
+    is requested in the background while the rows of the current one are
+    being used.
+
+    Attributes:
+      pages - the number of pages fetched so far.
+      cachedUntil - the earliest cachedUntil of those pages, after which
+                    walking again may return new rows.
+    """
+
+    def __init__(self, context, rowset=None, rowCount=None, stopID=None, since=None, maxRows=None, seen=None,
+                 params=None):
+        self.pages = 0
+        self.cachedUntil = None
+        self._context = context
+        self._name = rowset
+        self._rowCount = rowCount
+        self._stopID = stopID
+        self._since = since
+        self._maxRows = maxRows
+        self._seen = seen
+        self._params = params or {}
+        self._started = False
+
+    def _fetch(self, fromID):
+        kw = dict(self._params)
+        if fromID is not None:
+            kw["fromID"] = fromID
+        if self._rowCount:
+            kw["rowCount"] = min(self._rowCount, _MAXROWS)
+        result = self._context(**kw)
+        if isinstance(result, Future):
+            # asynchronous connection.
+            result = result.result()
+        return result
+
+    def _rowset(self, result):
+        if self._name is not None:
+            rowset = getattr(result, self._name, None)
+        else:
+            rowsets = [value for name, value in sorted(result.__dict__.items()) if isinstance(value, Rowset)]
+            rowset = rowsets and rowsets[0]
+        if not isinstance(rowset, Rowset):
+            raise ValueError("result has no rowset %s" % (self._name or ""))
+        return rowset
+
+    def _columns(self, rowset):
+        # positions of the key and date columns.
+        key = getattr(rowset, "_key", None)
+        if key is None:
+            raise ValueError("rowset %s has no key to walk by" % rowset._name)
+        ki, composite = _keyindex(rowset._cols, key)
+        if composite:
+            raise ValueError("rowset %s has a composite key" % rowset._name)
+        di = None
+        if self._since is not None:
+            for column in ("date", "transactionDateTime"):
+                if column in rowset._cols:
+                    di = rowset._cols.index(column)
+                    break
+            else:
+                raise ValueError("rowset %s has no date column" % rowset._name)
+        return ki, di
+
+    def Pages(self):
+        if self._started:
+            raise RuntimeError("a PageWalker can only be used once")
+        self._started = True
+
+        stopID, since, maxRows, seen = self._stopID, self._since, self._maxRows, self._seen
+        count = 0
+        fromID = None
+        # the server returns no more than _MAXROWS, however many are asked
+        # for, so a page that size is full too.
+        size = self._rowCount and min(self._rowCount, _MAXROWS)
+        workers = _WorkerPool(1)
+        try:
+            future = workers.submit(self._fetch, None)
+            while future is not None:
+                result = future.result()
+                future = None
+                self.pages += 1
+                cachedUntil = result._meta.cachedUntil
+                if self.cachedUntil is None or cachedUntil < self.cachedUntil:
+                    self.cachedUntil = cachedUntil
+
+                rowset = self._rowset(result)
+                ki, di = self._columns(rowset)
+                if isinstance(seen, Rowset):
+                    seen = seen._index(rowset._key, "unique")
+                rows = list(rowset._rows)
+                if size is None:
+                    # the server's default page size.
+                    size = len(rows)
+
+                kept = []
+                stopped = False
+                for row in rows:
+                    key = row[ki]
+                    if fromID is not None and key >= fromID:
+                        continue
+                    if ((stopID is not None and key <= stopID) or (di is not None and row[di] < since) or
+                            (maxRows is not None and count >= maxRows) or (seen is not None and key in seen)):
+                        stopped = True
+                        break
+                    kept.append(row)
+                    count += 1
+
+                if maxRows is not None and count >= maxRows:
+                    # no need to look at the next page to know that.
+                    stopped = True
+                if rows and not stopped and len(rows) >= size:
+                    fromID = min(row[ki] for row in rows)
+                    future = workers.submit(self._fetch, fromID)
+                yield rowset if len(kept) == len(rows) else rowset._derive(kept)
+        finally:
+            workers.shutdown()
+
+    def __iter__(self):
+        for page in self.Pages():
+            for row in page:
+                yield row
+
+    def Merge(self):
+        merged = None
+        for page in self.Pages():
+            if merged is None:
+                # not the page itself, which may be shared with the cache.
+                merged = page._derive([])
+            merged += page
+        return merged
@@ -1,17 +1,37 @@
+from cStringIO import StringIO
 from datetime import datetime
+from itertools import izip
 from xml.parsers import expat
 
+from .binary import _ispacked, loads
 from .containers import (
+    _Columns,
     Element,
     IndexRowset,
+    Query,
+    Row,
     Rowset,
 )
+from .columnar import _ColumnStore
 from .exceptions import (
     AuthenticationError,
     Error,
     RequestError,
     ServerError,
 )
+from .query import _bind, _where
+from .transport import _GZIP_MAGIC, _Decompressor
+
+
+def _parsedate(value):
+    # same as datetime.strptime(value, "%Y-%m-%d %H:%M:%S"), at a fraction
+    # of the cost. raises ValueError if value isn't a date of that format.
+    if (len(value) == 19 and value[4] == "-" and value[7] == "-" and value[10] == " " and
+            value[13] == ":" and value[16] == ":" and
+            (value[:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:]).isdigit()):
+        return datetime(int(value[:4]), int(value[5:7]), int(value[8:10]),
+                        int(value[11:13]), int(value[14:16]), int(value[17:]))
+    raise ValueError("invalid date: %r" % value)
 
 
 def _autocast(key, value):
@@ -30,9 +50,7 @@ def _autocast(key, value):
     if len(value) == 19 and value[10] == ' ':
         # it could be a date string
         try:
-            return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
-        except OverflowError:
-            pass
+            return _parsedate(value)
         except ValueError:
             pass
 
@@ -40,24 +58,327 @@ def _autocast(key, value):
     return value
 
 _castfunc = _autocast
+_lazycast = False
+_columnar = False
+
+
+# Rows are not cast value by value with _autocast, which has to try every
+# type in turn. Instead each column of a rowset gets a converter, decided
+# once per rowset: from _columntypes if the column is listed there, or
+# from the values in the first rows otherwise. The converters fall back to
+# _autocast for values that don't fit the column's type. Empty values are
+# left alone, like _autocast does.
+
+def _castint(key, value):
+    if value.isdigit() or (value[:1] == "-" and value[1:].isdigit()):
+        return int(value)
+    return value and _autocast(key, value)
+
+
+def _castfloat(key, value):
+    if not value:
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        return _autocast(key, value)
+
+
+def _castdate(key, value):
+    if len(value) == 19:
+        try:
+            return _parsedate(value)
+        except ValueError:
+            pass
+    return value and _autocast(key, value)
+
+
+def _caststr(key, value):
+    return value
+
 
+_numeric = frozenset("0123456789-+. \t\r\n")
 
-def ParseXML(file_or_string):
+
+def _castguess(key, value):
+    # for columns that looked like text. only values that could be numbers
+    # are passed on to _autocast.
+    if value[:1] in _numeric:
+        return _autocast(key, value)
+    return value
+
+_casts = {
+    int: _castint,
+    float: _castfloat,
+    datetime: _castdate,
+    str: _caststr,
+}
+
+_columntypes = {}
+for _type, _columns in (
+    (int, "accountID accountKey allianceID argID1 assigneeID acceptorID characterID clientID contractID corporationID"
+          " endStationID executorCorpID factionID flag groupID issuerCorpID issuerID itemID journalTransactionID keyID"
+          " level locationID memberCount minVolume orderID orderState ownerID ownerID1 ownerID2 quantity rawQuantity"
+          " refID refTypeID singleton skillpoints solarSystemID startStationID stationID taxReceiverID transactionID"
+          " typeID volEntered volRemaining"),
+    (float, "amount balance buyout collateral escrow price reward taxAmount volume"),
+    (datetime, "date dateAccepted dateCompleted dateExpired dateIssued endTime issued logoffDateTime logonDateTime"
+               " startDateTime startTime transactionDateTime"),
+    (str, "allianceName characterName clientName corporationName name ownerName1 ownerName2 shortName stationName"
+          " ticker transactionFor transactionType typeName"),
+):
+    for _column in _columns.split():
+        _columntypes[_column] = _casts[_type]
+del _type, _columns, _column
+
+_INFER_ROWS = 16  # number of rows to look at to infer column types
+
+
+def _infercast(key, value):
+    # picks the converter for a column of which value is the first
+    # non-empty value.
+    value = _autocast(key, value)
+    if type(value) is int:
+        return _castint
+    if type(value) is float:
+        # no _castfloat here, _autocast turns integral values into ints.
+        return _autocast
+    if type(value) is datetime:
+        return _castdate
+    return _castguess
+
+
+class _CastPlan(object):
+    # the converters for a rowset's columns, in the order of the attributes
+    # of its rows (names). If func is given, it is used for every column.
+
+    def __init__(self, names, func=None):
+        self.names = names
+        if func is None:
+            self.casts = [_columntypes.get(name) for name in names]
+        else:
+            self.casts = [func] * len(names)
+        self.pending = self.casts.count(None)
+        self.rows = _INFER_ROWS
+
+    def learn(self, values):
+        # infers the converters of columns that haven't had a value yet.
+        casts = self.casts
+        for i, cast in enumerate(casts):
+            if cast is None and values[i]:
+                casts[i] = _infercast(self.names[i], values[i])
+                self.pending -= 1
+        self.rows -= 1
+        if self.pending and not self.rows:
+            # columns that are still empty get no special treatment.
+            casts[:] = [cast or _castguess for cast in casts]
+            self.pending = 0
+
+    def cast(self, values):
+        if self.pending:
+            self.learn(values)
+            return [(cast or _autocast)(key, value) for cast, key, value in izip(self.casts, self.names, values)]
+        return [cast(key, value) for cast, key, value in izip(self.casts, self.names, values)]
+
+    def cast1(self, i, value):
+        return (self.casts[i] or _autocast)(self.names[i], value)
+
+
+_uncast = object()
+_getitem = list.__getitem__
+_setitem = list.__setitem__
+
+
+def _materialized(op):
+    def method(self, *args):
+        return op(self._cast(), *[arg._cast() if type(arg) is _LazyRow else arg for arg in args])
+    return method
+
+
+class _LazyRow(list):
+    # row data that is cast value by value, the first time each value is
+    # read. Until then the list holds _uncast and _raw the XML string. This
+    # makes no difference to anyone reading the row, only to those looking
+    # at the list's storage directly: C code such as cmp() on lists. Hence
+    # the overrides here.
+
+    __slots__ = ("_plan", "_raw")
+
+    def __init__(self, plan, raw):
+        list.__init__(self, [_uncast] * len(raw))
+        self._plan = plan
+        self._raw = raw
+
+    def __getitem__(self, i):
+        value = _getitem(self, i)
+        if value is _uncast:
+            if i < 0:
+                i += len(self)
+            # concurrent readers may both get here, but will store the same.
+            value = self._plan.cast1(i, self._raw[i])
+            _setitem(self, i, value)
+        elif type(i) is slice:
+            return _getitem(self._cast(), i)
+        return value
+
+    def __getslice__(self, i, j):
+        return list.__getslice__(self._cast(), i, j)
+
+    def _cast(self):
+        # casts all values still pending and returns self.
+        for i, value in enumerate(list.__iter__(self)):
+            if value is _uncast:
+                _setitem(self, i, self._plan.cast1(i, self._raw[i]))
+        return self
+
+    __iter__ = _materialized(list.__iter__)
+    __reversed__ = _materialized(list.__reversed__)
+    __contains__ = _materialized(list.__contains__)
+    __repr__ = _materialized(list.__repr__)
+    __add__ = _materialized(list.__add__)
+    __mul__ = __rmul__ = _materialized(list.__mul__)
+    __eq__ = _materialized(list.__eq__)
+    __ne__ = _materialized(list.__ne__)
+    __lt__ = _materialized(list.__lt__)
+    __le__ = _materialized(list.__le__)
+    __gt__ = _materialized(list.__gt__)
+    __ge__ = _materialized(list.__ge__)
+    count = _materialized(list.count)
+    index = _materialized(list.index)
+    pop = _materialized(list.pop)
+
+    def __reduce__(self):
+        # pickles and copies as a plain list.
+        return list, (list(self),)
+
+
+def ParseXML(file_or_string, stream=None, where=None):
+    # if stream is the name of a rowset, returns a RowStream over the rows
+    # of that rowset instead of the parsed result.
+    # where may map rowset names to the conditions their rows must meet,
+    # as accepted by Rowset.Where(): a list of (column, operator, value)
+    # tuples, or a dict of column: value. Other rows are skipped while
+    # parsing, and never cast or stored.
+    where = _where(where)
+    if stream is not None:
+        if not (isinstance(file_or_string, basestring) or hasattr(file_or_string, "read")):
+            raise TypeError("XML data must be provided as string or file-like object")
+        return RowStream(file_or_string, stream, where=where)
     try:
-        return _ParseXML(file_or_string, False, None)
+        return _ParseXML(file_or_string, False, None, where)
     except TypeError:
         raise TypeError("XML data must be provided as string or file-like object")
 
 
-def _ParseXML(response, fromContext, storeFunc):
+class RowStream(object):
+    """
+    Iterates over the rows of a single rowset as they are parsed, rather
+    than collecting them all in the result first. Rows are not kept once
+    they have been yielded, so memory use doesn't depend on their number.
+
+    The rest of the document is parsed as usual. Once all rows have been
+    read, it is available as the result attribute (the streamed rowset in
+    it is empty, unless the result came from a cache handler as an object).
+    Any API error in the document is raised at that point.
+    """
+
+    def __init__(self, response, rowset, fromContext=False, pooled=None, where=None):
+        self.rowset = rowset
+        self.result = None
+        self._rows = self._iterate(response, fromContext, pooled, where)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self._rows.next()
+
+    def _iterate(self, response, fromContext, pooled, where):
+        try:
+            if (fromContext and isinstance(response, Element)) or _ispacked(response):
+                # already parsed (cached) result.
+                self.result = _ParseXML(response, True, None, where)
+                rowset = getattr(self.result, self.rowset, None)
+                if isinstance(rowset, Rowset):
+                    for row in rowset:
+                        yield row
+                return
+
+            if isinstance(response, unicode):
+                response = response.encode("utf-8")
+            if isinstance(response, str):
+                if response[:2] == _GZIP_MAGIC:
+                    response = _Decompressor(StringIO(response))
+                else:
+                    response = StringIO(response)
+
+            parser = _Parser(where)
+            for row in parser.Stream(response, self.rowset):
+                yield row
+            self.result = _ParseXML(parser.root, True, None)
+        finally:
+            if pooled is not None:
+                pooled.close()
+
+
+def _matching(rowset, conditions):
+    # the rows of rowset that meet the conditions, which is decided the same
+    # way as while parsing: columns a row doesn't have are None.
+    cols = rowset._cols
+    if all(column in cols for column, func, value in conditions):
+        try:
+            # may use the rowset's indexes.
+            return Query(rowset, conditions)._rows()
+        except IndexError:
+            # rows of different lengths.
+            pass
+    tests = _bind(conditions, cols)
+    rows = []
+    for row in rowset._rows:
+        for i, func, value in tests:
+            if not func(row[i] if i is not None and i < len(row) else None, value):
+                break
+        else:
+            rows.append(row)
+    return rows
+
+
+def _filtered(element, where):
+    # a copy of a parsed (cached) element, leaving out the rows of rowsets
+    # in where that don't meet their conditions. Elements and rowsets in
+    # rows are left as they are, as are those behind underscored names
+    # (such as _meta, which refers back up the tree).
+    copy = Element()
+    for name, value in element.__dict__.iteritems():
+        if name[:1] != "_":
+            if isinstance(value, Rowset) and getattr(value, "_name", None) in where:
+                rowset = value._derive(_matching(value, where[value._name]))
+                rowset._name = value._name
+                value = rowset
+            elif isinstance(value, Element):
+                value = _filtered(value, where)
+        copy.__dict__[name] = value
+    return copy
+
+
+def _ParseXML(response, fromContext, storeFunc, where=None):
     # pre/post-process XML or Element data
 
-    if fromContext and isinstance(response, Element):
-        obj = response
+    if _ispacked(response):
+        # see eveapi.binary. results are stored with their document.
+        obj = loads(response)
+        obj = obj.__dict__.get("_meta", obj)
+        if where:
+            obj = _filtered(obj, where)
+    elif fromContext and isinstance(response, Element):
+        obj = _filtered(response, where) if where else response
+    elif type(response) is str and response[:2] == _GZIP_MAGIC:
+        # gzip compressed document, as stored by some cache handlers.
+        obj = _Parser(where).Parse(_Decompressor(StringIO(response)), True)
     elif type(response) in (str, unicode):
-        obj = _Parser().Parse(response, False)
+        obj = _Parser(where).Parse(response, False)
     elif hasattr(response, "read"):
-        obj = _Parser().Parse(response, True)
+        obj = _Parser(where).Parse(response, True)
     else:
         raise TypeError("retrieve method must return None, string, file-like object or an Element instance")
 
@@ -88,9 +409,27 @@ def _ParseXML(response, fromContext, storeFunc):
 
 class _Parser(object):
 
-    def Parse(self, data, isStream=False):
+    _stream = None
+
+    def __init__(self, where=None):
+        # conditions per rowset name for the rows to keep, see _where().
+        self._where = where
+
+    def _create(self):
         self.container = self.root = None
         self._cdata = False
+        # cast plans per rowset. a custom cast function set with
+        # set_cast_func() replaces the plans' converters.
+        self._plans = {}
+        self._castfunc = None if _castfunc is _autocast else _castfunc
+        # columnar rowsets store values by type, so can't cast lazily.
+        self._columnar = _columnar
+        self._lazy = _lazycast and not _columnar
+        # depth within a row that didn't meet the conditions, and the
+        # conditions bound to column positions per cast plan (or per rowset
+        # and columns, for rows missing attributes).
+        self._skip = 0
+        self._tests = {}
         p = expat.ParserCreate()
         p.StartElementHandler = self.tag_start
         p.CharacterDataHandler = self.tag_cdata
@@ -99,13 +438,41 @@ class _Parser(object):
         p.EndElementHandler = self.tag_end
         p.ordered_attributes = True
         p.buffer_text = True
+        return p
 
+    def Parse(self, data, isStream=False):
+        p = self._create()
         if isStream:
-            p.ParseFile(data)
+            # feed the parser as data comes in, so parsing overlaps with the
+            # transfer and the document never has to be held in memory.
+            read = data.read
+            while True:
+                chunk = read(16384)
+                if not chunk:
+                    break
+                p.Parse(chunk, False)
+            p.Parse("", True)
         else:
             p.Parse(data, True)
         return self.root
 
+    def Stream(self, data, rowset):
+        # generator yielding the rows of rowsets with the given name as soon
+        # as they are complete, instead of adding them to the rowset.
+        p = self._create()
+        self._stream = rowset
+        self._streamed = []
+        read = data.read
+        while True:
+            chunk = read(16384)
+            p.Parse(chunk, not chunk)
+            if self._streamed:
+                rows, self._streamed = self._streamed, []
+                for row in rows:
+                    yield row
+            if not chunk:
+                return
+
     def tag_cdatasection_enter(self):
         # encountered an explicit CDATA tag.
         self._cdata = True
@@ -119,7 +486,23 @@ class _Parser(object):
         else:
             self._cdata = False
 
+    def _match(self, key, names, conditions, value):
+        # whether a row meets the conditions. value(i) returns the row's
+        # i-th value, cast.
+        tests = self._tests.get(key)
+        if tests is None:
+            tests = self._tests[key] = _bind(conditions, names)
+        for i, func, operand in tests:
+            if not func(None if i is None else value(i), operand):
+                return False
+        return True
+
     def tag_start(self, name, attributes):
+        if self._skip:
+            # inside a row that's being left out.
+            self._skip += 1
+            return
+
         # <hack>
         # If there's a colon in the tag name, cut off the name from the colon
         # onward. This is a workaround to make certain bugged XML responses
@@ -137,11 +520,12 @@ class _Parser(object):
                 # columns will be extracted from first row instead.
                 columns = []
 
+            rows = _ColumnStore() if self._columnar else None
             try:
                 priKey = attributes[attributes.index('key') + 1]
-                this = IndexRowset(cols=columns, key=priKey)
+                this = IndexRowset(cols=columns, rows=rows, key=priKey)
             except ValueError:
-                this = Rowset(cols=columns)
+                this = Rowset(cols=columns, rows=rows)
 
             this._name = attributes[attributes.index('name') + 1]
             this.__catch = "row"  # tag to auto-add to rowset.
@@ -170,6 +554,13 @@ class _Parser(object):
             #   such as rawQuantity in the assets lists.
             # In either case the tag is assumed to be correct and the rowset's
             # columns are overwritten with the tag's version, if required.
+            if self.container._name == self._stream:
+                # streamed rows are handed out when complete, so they must not
+                # end up in the rowset's index.
+                append = self.container._rows.append
+            else:
+                append = self.container.append
+            conditions = self._where and self._where.get(self.container._name)
             numAttr = len(attributes) / 2
             numCols = len(self.container._cols)
             if numAttr < numCols and (attributes[-2] == self.container._cols[-1]):
@@ -187,12 +578,32 @@ class _Parser(object):
                     else:
                         fixed.append(None)
                     hdr_idx += 1
-                self.container.append(fixed)
+                cols = self.container._cols
+                if conditions and not self._match((self.container, cols), cols, conditions, fixed.__getitem__):
+                    self._skip = 1
+                    return
+                append(fixed)
             else:
                 if not self.container._cols or (numAttr > numCols):
                     # the row data contains more attributes than were defined.
-                    self.container._cols = attributes[0::2]
-                self.container.append([_castfunc(attributes[i], attributes[i + 1]) for i in xrange(0, len(attributes), 2)])
+                    self.container._cols = _Columns(attributes[0::2])
+                names = attributes[0::2]
+                plan = self._plans.get(self.container)
+                if plan is None or plan.names != names:
+                    plan = self._plans[self.container] = _CastPlan(names, self._castfunc)
+                if conditions:
+                    # only the values in the conditions' columns are cast
+                    # to decide, the rest once the row is known to be kept.
+                    raw = attributes[1::2]
+                    if not self._match(plan, names, conditions, lambda i: plan.cast1(i, raw[i])):
+                        self._skip = 1
+                        return
+                if self._lazy:
+                    if plan.pending:
+                        plan.learn(attributes[1::2])
+                    append(_LazyRow(plan, attributes[1::2]))
+                else:
+                    append(plan.cast(attributes[1::2]))
             # </hack>
 
             this._isrow = True
@@ -206,6 +617,9 @@ class _Parser(object):
         self.has_cdata = False
 
     def tag_cdata(self, data):
+        if self._skip:
+            self._cdata = False
+            return
         self.has_cdata = True
         if self._cdata:
             # unset cdata flag to indicate it's been handled.
@@ -224,7 +638,7 @@ class _Parser(object):
             _row = parent._rows[-1]
             _row.append(data)
             if len(parent._cols) < len(_row):
-                parent._cols.append("data")
+                parent._cols += ("data",)
 
         elif this._attributes:
             # this tag has attributes, so we can't simply assign the cdata
@@ -239,6 +653,9 @@ class _Parser(object):
             setattr(this.__parent, this._name, data)
 
     def tag_end(self, name):
+        if self._skip:
+            self._skip -= 1
+            return
         this = self.container
 
         if this is self.root:
@@ -254,6 +671,10 @@ class _Parser(object):
         attributes2 = this.__dict__.pop("_attributes2")
         if attributes is None:
             # already processed this tag's closure early, in tag_start()
+            if self.container._name == self._stream:
+                # the row is complete, hand it out instead of keeping it.
+                rowset = self.container
+                self._streamed.append(Row(rowset._cols, rowset._rows.pop()))
             return
 
         if self.container._isrow:
@@ -269,7 +690,7 @@ class _Parser(object):
 
             # fix columns if neccessary.
             if len(parent._cols) < len(_row):
-                parent._cols.append(this._name)
+                parent._cols += (this._name,)
         else:
             # see if there's already an attribute with this name (this shouldn't
             # really happen, but it doesn't hurt to handle this case!
@@ -303,11 +724,13 @@ class _Parser(object):
                 # into a Rowset, adding the sibling element and this one.
                 rs = Rowset()
                 rs.__catch = rs._name = this._name
-                row = [_castfunc(attributes[i], attributes[i+1]) for i in xrange(0, len(attributes), 2)]+[getattr(this, col) for col in attributes2]
+                row = [_castfunc(attributes[i], attributes[i+1]) for i in xrange(0, len(attributes), 2)]
+                row += [getattr(this, col) for col in attributes2]
                 rs.append(row)
-                row = [getattr(sibling, attributes[i]) for i in xrange(0, len(attributes), 2)]+[getattr(sibling, col) for col in attributes2]
+                row = [getattr(sibling, attributes[i]) for i in xrange(0, len(attributes), 2)]
+                row += [getattr(sibling, col) for col in attributes2]
                 rs.append(row)
-                rs._cols = [attributes[i] for i in xrange(0, len(attributes), 2)]+[col for col in attributes2]
+                rs._cols = _Columns([attributes[i] for i in xrange(0, len(attributes), 2)]+[col for col in attributes2])
                 setattr(self.container, this._name, rs)
             else:
                 # something else must have set this attribute already.
@@ -0,0 +1,68 @@
+import operator
+
+
+def _isin(value, values):
+    return value in values
+
+
+def _notin(value, values):
+    return value not in values
+
+_operators = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": _isin,
+    "not in": _notin,
+}
+
+
+def _conditions(conditions, equalities):
+    # turns the arguments of Where() into a list of (column, func, value)
+    # tuples. conditions are (column, operator, value) tuples, equalities
+    # a dict of column: value.
+    result = []
+    for condition in conditions:
+        try:
+            column, op, value = condition
+        except (TypeError, ValueError):
+            raise ValueError("conditions must be (column, operator, value) tuples, not %r" % (condition,))
+        try:
+            func = _operators[op]
+        except (KeyError, TypeError):
+            raise ValueError("unknown operator %r" % (op,))
+        if func is _isin or func is _notin:
+            try:
+                value = frozenset(value)
+            except TypeError:
+                value = list(value)
+        result.append((column, func, value))
+    for column, value in sorted(equalities.iteritems()):
+        result.append((column, operator.eq, value))
+    return result
+
+
+def _where(where):
+    # the conditions per rowset name for the parser, from a dict mapping
+    # rowset names to a list of conditions or a dict of equalities.
+    if not where:
+        return None
+    result = {}
+    for name, conditions in where.iteritems():
+        if isinstance(conditions, dict):
+            result[name] = _conditions((), conditions)
+        else:
+            result[name] = _conditions(conditions, {})
+    return result
+
+
+def _bind(conditions, names):
+    # (position, func, value) tests for rows with the given column names.
+    # position is None for columns that aren't there, their value is None.
+    positions = {}
+    for i, name in enumerate(names):
+        positions.setdefault(name, i)
+    return [(positions.get(column), func, value) for column, func, value in conditions]
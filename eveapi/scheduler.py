@@ -0,0 +1,228 @@
+import threading
+import time
+from collections import deque
+
+from .workers import Future
+
+INTERACTIVE = 0
+BULK = 1
+
+_local = threading.local()
+
+
+def _priority():
+    # the priority of requests made on this thread, see _prioritized().
+    return getattr(_local, "priority", INTERACTIVE)
+
+
+def _prioritized(priority, func, *args):
+    # calls func with the requests it makes on this thread queued at the
+    # given priority.
+    previous = _priority()
+    _local.priority = priority
+    try:
+        return func(*args)
+    finally:
+        _local.priority = previous
+
+
+class _TokenBucket(object):
+    # Allows rate requests per second on average, and bursts of up to burst
+    # requests after a quiet spell.
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst or rate))
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self):
+        # seconds until there's a token, as of the last refill.
+        return max(0.0, (1.0 - self.tokens) / self.rate)
+
+
+class _Waiter(object):
+    __slots__ = ("key", "granted", "future")
+
+    def __init__(self, key, future=None):
+        self.key = key
+        self.granted = False
+        self.future = future
+
+
+class _Scheduler(object):
+    # Decides when requests may be sent to the server, keeping to a limit on
+    # the rate of requests to the host and one on the rate of requests per
+    # API key (keyID). Requests that have to wait are sent in order of
+    # priority (lower first), and in turn by key within a priority: a key
+    # with many requests queued doesn't hold up the others. A request of a
+    # lower priority goes ahead if those of higher ones are all held back by
+    # the limits of their keys.
+    #
+    # Threads wait in acquire(). Callers that mustn't block, such as the
+    # event loop of the asynchronous client, get a Future from submit()
+    # instead, which a timer thread resolves when the limits allow.
+
+    def __init__(self, rate=0, keyRate=0, burst=None, keyBurst=None):
+        self._host = _TokenBucket(rate, burst) if rate else None
+        self._keyRate = keyRate
+        self._keyBurst = keyBurst
+        self._buckets = {}
+        # priority: (deque of keys in turn, {key: deque of waiters})
+        self._waiting = {}
+        self._futures = 0  # waiters with a future
+        self._timer = None
+        # reentrant, futures are resolved (and their callbacks called) with
+        # the lock held.
+        self._cond = threading.Condition(threading.RLock())
+
+    def _bucket(self, key, now):
+        if not self._keyRate or key is None:
+            return None
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _TokenBucket(self._keyRate, self._keyBurst)
+        else:
+            bucket.refill(now)
+        return bucket
+
+    def _prune(self, now):
+        # forgets keys whose buckets are full again, which are no different
+        # from new ones.
+        for key, bucket in self._buckets.items():
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._buckets[key]
+
+    def _next(self, now):
+        # takes the waiter to let through next, if there is one the limits
+        # allow. returns (waiter, seconds until one may be let through).
+        delay = None
+        for priority in sorted(self._waiting):
+            keys, waiters = self._waiting[priority]
+            for i in xrange(len(keys)):
+                key = keys[0]
+                bucket = self._bucket(key, now)
+                if bucket is None or bucket.tokens >= 1:
+                    queue = waiters[key]
+                    waiter = queue.popleft()
+                    keys.popleft()
+                    if queue:
+                        # back of the line for this key's next request.
+                        keys.append(key)
+                    else:
+                        del waiters[key]
+                        if not keys:
+                            del self._waiting[priority]
+                    if bucket is not None:
+                        bucket.tokens -= 1
+                    return waiter, None
+                keys.rotate(-1)
+                wait = bucket.delay()
+                if delay is None or wait < delay:
+                    delay = wait
+        return None, delay
+
+    def _dispatch(self):
+        # lets through as many waiters as the limits allow. returns the
+        # seconds until more may be let through, or None.
+        now = time.time()
+        host = self._host
+        if host is not None:
+            host.refill(now)
+        granted = False
+        delay = None
+        while self._waiting:
+            if host is not None and host.tokens < 1:
+                delay = host.delay()
+                break
+            waiter, delay = self._next(now)
+            if waiter is None:
+                break
+            waiter.granted = granted = True
+            if host is not None:
+                host.tokens -= 1
+            if waiter.future is not None:
+                self._futures -= 1
+                waiter.future.set_result(None)
+        if granted:
+            self._cond.notify_all()
+        if len(self._buckets) > 1000:
+            self._prune(now)
+        if self._futures and delay is not None and self._timer is None:
+            # no thread is waiting for those, so one is started to.
+            self._timer = threading.Timer(delay, self._wake)
+            self._timer.daemon = True
+            self._timer.start()
+        return delay
+
+    def _wake(self):
+        self._cond.acquire()
+        try:
+            self._timer = None
+            self._dispatch()
+        finally:
+            self._cond.release()
+
+    def _enqueue(self, waiter, priority):
+        if priority not in self._waiting:
+            self._waiting[priority] = (deque(), {})
+        keys, waiters = self._waiting[priority]
+        if waiter.key in waiters:
+            waiters[waiter.key].append(waiter)
+        else:
+            waiters[waiter.key] = deque((waiter,))
+            keys.append(waiter.key)
+
+    def submit(self, key=None, priority=INTERACTIVE):
+        # same as acquire(), except that it returns a Future that is
+        # resolved once the request may be sent, rather than blocking.
+        waiter = _Waiter(key, Future())
+        self._cond.acquire()
+        try:
+            self._futures += 1
+            self._enqueue(waiter, priority)
+            self._dispatch()
+        finally:
+            self._cond.release()
+        return waiter.future
+
+    def acquire(self, key=None, priority=INTERACTIVE):
+        # blocks until a request for the given API key may be sent.
+        waiter = _Waiter(key)
+        self._cond.acquire()
+        try:
+            self._enqueue(waiter, priority)
+            while True:
+                delay = self._dispatch()
+                if waiter.granted:
+                    return
+                # woken up when others are let through, or once there may
+                # be tokens for the next.
+                self._cond.wait(delay)
+                if waiter.granted:
+                    return
+        except BaseException:
+            # interrupted while waiting, leave the line.
+            self._leave(waiter, priority)
+            raise
+        finally:
+            self._cond.release()
+
+    def _leave(self, waiter, priority):
+        if waiter.granted or priority not in self._waiting:
+            return
+        keys, waiters = self._waiting[priority]
+        queue = waiters.get(waiter.key)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del waiters[waiter.key]
+                keys.remove(waiter.key)
+                if not keys:
+                    del self._waiting[priority]
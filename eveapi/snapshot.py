@@ -0,0 +1,440 @@
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from datetime import datetime, timedelta
+from itertools import izip
+
+from .binary import _EPOCH, _int64, _Reader, _micros, _pack, _uint
+from .containers import _columns, _keyindex, IndexRowset, Rowset
+
+_MAGIC = "\x00EVS"
+_VERSION = 1
+_CHUNK = 1024  # rows read at a time when iterating
+_INF = float("inf")
+
+_header = struct.Struct("<4sB3xI")  # magic, version, header size
+
+
+# Snapshot files start with a header describing the rowset and where its
+# parts are, encoded with eveapi.binary. Then come the parts, each at an
+# offset that's a multiple of 8:
+#   - a segment per column: an int64, float64 or int64 (dates, in
+#     microseconds since the epoch) for each row if all values in the
+#     column are of that type. Otherwise a uint32 code for each row, the
+#     number of a value in the column's table: uint32 offsets into a blob
+#     of eveapi.binary encoded values, one more than there are values.
+#   - the number of values in each row as uint16, if they differ.
+#   - an open addressing hash table of uint32 row numbers + 1 (0 is an
+#     empty slot) for the key, if the rowset has one. The slot to start
+#     at is the crc32 of the key's _hashkey(), linear probing from there.
+
+def _normalized(key):
+    if type(key) is str:
+        try:
+            return key.decode("ascii")
+        except UnicodeDecodeError:
+            pass
+    elif type(key) is long or (type(key) is float and key == key and abs(key) != _INF and key == int(key)):
+        # not inf and nan, which have no int.
+        return int(key)
+    return key
+
+
+def _hashkey(key):
+    # keys that are equal in Python have the same hash here, e.g. u"a" and
+    # "a", 1 and 1.0.
+    if type(key) is tuple:
+        key = tuple(map(_normalized, key))
+    else:
+        key = _normalized(key)
+    # the same as _pack() for the most common keys, only faster.
+    if type(key) is int:
+        data = "i" + _int64.pack(key)
+    elif type(key) is unicode:
+        data = key.encode("utf-8")
+        data = "u" + _uint.pack(len(data)) + data
+    else:
+        data = _pack(key)
+    return zlib.crc32(data) & 0xffffffff
+
+
+def _kind(values):
+    # the segment type for a column.
+    types = set(map(type, values))
+    if types == set([int]):
+        return "q"
+    if types == set([float]):
+        return "d"
+    if types == set([datetime]) and all(value.tzinfo is None for value in values):
+        return "t"
+    return "v"
+
+
+def save(rowset, filename):
+    """
+    Writes a Rowset or IndexRowset to a file that can be opened with load().
+    The file is written under another name first and then renamed, so
+    processes loading it never see it half written.
+    """
+    rows = list(rowset._rows)
+    count = len(rows)
+    widths = map(len, rows)
+    width = max(widths) if rows else len(rowset._cols)
+    ragged = widths.count(width) != count
+    if ragged:
+        rows = [row if len(row) == width else list(row) + [None] * (width - len(row)) for row in rows]
+    columns = zip(*rows) if rows else [()] * width
+
+    parts = []
+    size = [0]
+
+    def add(data):
+        offset = size[0]
+        parts.append(data)
+        parts.append("\0" * (-len(data) % 8))
+        size[0] += len(data) + (-len(data) % 8)
+        return offset
+
+    segments = []
+    for values in columns:
+        kind = _kind(values)
+        if kind == "q":
+            segments.append((kind, add(struct.pack("<%dq" % count, *values))))
+        elif kind == "d":
+            segments.append((kind, add(struct.pack("<%dd" % count, *values))))
+        elif kind == "t":
+            segments.append((kind, add(struct.pack("<%dq" % count, *map(_micros, values)))))
+        else:
+            codes = {}
+            table = []
+            numbers = []
+            for value in values:
+                try:
+                    number = codes.get((type(value), value))
+                except TypeError:
+                    number = None
+                    key = None
+                else:
+                    key = (type(value), value)
+                if number is None:
+                    number = len(table)
+                    table.append(_pack(value))
+                    if key is not None:
+                        codes[key] = number
+                numbers.append(number)
+            offsets = [0]
+            for data in table:
+                offsets.append(offsets[-1] + len(data))
+            codes = add(struct.pack("<%dI" % count, *numbers))
+            segments.append((kind, codes, add(struct.pack("<%dI" % len(offsets), *offsets)), add("".join(table))))
+
+    widthsOffset = add(struct.pack("<%dH" % count, *widths)) if ragged else None
+
+    key = getattr(rowset, "_key", None) if isinstance(rowset, IndexRowset) else None
+    index = None
+    if key is not None:
+        ki, composite = _keyindex(rowset._cols, key)
+        positions = {}
+        for i, row in enumerate(rows):
+            positions[tuple([row[k] for k in ki]) if composite else row[ki]] = i
+        slots = 8
+        while slots < 2 * len(positions):
+            slots *= 2
+        table = [0] * slots
+        for k, i in positions.iteritems():
+            slot = _hashkey(k) & (slots - 1)
+            while table[slot]:
+                slot = (slot + 1) & (slots - 1)
+            table[slot] = i + 1
+        index = (add(struct.pack("<%dI" % slots, *table)), slots, len(positions))
+
+    header = _pack({
+        "cols": tuple(rowset._cols),
+        "key": key,
+        "name": rowset.__dict__.get("_name"),
+        "count": count,
+        "width": width,
+        "columns": segments,
+        "widths": widthsOffset,
+        "index": index,
+    })
+    start = _header.size + len(header)
+    start += -start % 8
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp = tempfile.mkstemp(dir=directory, prefix=".snapshot")
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            f.write(_header.pack(_MAGIC, _VERSION, len(header)))
+            f.write(header)
+            f.write("\0" * (start - _header.size - len(header)))
+            for data in parts:
+                f.write(data)
+        finally:
+            f.close()
+        if os.name == "nt" and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(temp, filename)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+class _MappedColumn(object):
+    # the values of a column of int64, float64 or dates.
+
+    def __init__(self, data, offset, count, kind):
+        self._data = data
+        self._offset = offset
+        self._count = count
+        self._format = "<q" if kind == "t" else "<" + kind
+        self._unpack = struct.Struct(self._format).unpack_from
+        self._dates = kind == "t"
+        self._cache = {}  # dates: microseconds to datetime
+
+    def _date(self, micros):
+        value = self._cache.get(micros)
+        if value is None:
+            value = self._cache[micros] = _EPOCH + timedelta(microseconds=micros)
+        return value
+
+    def __getitem__(self, i):
+        value = self._unpack(self._data, self._offset + 8 * i)[0]
+        return self._date(value) if self._dates else value
+
+    def slice(self, start, stop):
+        values = struct.unpack_from("<%d%s" % (stop - start, self._format[1]), self._data, self._offset + 8 * start)
+        if self._dates:
+            return map(self._date, values)
+        return list(values)
+
+    def __iter__(self):
+        for start in xrange(0, self._count, _CHUNK):
+            for value in self.slice(start, min(start + _CHUNK, self._count)):
+                yield value
+
+
+class _MappedTable(_MappedColumn):
+    # the values of any other column, decoded when first read.
+
+    def __init__(self, data, codes, offsets, values, count):
+        self._data = data
+        self._offset = codes
+        self._offsets = offsets
+        self._values = values
+        self._count = count
+        self._cache = {}  # code: value
+
+    def _value(self, code):
+        try:
+            return self._cache[code]
+        except KeyError:
+            start = self._values + _uint.unpack_from(self._data, self._offsets + 4 * code)[0]
+            value = self._cache[code] = _Reader(self._data, start).value()
+            return value
+
+    def __getitem__(self, i):
+        return self._value(_uint.unpack_from(self._data, self._offset + 4 * i)[0])
+
+    def slice(self, start, stop):
+        return map(self._value, struct.unpack_from("<%dI" % (stop - start), self._data, self._offset + 4 * start))
+
+
+class _MappedRows(object):
+    # Stands in for the list of rows (Rowset._rows) of a snapshot. Rows are
+    # built from the mapping when they're read, and can't be changed.
+
+    def __init__(self, data, base, header):
+        self._count = count = header["count"]
+        self._width = header["width"]
+        columns = []
+        for segment in header["columns"]:
+            if segment[0] == "v":
+                columns.append(_MappedTable(data, base + segment[1], base + segment[2], base + segment[3], count))
+            else:
+                columns.append(_MappedColumn(data, base + segment[1], count, segment[0]))
+        self._columns = columns
+        self._widths = None
+        if header["widths"] is not None:
+            self._widths = struct.unpack_from("<%dH" % count, data, base + header["widths"])
+
+    def __len__(self):
+        return self._count
+
+    def _row(self, i):
+        row = [column[i] for column in self._columns]
+        if self._widths is not None and self._widths[i] != self._width:
+            del row[self._widths[i]:]
+        return row
+
+    def _slice(self, start, stop):
+        if not self._columns:
+            return [[] for i in xrange(start, stop)]
+        rows = map(list, izip(*[column.slice(start, stop) for column in self._columns]))
+        if self._widths is not None:
+            widths = self._widths[start:stop]
+            rows = [row if w == self._width else row[:w] for row, w in izip(rows, widths)]
+        return rows
+
+    def __getitem__(self, i):
+        if type(i) is slice:
+            return [self._row(j) for j in xrange(*i.indices(self._count))]
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("list index out of range")
+        return self._row(i)
+
+    def __getslice__(self, i, j):
+        return self[i:j]
+
+    def __iter__(self):
+        for start in xrange(0, self._count, _CHUNK):
+            for row in self._slice(start, min(start + _CHUNK, self._count)):
+                yield row
+
+    def column(self, i):
+        # iterable over the values in the i-th column.
+        return self._columns[i]
+
+    def _readonly(self, *args, **kw):
+        raise TypeError("snapshot rows can't be changed")
+
+    append = pop = sort = __iadd__ = __setitem__ = __delitem__ = _readonly
+
+    def __reduce__(self):
+        # pickles as a list.
+        return list, (list(self),)
+
+
+class _MappedIndex(object):
+    # Stands in for IndexRowset._items of a snapshot, see the hash table
+    # described at the top.
+
+    def __init__(self, data, offset, slots, size, rows, ki, composite):
+        self._data = data
+        self._offset = offset
+        self._mask = slots - 1
+        self._size = size
+        self._rows = rows
+        self._ki = ki
+        self._composite = composite
+
+    def _key(self, i):
+        rows = self._rows
+        if self._composite:
+            return tuple([rows._columns[k][i] for k in self._ki])
+        return rows._columns[self._ki][i]
+
+    def _find(self, key):
+        # the number of the row with the key, or None.
+        slot = _hashkey(key) & self._mask
+        while True:
+            i = _uint.unpack_from(self._data, self._offset + 4 * slot)[0]
+            if not i:
+                return None
+            if self._key(i - 1) == key:
+                return i - 1
+            slot = (slot + 1) & self._mask
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        if i is None:
+            return default
+        return self._rows._row(i)
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i is None:
+            raise KeyError(key)
+        return self._rows._row(i)
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    has_key = __contains__
+
+    def __len__(self):
+        return self._size
+
+    def _positions(self):
+        slots = struct.unpack_from("<%dI" % (self._mask + 1), self._data, self._offset)
+        return sorted(i - 1 for i in slots if i)
+
+    def __iter__(self):
+        for i in self._positions():
+            yield self._key(i)
+
+    def keys(self):
+        return list(self)
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        for i in self._positions():
+            yield self._rows._row(i)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for i in self._positions():
+            yield self._key(i), self._rows._row(i)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __setitem__(self, key, row):
+        raise TypeError("snapshot rows can't be changed")
+
+    def __reduce__(self):
+        # pickles as a dict.
+        return dict, (self.items(),)
+
+
+def load(filename):
+    """
+    Opens a file written by save(), and returns a rowset of the same kind
+    (Rowset or IndexRowset) that reads its rows straight from the file,
+    which is mapped into memory read-only. Nothing is read until it's used,
+    and all processes that load the file share the memory it takes.
+
+    Rows are built when they're read, values other than ints, floats and
+    dates are decoded once. The rowset can't be changed: append() and
+    sorting it in place raise TypeError. Other methods, such as Get(),
+    Select() and IndexedBy(), work as usual.
+
+    Like eveapi.binary.loads(), loading unpickles the values that were
+    pickled, so only load files from a source you trust.
+    """
+    f = open(filename, "rb")
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    if len(data) < _header.size:
+        raise ValueError("not an eveapi.snapshot file")
+    magic, version, size = _header.unpack_from(data)
+    if magic != _MAGIC:
+        raise ValueError("not an eveapi.snapshot file")
+    if version != _VERSION:
+        raise ValueError("unsupported eveapi.snapshot version %d" % version)
+    header = _Reader(data, _header.size).value()
+    base = _header.size + size
+    base += -base % 8
+
+    rows = _MappedRows(data, base, header)
+    if header["key"] is None:
+        rowset = Rowset(header["cols"], rows)
+    else:
+        ki, composite = _keyindex(_columns(header["cols"]), header["key"])
+        offset, slots, count = header["index"]
+        items = _MappedIndex(data, base + offset, slots, count, rows, ki, composite)
+        rowset = IndexRowset(header["cols"], rows, header["key"], items)
+    if header["name"] is not None:
+        rowset._name = header["name"]
+    return rowset
@@ -0,0 +1,187 @@
+import httplib
+import select
+import socket
+import threading
+import time
+import zlib
+from cStringIO import StringIO
+
+_GZIP_MAGIC = "\x1f\x8b"
+
+
+class _ConnectionPool(object):
+    # Keeps idle HTTP/1.1 keep-alive connections to a single server around so
+    # consecutive requests don't pay for a new TCP (and TLS) handshake.
+    #
+    # A pool is created per root context and shared by every context derived
+    # from it. When a proxy is in use the pool connects to the proxy instead.
+
+    def __init__(self, address, secure=False, size=4, idleTimeout=30.0):
+        # address is a tuple of arguments for httplib.HTTP(S)Connection, i.e.
+        # (host,) or (host, port).
+        self.address = tuple(address)
+        self.secure = secure
+        self.size = size
+        self.idleTimeout = idleTimeout
+        self._idle = []  # [(conn, lastUsed), ...], most recently used last
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.secure:
+            return httplib.HTTPSConnection(*self.address)
+        return httplib.HTTPConnection(*self.address)
+
+    def _checkout(self):
+        # returns an idle connection that still looks usable, or None.
+        now = time.time()
+        while True:
+            self._lock.acquire()
+            try:
+                if not self._idle:
+                    return None
+                conn, lastUsed = self._idle.pop()
+            finally:
+                self._lock.release()
+
+            if self.idleTimeout is not None and now - lastUsed > self.idleTimeout:
+                conn.close()
+                continue
+
+            # an idle socket that is readable has either been closed by the
+            # server or has junk on it. either way it's of no use to us.
+            try:
+                if select.select([conn.sock], [], [], 0)[0]:
+                    conn.close()
+                    continue
+            except (select.error, socket.error, TypeError, ValueError):
+                conn.close()
+                continue
+            return conn
+
+    def request(self, method, url, body, headers):
+        # sends a request, returning (conn, response). The caller must hand
+        # both back through release() once it is done with the response.
+        conn = self._checkout()
+        if conn is not None:
+            try:
+                conn.request(method, url, body, headers)
+                return conn, conn.getresponse()
+            except (socket.error, httplib.HTTPException):
+                # the server dropped the connection while it was idle.
+                # discard it and retry once on a fresh one.
+                conn.close()
+
+        conn = self._connect()
+        try:
+            conn.request(method, url, body, headers)
+            return conn, conn.getresponse()
+        except:
+            conn.close()
+            raise
+
+    def release(self, conn, response):
+        # the connection can only be reused if the response was consumed in
+        # full and the server did not ask for the connection to be closed.
+        if response.will_close or not response.isclosed():
+            conn.close()
+            return
+
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.time()))
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def clear(self):
+        # closes all idle connections.
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._lock.release()
+        for conn, lastUsed in idle:
+            conn.close()
+
+
+class _Decompressor(object):
+    # File-like object that decompresses a gzip or deflate encoded stream
+    # as it is read, without ever holding all of the decompressed data.
+
+    def __init__(self, fileobj, encoding="gzip"):
+        self._fileobj = fileobj
+        self._encoding = encoding
+        if encoding == "gzip":
+            self._z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._z = zlib.decompressobj(zlib.MAX_WBITS)
+        self._first = True
+        self._eof = False
+        self._buf = ""
+        self._pos = 0
+
+    def _fill(self):
+        tail = self._z.unconsumed_tail
+        if tail:
+            self._buf = self._z.decompress(tail, 65536)
+            return
+        data = self._fileobj.read(16384)
+        if not data:
+            self._buf = self._z.flush()
+            self._eof = True
+            return
+        if self._first:
+            self._first = False
+            try:
+                self._buf = self._z.decompress(data, 65536)
+                return
+            except zlib.error:
+                if self._encoding != "deflate":
+                    raise
+                # "deflate" is supposed to be zlib wrapped, but some servers
+                # send raw deflate data instead.
+                self._z = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._buf = self._z.decompress(data, 65536)
+
+    def read(self, size=-1):
+        chunks = []
+        while size:
+            if self._pos >= len(self._buf):
+                if self._eof:
+                    break
+                self._fill()
+                self._pos = 0
+                continue
+            if size < 0:
+                chunk = self._buf[self._pos:]
+            else:
+                chunk = self._buf[self._pos:self._pos+size]
+                size -= len(chunk)
+            self._pos += len(chunk)
+            chunks.append(chunk)
+        return "".join(chunks)
+
+    def close(self):
+        close = getattr(self._fileobj, "close", None)
+        if close is not None:
+            close()
+
+
+class _Tee(object):
+    # File-like object that copies everything read from it to sink.
+
+    def __init__(self, fileobj, sink):
+        self._fileobj = fileobj
+        self._sink = sink
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        if data:
+            self._sink.write(data)
+        return data
+
+
+def _decompress(data, encoding="gzip"):
+    return _Decompressor(StringIO(data), encoding).read()
@@ -0,0 +1,205 @@
+import sys
+import threading
+import traceback
+from collections import deque
+
+
+class Future(object):
+    """
+    Placeholder for the result of a call that runs on another thread.
+
+      result([timeout])
+        Waits for the call to finish and returns its result, or re-raises
+        the exception it raised.
+
+      exception([timeout])
+        Waits for the call to finish and returns the exception it raised,
+        or None if it succeeded.
+
+      done()
+        Returns True if the call has finished.
+
+      add_done_callback(func)
+        Calls func(future) once the call has finished (immediately, if it
+        already has).
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def _wait(self, timeout):
+        if not self._event.wait(timeout):
+            raise RuntimeError("timed out waiting for result")
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        if self._exc_info:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, func):
+        self._lock.acquire()
+        try:
+            if not self._event.is_set():
+                self._callbacks.append(func)
+                return
+        finally:
+            self._lock.release()
+        func(self)
+
+    def _finish(self, result, exc_info):
+        self._lock.acquire()
+        try:
+            self._result = result
+            self._exc_info = exc_info
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                # the other callbacks still get called, and whatever set the
+                # result carries on.
+                _report("future callback")
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info):
+        # exc_info is a sys.exc_info() tuple, so the traceback survives the
+        # trip to the thread that collects the result.
+        self._finish(None, exc_info)
+
+
+def _report(what):
+    # prints the exception being handled to stderr, like threads do with the
+    # ones they don't catch, for code that has to carry on after it.
+    sys.stderr.write("Exception in %s:\n" % what)
+    traceback.print_exc()
+
+
+class _WorkerPool(object):
+    # A bounded set of daemon threads executing submitted calls. Threads are
+    # started on demand, up to size.
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("pool size must be at least 1")
+        self.size = size
+        self._tasks = deque()
+        self._cond = threading.Condition()
+        self._threads = 0
+        self._idle = 0
+        self._closed = False
+
+    def submit(self, func, *args, **kw):
+        future = Future()
+        self._cond.acquire()
+        try:
+            if self._closed:
+                raise RuntimeError("worker pool has been shut down")
+            self._tasks.append((future, func, args, kw))
+            if not self._idle and self._threads < self.size:
+                self._threads += 1
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+            elif self._idle:
+                # wake an idle thread. it's taken off the idle count here so
+                # that a quick succession of submits wakes separate threads.
+                self._idle -= 1
+                self._cond.notify()
+        finally:
+            self._cond.release()
+        return future
+
+    def _work(self):
+        while True:
+            self._cond.acquire()
+            try:
+                while not self._tasks and not self._closed:
+                    self._idle += 1
+                    self._cond.wait()
+                if not self._tasks:
+                    self._threads -= 1
+                    return
+                future, func, args, kw = self._tasks.popleft()
+            finally:
+                self._cond.release()
+
+            try:
+                result = func(*args, **kw)
+            except Exception:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+
+    def shutdown(self, cancel=True):
+        # stops the threads once they're done with their current call. Calls
+        # that haven't started yet are dropped when cancel is True.
+        self._cond.acquire()
+        try:
+            self._closed = True
+            if cancel:
+                self._tasks.clear()
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+
+class _SingleFlight(object):
+    # Coalesces concurrent calls for the same key: while a call is in
+    # progress, other threads asking for the same key wait for it and get
+    # its result (or exception) instead of making the call themselves.
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        self._lock.acquire()
+        try:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        finally:
+            self._lock.release()
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = func(*args)
+        except BaseException:
+            # also KeyboardInterrupt and the like, or the callers waiting for
+            # this one (and all later ones) would hang.
+            exc_info = sys.exc_info()
+            self._forget(key)
+            future.set_exception(exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._forget(key)
+        future.set_result(result)
+        return result
+
+    def _forget(self, key):
+        self._lock.acquire()
+        try:
+            del self._calls[key]
+        finally:
+            self._lock.release()
@@ -334,7 +334,8 @@ class MyCacheHandler(object):
 
             cachedUntil = datetime.datetime.now() + cachedFor
 
-            # store in memory
+            # store in memory. (storing eveapi.binary.dumps(obj) instead of
+            # doc would make cache hits faster, as there's no XML to parse.)
             cached = self.cache[key] = (cachedUntil, doc)
 
             # store in cache folder
@@ -1,11 +1,152 @@
+import BaseHTTPServer
+import datetime
+import gzip
 import os
+import pickle
+import shutil
+import socket
+import SocketServer
 import sys
+import tempfile
+import threading
+import time
 import unittest
+import urlparse
+import warnings
+import zlib
+from cStringIO import StringIO
 from unittest import TestCase
 
 eveapi_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
 sys.path.insert(0, eveapi_path)
 
+import eveapi
+import eveapi.arrays
+import eveapi.binary
+import eveapi.columnar
+import eveapi.containers
+import eveapi.delta
+import eveapi.paging
+import eveapi.parser
+import eveapi.scheduler
+import eveapi.snapshot
+import eveapi.workers
+from eveapi.workers import Future
+
+JOURNAL_XML = """<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2">
+  <currentTime>2015-02-21 12:00:00</currentTime>
+  <result>
+    <rowset name="transactions" key="refID" columns="date,refID,refTypeID,ownerName1,amount,balance,reason">
+      <row date="2015-02-21 11:00:00" refID="1003" refTypeID="54" ownerName1="Foo" amount="-12.50" balance="1000.00" reason="" />
+      <row date="2015-02-20 11:00:00" refID="1002" refTypeID="10" ownerName1="Bar" amount="100.00" balance="1012.50" reason="gift" />
+      <row date="2015-02-19 11:00:00" refID="1001" refTypeID="54" ownerName1="Foo" amount="-1.25" balance="912.50" reason="" />
+    </rowset>
+  </result>
+  <cachedUntil>2015-02-21 12:30:00</cachedUntil>
+</eveapi>
+"""
+
+ERROR_XML = """<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2">
+  <currentTime>2015-02-21 12:00:00</currentTime>
+  <error code="%d">Something went wrong.</error>
+  <cachedUntil>2015-02-21 12:30:00</cachedUntil>
+</eveapi>
+"""
+
+
+def _compress(data, encoding="gzip"):
+    if encoding == "deflate":
+        return zlib.compress(data)
+    f = StringIO()
+    g = gzip.GzipFile(fileobj=f, mode="wb", mtime=0)
+    g.write(data)
+    g.close()
+    return f.getvalue()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Stand-in for the API server. Serves server.document (or, if callable,
+    # what it returns for the body) and records requests.
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections.append(self.connection)
+
+    def do_GET(self):
+        self.respond("")
+
+    def do_POST(self):
+        self.respond(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+    def respond(self, body):
+        server = self.server
+        server.requests.append((self.path, body, self.client_address))
+        time.sleep(server.delay)
+        if "Missing" in self.path:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        document = server.document
+        if callable(document):
+            document = document(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        if server.encoding and server.encoding in self.headers.get("Accept-Encoding", ""):
+            document = _compress(document, server.encoding)
+            self.send_header("Content-Encoding", server.encoding)
+        self.send_header("Content-Length", str(len(document)))
+        self.end_headers()
+        self.wfile.write(document)
+        if server.dropConnections:
+            # hang up without telling the client, like an idle timeout would.
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ServerTestCase(TestCase):
+    """
+    Base class for tests that talk to a local stand-in API server.
+    """
+    document = JOURNAL_XML
+
+    def setUp(self):
+        self.server = _Server(("127.0.0.1", 0), _Handler)
+        self.server.document = self.document
+        self.server.requests = []
+        self.server.connections = []
+        self.server.dropConnections = False
+        self.server.delay = 0
+        self.server.encoding = None
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.api = eveapi.EVEAPIConnection(self.url)
+        self.warnings = warnings.catch_warnings()
+        self.warnings.__enter__()
+        warnings.simplefilter("ignore")
+
+    def tearDown(self):
+        self.warnings.__exit__()
+        self.api._pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        for conn in self.server.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
 
 class ImportTestCase(TestCase):
     """
@@ -21,5 +162,1250 @@ class ImportTestCase(TestCase):
         from eveapi import ServerError
 
 
+class CastTestCase(TestCase):
+    """
+    Tests the casting of values to Python types.
+    """
+
+    XML = """<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2">
+  <currentTime>2015-02-21 12:00:00</currentTime>
+  <result>
+    <rowset name="items" key="itemID" columns="itemID,name,amount,custom,when,extra,other">
+      <row itemID="1" name="007" amount="5" custom="" when="2015-02-21 11:00:00" extra="a" other="1.5" />
+      <row itemID="2" name="Foo" amount="2.50" custom="12" when="not a date" extra="10" other="2" />
+      <row itemID="x" name="" amount="" custom="y" when="" extra="b" other="" />
+    </rowset>
+  </result>
+  <cachedUntil>2015-02-21 12:30:00</cachedUntil>
+</eveapi>
+"""
+
+    def tearDown(self):
+        eveapi.api.set_cast_func(None)
+        eveapi.api.set_column_type("custom", None)
+        eveapi.api.set_lazy_cast(False)
+
+    def test_plans(self):
+        items = list(eveapi.parser.ParseXML(self.XML).items.Select("itemID", "name", "amount", "custom", "when", "extra", "other"))
+        self.assertEqual(items, [
+            [1, "007", 5.0, "", datetime.datetime(2015, 2, 21, 11), "a", 1.5],
+            [2, "Foo", 2.5, 12, "not a date", 10, 2],
+            ["x", "", "", "y", "", "b", ""],
+        ])
+        self.assertTrue(isinstance(items[0][2], float))
+        self.assertTrue(isinstance(items[1][6], int))
+
+        eveapi.api.set_column_type("custom", str)
+        self.assertEqual(list(eveapi.parser.ParseXML(self.XML).items.Select("custom")), ["", "12", "y"])
+        self.assertRaises(ValueError, eveapi.api.set_column_type, "custom", list)
+
+    def test_cast_func(self):
+        eveapi.api.set_cast_func(lambda key, value: (key, value))
+        result = eveapi.parser.ParseXML(self.XML)
+        self.assertEqual(result.items[0].itemID, ("itemID", "1"))
+        self.assertEqual(result._meta.currentTime, ("currentTime", "2015-02-21 12:00:00"))
+
+        eveapi.api.set_cast_func(None)
+        self.assertEqual(eveapi.parser.ParseXML(self.XML).items[0].itemID, 1)
+
+    def test_lazy(self):
+        columns = ("itemID", "name", "amount", "custom", "when", "extra", "other")
+        eager = eveapi.parser.ParseXML(self.XML).items
+        eveapi.api.set_lazy_cast(True)
+        lazy = eveapi.parser.ParseXML(self.XML).items
+        self.assertTrue(lazy.Get(2) == eager.Get(2))
+        self.assertEqual(lazy.Get(1).when, eager.Get(1).when)
+        self.assertEqual(list(lazy.Select(*columns)), list(eager.Select(*columns)))
+        self.assertEqual(str(lazy[2]), str(eager[2]))
+
+        lazy = eveapi.parser.ParseXML(self.XML).items
+        row = lazy._rows[0]
+        self.assertTrue(eveapi.parser._uncast in list.__iter__(row))
+        self.assertEqual(row[-1], 1.5)
+        self.assertEqual(row[1:3], ["007", 5.0])
+        self.assertEqual(row, eager._rows[0])
+        self.assertEqual(pickle.loads(pickle.dumps(lazy[2], 2)), eager[2])
+        self.assertEqual(type(pickle.loads(pickle.dumps(lazy._rows[2]))), list)
+        self.assertEqual(list(lazy.SortedBy("amount").Select("itemID")), list(eager.SortedBy("amount").Select("itemID")))
+
+        eveapi.api.set_cast_func(lambda key, value: (key, value))
+        self.assertEqual(eveapi.parser.ParseXML(self.XML).items[0].itemID, ("itemID", "1"))
+
+    def test_dates(self):
+        for value in ("2015-02-21 11:00:00", "1999-12-31 23:59:59", "2016-02-29 00:00:00"):
+            self.assertEqual(eveapi.parser._parsedate(value), datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S"))
+        for value in ("2015-02-30 11:00:00", "2015-02-21T11:00:00", "2015-02-21 11:00:0x", "2015-02-21 11:00"):
+            self.assertRaises(ValueError, eveapi.parser._parsedate, value)
+
+
+class RowsetTestCase(TestCase):
+    """
+    Tests rowsets and rows.
+    """
+
+    def setUp(self):
+        self.rowset = eveapi.parser.ParseXML(JOURNAL_XML).transactions
+
+    def test_columns(self):
+        rowset = self.rowset
+        cols = rowset._cols
+        self.assertTrue(rowset[0]._cols is cols)
+        self.assertTrue(rowset[1:]._cols is cols)
+        self.assertTrue(rowset.IndexedBy("amount")._cols is cols)
+        self.assertTrue(rowset.GroupedBy("refTypeID")[54]._cols is cols)
+        self.assertEqual(cols.index("amount"), 4)
+        self.assertRaises(ValueError, cols.index, "nope")
+
+        row = rowset[1]
+        self.assertEqual((row.refID, row["amount"], row.get("reason"), row.get("nope", 1)), (1002, 100.0, "gift", 1))
+        self.assertTrue("reason" in row)
+        self.assertFalse("nope" in row)
+        self.assertRaises(AttributeError, getattr, row, "nope")
+
+    def test_pickle(self):
+        rowset = pickle.loads(pickle.dumps(self.rowset, 2))
+        self.assertEqual(rowset.Get(1002).amount, 100.0)
+        self.assertTrue(rowset[0]._cols is rowset._cols)
+
+        # objects pickled by older versions have lists of column names.
+        old = eveapi.parser.ParseXML(JOURNAL_XML).transactions
+        row = old[0]
+        old._cols = row._cols = list(old._cols)
+        rowset, row = pickle.loads(pickle.dumps((old, row)))
+        self.assertEqual((rowset.Get(1001).refTypeID, row.amount), (54, -12.5))
+
+        # rows had a __dict__ in older versions.
+        for data in (
+            "ccopy_reg\n_reconstructor\np0\n(ceveapi.containers\nRow\np1\nc__builtin__\nobject\np2\nNtp3\nRp4\n(dp5\nS'_row'\np6\n(lp7\nI1\naS'x'\np8\nasS'_cols'\np9\n(lp10\nS'a'\np11\naS'b'\np12\nasb.",
+            "\x80\x02ceveapi.containers\nRow\nq\x00)\x81q\x01}q\x02(U\x04_rowq\x03]q\x04(K\x01U\x01xq\x05eU\x05_colsq\x06]q\x07(U\x01aq\x08U\x01bq\teub.",
+        ):
+            row = pickle.loads(data)
+            self.assertEqual((row.a, row.b), (1, "x"))
+            self.assertEqual(pickle.loads(pickle.dumps(row)), row)
+
+    def test_add(self):
+        rowset = self.rowset
+        both = rowset + rowset[:1]
+        self.assertTrue(isinstance(both, eveapi.containers.IndexRowset))
+        self.assertEqual((len(both), len(rowset)), (4, 3))
+        self.assertRaises(TypeError, lambda: rowset + [])
+        self.assertRaises(ValueError, lambda: rowset + eveapi.containers.Rowset(["refID"], [[1]]))
+
+        grouped = rowset.GroupedBy("refTypeID")
+        rowset += eveapi.parser.ParseXML(JOURNAL_XML.replace('refID="100', 'refID="200')).transactions
+        self.assertEqual((len(rowset), rowset.Get(2002).amount), (6, 100.0))
+        self.assertEqual(len(rowset.GroupedBy("refTypeID")[54]), 4)
+        self.assertEqual(len(grouped[54]), 4)
+
+        ordered = rowset.OrderedBy("refID")
+        ordered += ordered[:1]
+        self.assertEqual(list(ordered.Select("refID")), [1001, 1001, 1002, 1003, 2001, 2002, 2003])
+
+    def test_columnar(self):
+        XML = CastTestCase.XML.replace('extra="b" other=""', 'extra="b" other="" late="1"')
+        columns = ("itemID", "name", "amount", "custom", "when", "extra", "other")
+        eveapi.api.set_columnar(True)
+        try:
+            columnar = eveapi.parser.ParseXML(XML).items
+            journal = eveapi.parser.ParseXML(JOURNAL_XML).transactions
+        finally:
+            eveapi.api.set_columnar(False)
+        rows = eveapi.parser.ParseXML(XML).items
+        self.assertTrue(isinstance(columnar._rows, eveapi.columnar._ColumnStore))
+        self.assertEqual(list(columnar.Select(*columns)), list(rows.Select(*columns)))
+        self.assertEqual(list(columnar.Select("amount")), list(rows.Select("amount")))
+        self.assertEqual([str(row) for row in columnar], [str(row) for row in rows])
+        self.assertEqual(columnar.Get("x").late, 1)
+        self.assertFalse("late" in columnar.Get(1))
+
+        self.assertEqual(list(journal.Select("refID")), [1003, 1002, 1001])
+        self.assertEqual(list(journal.SortedBy("amount").Select("refID")), [1003, 1001, 1002])
+        self.assertEqual(journal.IndexedBy("amount").Get(-1.25)._row, self.rowset[2]._row)
+        self.assertEqual(list(journal[1:].Select("refID")), [1002, 1001])
+        self.assertEqual(len(journal.GroupedBy("ownerName1")["Foo"]), 2)
+
+        journal.SortBy("balance")
+        self.assertEqual([row.refID for row in journal], [1001, 1003, 1002])
+        self.assertEqual(journal.Get(1002).balance, 1012.5)
+        journal.append([u"2015-02-18 11:00:00", 1000, 1, u"Baz", 2.0, 3.0, u""])
+        self.assertEqual(journal.Get(1000).ownerName1, "Baz")
+        self.assertEqual(journal.Get(1003).ownerName1, "Foo")
+
+        journal = pickle.loads(pickle.dumps(journal, 2))
+        self.assertEqual([row.refID for row in journal], [1001, 1003, 1002, 1000])
+
+        journal += eveapi.parser.ParseXML(JOURNAL_XML.replace('refID="100', 'refID="200')).transactions
+        self.assertEqual([journal.Get(refID).refID for refID in (1000, 2001, 2002, 2003)], [1000, 2001, 2002, 2003])
+        self.assertEqual(journal.Get(2002).reason, "gift")
+        self.assertEqual(journal.Get(1002).date, datetime.datetime(2015, 2, 20, 11))
+
+    def test_columnar_mixed(self):
+        # a column of ints that turns out to hold floats too.
+        store = eveapi.columnar._ColumnStore()
+        for i in range(2000):
+            store.append([i, i + 0.5 if i else 1])
+        store.append([2000, 2 ** 60])
+        column = store.column(1)
+        self.assertEqual((column.values.typecode, len(column.other)), ("d", 1))
+        self.assertEqual(list(column)[:3], [1.0, 1.5, 2.5])
+        self.assertEqual(store[2000][1], 2 ** 60)
+        self.assertEqual(eveapi.columnar._column(1).values.typecode, "l")
+
+    def test_columnar_nested(self):
+        # more rows than the store keeps back before adding them to columns.
+        rows = "".join('<row itemID="%d" typeID="587" quantity="1"><rowset name="contents" key="itemID" columns="itemID,typeID"><row itemID="%d" typeID="34" /></rowset></row>' % (i, i + 1000) for i in range(600))
+        XML = '<eveapi version="2"><result><rowset name="assets" key="itemID" columns="itemID,typeID,quantity">%s</rowset></result></eveapi>' % rows
+        eveapi.api.set_columnar(True)
+        try:
+            assets = eveapi.parser.ParseXML(XML).assets
+        finally:
+            eveapi.api.set_columnar(False)
+        self.assertEqual(len(assets), 600)
+        self.assertEqual([row.contents[0].itemID for row in assets], range(1000, 1600))
+
+    def test_indexes(self):
+        rowset = self.rowset
+        byAmount = rowset.IndexedBy("amount")
+        self.assertTrue(rowset.IndexedBy("amount")._items is byAmount._items)
+        self.assertTrue(rowset.IndexedBy("refID")._items is rowset._items)
+        byOwner = rowset.GroupedBy("ownerName1")
+        self.assertTrue(rowset.GroupedBy("ownerName1")._items is byOwner._items)
+        self.assertEqual(len(byOwner["Foo"]), 2)
+        byTwo = rowset.IndexedBy("ownerName1,refTypeID")
+        self.assertEqual(byTwo.Get(("Bar", 10)).refID, 1002)
+
+        # groups are handed out as copies, changing them leaves the index be.
+        group = byOwner["Foo"]
+        group.append(list(rowset._rows[0]))
+        group.SortBy("refID")
+        self.assertEqual([row.refID for row in rowset.GroupedBy("ownerName1")["Foo"]], [1003, 1001])
+        self.assertEqual(len(rowset.Where(ownerName1="Foo")), 2)
+
+        # kept up to date by append().
+        rowset.append([datetime.datetime(2015, 2, 18, 11), 1000, 10, "Foo", 5.0, 917.5, ""])
+        self.assertEqual(byAmount.Get(5.0).refID, 1000)
+        self.assertEqual(len(byOwner["Foo"]), 3)
+        self.assertEqual(rowset.IndexedBy("ownerName1,refTypeID").Get(("Foo", 10)).refID, 1000)
+        self.assertEqual(rowset.Get(1000).amount, 5.0)
+
+        # and dropped by sorting.
+        rowset.SortBy("balance")
+        self.assertFalse(rowset.IndexedBy("amount")._items is byAmount._items)
+        self.assertEqual([row.refID for row in rowset.GroupedBy("ownerName1")["Foo"]], [1001, 1000, 1003])
+        self.assertEqual(rowset.Get(1002).amount, 100.0)
+        self.assertEqual(len(byOwner["Foo"]), 3)
+
+        byOwner = pickle.loads(pickle.dumps(rowset.GroupedBy("ownerName1")))
+        self.assertEqual(len(byOwner["Bar"]), 1)
+        rowset = pickle.loads(pickle.dumps(rowset))
+        self.assertEqual(rowset[1:].Get(1002).refTypeID, 10)
+
+    def test_ordered(self):
+        rowset = self.rowset
+        byDate = rowset.OrderedBy("date")
+        self.assertTrue(rowset.OrderedBy("date") is byDate)
+        self.assertTrue(byDate._rows[0] is rowset._rows[2])
+        self.assertEqual([row.refID for row in byDate], [1001, 1002, 1003])
+        self.assertEqual([row.refID for row in byDate.Range(datetime.datetime(2015, 2, 20), datetime.datetime(2015, 2, 21, 11))], [1002, 1003])
+        self.assertEqual([row.refID for row in byDate.Range(hi=datetime.datetime(2015, 2, 20, 11))], [1001, 1002])
+        self.assertEqual(len(byDate.Range(datetime.datetime(2016, 1, 1))), 0)
+        self.assertEqual([row.refID for row in rowset.OrderedBy("balance").TopN(2)], [1002, 1003])
+        self.assertEqual(byDate.Floor(datetime.datetime(2015, 2, 20, 12)).refID, 1002)
+        self.assertEqual(byDate.Ceiling(datetime.datetime(2015, 2, 20, 12)).refID, 1003)
+        self.assertEqual(byDate.Floor(datetime.datetime(2015, 2, 19, 11)).refID, 1001)
+        self.assertRaises(KeyError, byDate.Floor, datetime.datetime(2015, 1, 1))
+        self.assertEqual(byDate.Ceiling(datetime.datetime(2016, 1, 1), None), None)
+        self.assertRaises(TypeError, byDate.SortBy, "amount")
+        self.assertEqual([row.refID for row in byDate.SortedBy("amount")], [1003, 1001, 1002])
+
+        byType = rowset.OrderedBy("refTypeID,amount")
+        self.assertEqual([row.refID for row in byType.Range((54, -5), (54, 0))], [1001])
+
+        rowset.append([datetime.datetime(2015, 2, 20, 12), 1000, 10, "Foo", 5.0, 917.5, ""])
+        self.assertEqual([row.refID for row in byDate], [1001, 1002, 1000, 1003])
+        self.assertEqual(byDate.Floor(datetime.datetime(2015, 2, 20, 12)).refID, 1000)
+        byDate.append([datetime.datetime(2015, 2, 22), 1004, 10, "Foo", 1.0, 918.5, ""])
+        self.assertEqual(byDate.TopN(1)[0].refID, 1004)
+        rowset.SortBy("refID")
+        self.assertFalse(rowset.OrderedBy("date") is byDate)
+
+        byDate = pickle.loads(pickle.dumps(byDate))
+        self.assertEqual(byDate.Ceiling(datetime.datetime(2015, 2, 21)).refID, 1003)
+
+    def test_filter(self):
+        rowset = self.rowset.Filter([True, False, True])
+        self.assertEqual([row.refID for row in rowset], [1003, 1001])
+        self.assertEqual(rowset.Get(1001).amount, -1.25)
+        self.assertRaises(ValueError, self.rowset.Filter, [True])
+
+    def test_where(self):
+        rowset = self.rowset
+        query = rowset.Where(("amount", "<", 0))
+        self.assertEqual([row.refID for row in query], [1003, 1001])
+        self.assertEqual(list(query.Where(refTypeID=54, ownerName1="Foo").Select("refID")), [1003, 1001])
+        self.assertEqual(len(query.Where(("refID", "in", [1001, 1002]))), 1)
+        self.assertEqual(len(rowset.Where(("reason", "not in", ("",)), ("balance", ">=", 1000))), 1)
+
+        # queries are run when used, and use the rowset's indexes.
+        rowset.GroupedBy("ownerName1")
+        query = rowset.Where(ownerName1="Foo")
+        rowset.append([datetime.datetime(2015, 2, 18, 11), 1000, 10, "Foo", 5.0, 917.5, ""])
+        self.assertEqual([row.refID for row in query], [1003, 1001, 1000])
+        self.assertEqual(len(rowset.Where(refID=1000, amount=5.0)), 1)
+        self.assertEqual(len(rowset.Where(refID=[1000])), 0)
+        result = query.ToRowset()
+        self.assertTrue(isinstance(result, eveapi.containers.IndexRowset))
+        self.assertEqual(result.Get(1000).amount, 5.0)
+
+        self.assertRaises(ValueError, rowset.Where, ("nope", "==", 1))
+        self.assertRaises(ValueError, rowset.Where, ("amount", "~", 1))
+        self.assertRaises(ValueError, rowset.Where, ("amount", 1))
+
+        eveapi.api.set_columnar(True)
+        try:
+            rowset = eveapi.parser.ParseXML(JOURNAL_XML).transactions
+        finally:
+            eveapi.api.set_columnar(False)
+        result = rowset.Where(("amount", "<", 0), refTypeID=54).ToRowset()
+        self.assertTrue(isinstance(result._rows, eveapi.columnar._ColumnStore))
+        self.assertEqual(list(result.Select("refID")), [1003, 1001])
+
+    def test_join(self):
+        types = eveapi.containers.Rowset(["refTypeID", "name", "amount"], [[54, "Bounty", 1], [10, "Donation", 2], [10, "Gift", 3]])
+        joined = self.rowset.Join(types, "refTypeID")
+        self.assertEqual(joined._cols[-2:], ("name", "amount_2"))
+        self.assertEqual([(row.refID, row.name, row.amount_2) for row in joined], [(1003, "Bounty", 1), (1002, "Donation", 2), (1002, "Gift", 3), (1001, "Bounty", 1)])
+        self.assertTrue(("refTypeID", "group") in types._indexes)
+
+        # an IndexRowset's index is used for its key.
+        owners = eveapi.containers.IndexRowset(["name", "corp"], [["Foo", "A"]], "name")
+        joined = self.rowset.Join(owners, ("ownerName1", "name"), how="left")
+        self.assertEqual([(row.refID, row.corp) for row in joined], [(1003, "A"), (1002, None), (1001, "A")])
+        self.assertFalse(owners._indexes.get(("name", "group")))
+        self.assertEqual(len(self.rowset.Join(owners, ("ownerName1", "name"))), 2)
+        self.assertEqual(len(self.rowset.Join(self.rowset, "ownerName1,refTypeID")), 5)
+        self.assertRaises(ValueError, self.rowset.Join, owners, "name")
+        self.assertRaises(ValueError, self.rowset.Join, owners, ("ownerName1", "name"), "outer")
+
+    def test_iteration(self):
+        rows = list(self.rowset)
+        self.assertEqual([row.refID for row in rows], [1003, 1002, 1001])
+        self.assertFalse(hasattr(rows[0], "__dict__"))
+
+        seen = []
+        for row in self.rowset.Cursor():
+            seen.append((id(row), row.refID, row.get("amount")))
+        self.assertEqual(len(set(item[0] for item in seen)), 1)
+        self.assertEqual([item[1:] for item in seen], [(1003, -12.5), (1002, 100.0), (1001, -1.25)])
+
+
+@unittest.skipIf(eveapi.arrays.numpy is None, "numpy not installed")
+class ArraysTestCase(TestCase):
+    """
+    Tests the numpy based methods of rowsets.
+    """
+
+    def setUp(self):
+        self.rowsets = [eveapi.parser.ParseXML(JOURNAL_XML).transactions]
+        eveapi.api.set_columnar(True)
+        try:
+            self.rowsets.append(eveapi.parser.ParseXML(JOURNAL_XML).transactions)
+        finally:
+            eveapi.api.set_columnar(False)
+
+    def test_arrays(self):
+        numpy = eveapi.arrays.numpy
+        for rowset in self.rowsets:
+            arrays = rowset.ToNumpy()
+            self.assertEqual(arrays["refID"].dtype, numpy.int64)
+            self.assertEqual(arrays["amount"].tolist(), [-12.5, 100.0, -1.25])
+            self.assertEqual(arrays["date"].dtype, numpy.dtype("datetime64[s]"))
+            self.assertEqual(arrays["date"][0].item(), datetime.datetime(2015, 2, 21, 11))
+            self.assertEqual(arrays["reason"].tolist(), ["", "gift", ""])
+
+            array = rowset.ToNumpy("refID", "balance", structured=True)
+            self.assertEqual(array.dtype.names, ("refID", "balance"))
+            self.assertEqual(array[1]["balance"], 1012.5)
+
+        self.assertEqual(eveapi.arrays._toarray([1.5, "", None]).tolist()[0], 1.5)
+        self.assertTrue(numpy.isnan(eveapi.arrays._toarray([1, "", None])[1]))
+        self.assertEqual(eveapi.arrays._toarray([1, "x"]).dtype, object)
+
+    def test_aggregation(self):
+        for rowset in self.rowsets:
+            self.assertEqual(rowset.Sum("amount"), 86.25)
+            self.assertEqual(rowset.Sum("amount", by="ownerName1"), {"Foo": -13.75, "Bar": 100.0})
+            self.assertEqual(rowset.Min("refID", by="refTypeID"), {54: 1001, 10: 1002})
+            self.assertEqual(rowset.Max("date"), datetime.datetime(2015, 2, 21, 11))
+            self.assertEqual(rowset.Mean("balance", by="refTypeID"), {54: 956.25, 10: 1012.5})
+            self.assertEqual(rowset.Mean("refTypeID"), 118 / 3.0)
+
+            negative = rowset.ToNumpy("amount")["amount"] < 0
+            self.assertEqual(rowset.Sum("amount", by="ownerName1", where=negative), {"Foo": -13.75})
+            self.assertEqual(rowset.Max("amount", where=negative), -1.25)
+            filtered = rowset.Filter(negative)
+            self.assertEqual([row.refID for row in filtered], [1003, 1001])
+            self.assertEqual(filtered.Get(1001).amount, -1.25)
+
+
+class BinaryTestCase(TestCase):
+    """
+    Tests the binary format for parsed results.
+    """
+
+    def test_roundtrip(self):
+        root = eveapi.parser.ParseXML(JOURNAL_XML)._meta
+        copy = eveapi.binary.loads(eveapi.binary.dumps(root))
+        self.assertEqual((copy.version, copy.currentTime), (root.version, root.currentTime))
+        rowset = copy.result.transactions
+        self.assertTrue(isinstance(rowset, eveapi.containers.IndexRowset))
+        self.assertEqual(rowset._name, "transactions")
+        self.assertEqual(rowset._rows, root.result.transactions._rows)
+        self.assertEqual(rowset.Get(1002).reason, "gift")
+        self.assertTrue(type(rowset[0].date) is datetime.datetime and type(rowset[0].reason) is unicode)
+
+        # results are stored with their document.
+        result = eveapi.parser.ParseXML(eveapi.binary.dumps(root.result))
+        self.assertEqual(result._meta.cachedUntil, datetime.datetime(2015, 2, 21, 12, 30))
+        self.assertEqual(len(eveapi.parser.ParseXML(eveapi.binary.dumps(root), where={"transactions": {"refTypeID": 54}}).transactions), 2)
+
+    def test_rowsets(self):
+        cols = ["a", "b", "c"]
+        rows = [
+            [i, u"x" if i % 3 else "y", datetime.datetime(2015, 1, 1, 0, 0, i % 60, i) if i % 7 else ""]
+            for i in xrange(100)
+        ]
+        rows[5] = [2 ** 70, u"a\x00b", None]
+        rows[6] = [1.5]
+        rows.append([1, u"z", None, u"data"])
+        for rowset in (
+            eveapi.containers.Rowset(cols, rows),
+            eveapi.containers.Rowset(cols, [row for row in rows if len(row) > 1]).GroupedBy("b"),
+            eveapi.containers.Rowset(cols[:2], [[i, unicode(i)] for i in xrange(10)]).OrderedBy("b"),
+            eveapi.containers.FilterRowset(eveapi.containers._Columns(cols), [[1, 1, 1], [1, 2, 1], [2, 1, 0]], "a", "b"),
+            eveapi.containers.Rowset(cols, []),
+        ):
+            copy = eveapi.binary.loads(eveapi.binary.dumps(rowset))
+            self.assertEqual(type(copy), type(rowset))
+            self.assertEqual(copy.__getstate__(), rowset.__getstate__())
+        copy = eveapi.binary.loads(eveapi.binary.dumps(eveapi.containers.Rowset(cols, rows)))
+        self.assertEqual(map(type, copy._rows[8]) + map(type, copy._rows[7]), [int, unicode, datetime.datetime, int, unicode, str])
+        dates = [[datetime.datetime(1, 1, 1)], [datetime.datetime(9999, 12, 31, 23, 59, 59)], [datetime.datetime(2015, 2, 21)]]
+        self.assertEqual(eveapi.binary.loads(eveapi.binary.dumps(eveapi.containers.Rowset(["d"], dates)))._rows, dates)
+
+        self.assertEqual(eveapi.binary.loads(eveapi.binary.dumps([{"a": (1, 2L)}, set([3])])), [{"a": (1, 2)}, set([3])])
+        data = eveapi.binary.dumps(None)
+        self.assertRaises(ValueError, eveapi.binary.loads, data[:4] + "\x09" + data[5:])
+        self.assertRaises(ValueError, eveapi.binary.loads, eveapi.binary.dumps(u"abc")[:-1])
+        self.assertRaises(ValueError, eveapi.binary.loads, JOURNAL_XML)
+
+
+class SnapshotTestCase(TestCase):
+    """
+    Tests memory-mapped snapshots of rowsets.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_indexed(self):
+        rowset = eveapi.parser.ParseXML(JOURNAL_XML).transactions
+        eveapi.snapshot.save(rowset, self.filename)
+        snapshot = eveapi.snapshot.load(self.filename)
+        self.assertTrue(isinstance(snapshot, eveapi.containers.IndexRowset))
+        self.assertEqual((snapshot._name, snapshot._cols, len(snapshot)), ("transactions", rowset._cols, 3))
+        self.assertEqual([row._row for row in snapshot], rowset._rows)
+        self.assertEqual(snapshot.Get(1002)._row, rowset.Get(1002)._row)
+        self.assertEqual(snapshot.Get(1002L).reason, "gift")
+        self.assertEqual(snapshot.Get(1004, None), None)
+        self.assertRaises(KeyError, snapshot.Get, "1002")
+        self.assertEqual(list(snapshot.Select("amount")), [-12.5, 100.0, -1.25])
+        self.assertEqual(snapshot[-1].date, datetime.datetime(2015, 2, 19, 11))
+        self.assertEqual(snapshot[1:].Get(1001).refTypeID, 54)
+        self.assertEqual(len(snapshot.GroupedBy("ownerName1")["Foo"]), 2)
+        self.assertEqual(sorted(snapshot._items.keys()), [1001, 1002, 1003])
+        self.assertEqual(len(snapshot.Where(ownerName1="Foo")), 2)
+
+        self.assertRaises(TypeError, snapshot.append, rowset[0]._row)
+        self.assertRaises(TypeError, snapshot.SortBy, "amount")
+        self.assertEqual([row.refID for row in snapshot.SortedBy("amount")], [1003, 1001, 1002])
+        self.assertEqual(pickle.loads(pickle.dumps(snapshot)).Get(1003).amount, -12.5)
+
+        # float keys that have no int.
+        rowset = eveapi.containers.IndexRowset(["amount", "name"], [[float("inf"), "a"], [1.0, "b"], [float("nan"), "c"]], "amount")
+        eveapi.snapshot.save(rowset, self.filename)
+        snapshot = eveapi.snapshot.load(self.filename)
+        self.assertEqual((snapshot.Get(float("inf")).name, snapshot.Get(1).name), ("a", "b"))
+        self.assertEqual((snapshot.Get(float("-inf"), None), snapshot.Get(float("nan"), None)), (None, None))
+        self.assertEqual(rowset.Get(float("-inf"), None), None)
+
+    def test_rows(self):
+        cols = ["name", "kind", "value"]
+        rows = [[u"a", 1, 1.5], ["b", 2, ""], [u"\xe9", 1, None], [u"c", 3], [u"a", 3, datetime.datetime(2015, 1, 1)]]
+        eveapi.snapshot.save(eveapi.containers.IndexRowset(cols, rows, "name,kind"), self.filename)
+        snapshot = eveapi.snapshot.load(self.filename)
+        self.assertEqual(list(snapshot._rows), rows)
+        self.assertEqual(snapshot.Get(("b", 2)).value, "")
+        self.assertEqual(snapshot.Get((u"\xe9", 1.0))._row, rows[2])
+        self.assertEqual(snapshot.Get(("c", 3))._row, [u"c", 3])
+        self.assertEqual(len(snapshot._items), 5)
+
+        eveapi.snapshot.save(eveapi.containers.Rowset(cols, []), self.filename)
+        snapshot = eveapi.snapshot.load(self.filename)
+        self.assertEqual((type(snapshot), len(snapshot), list(snapshot)), (eveapi.containers.Rowset, 0, []))
+
+        open(self.filename, "wb").write(JOURNAL_XML)
+        self.assertRaises(ValueError, eveapi.snapshot.load, self.filename)
+
+
+class DeltaTestCase(TestCase):
+    """
+    Tests comparing versions of rowsets with eveapi.delta.
+    """
+
+    def test_diff(self):
+        old = eveapi.parser.ParseXML(QueryTestCase.document).assets
+        XML = QueryTestCase.document.replace('quantity="5"', 'quantity="6"').replace('<row itemID="6"', '<row itemID="7"')
+        new = eveapi.parser.ParseXML(XML).assets
+        delta = eveapi.delta.diff(old, new)
+        self.assertEqual((len(delta), list(delta.added.Select("itemID")), list(delta.removed.Select("itemID")), list(delta.changed.Select("itemID"))), (3, [7], [6], [4]))
+        self.assertFalse(eveapi.delta.diff(old, eveapi.parser.ParseXML(QueryTestCase.document).assets))
+        self.assertEqual(len(eveapi.delta.diff(old, new, partial=True).removed), 0)
+
+        grouped = old.GroupedBy("locationID")
+        self.assertTrue(delta.Apply(old) is old)
+        self.assertEqual(list(old.Select("itemID")), [7, 1, 4])
+        self.assertEqual(old.Get(4).contents[0].quantity, 6)
+        self.assertRaises(KeyError, old.Get, 6)
+        self.assertEqual(len(old.GroupedBy("locationID")[60003760]), 2)
+        self.assertFalse(eveapi.delta.diff(old, new))
+
+    def test_errors(self):
+        rowset = eveapi.parser.ParseXML(JOURNAL_XML).transactions
+        self.assertRaises(ValueError, eveapi.delta.diff, rowset, eveapi.containers.Rowset(["refID"], [[1]]))
+        plain = eveapi.containers.Rowset(rowset._cols, rowset._rows)
+        self.assertRaises(ValueError, eveapi.delta.diff, plain, plain[:])
+
+
+class ConnectionPoolTestCase(ServerTestCase):
+    """
+    Tests that requests reuse keep-alive connections.
+    """
+
+    def test_reuse(self):
+        auth = self.api.auth(keyID=1, vCode="abc")
+        auth.char.WalletJournal(characterID=2)
+        auth.char.WalletJournal(characterID=3)
+        self.api.eve.RefTypes()
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(set(r[2] for r in self.server.requests)), 1)
+
+    def test_dropped_connection(self):
+        self.server.dropConnections = True
+        self.api.eve.RefTypes()
+        result = self.api.eve.RefTypes()
+        self.assertEqual(len(result.transactions), 3)
+        self.assertEqual(len(set(r[2] for r in self.server.requests)), 2)
+
+
+class CompressionTestCase(ServerTestCase):
+    """
+    Tests gzip and deflate compressed responses.
+    """
+
+    def test_uncached(self):
+        for encoding in ("gzip", "deflate"):
+            self.server.encoding = encoding
+            self.assertEqual(len(self.api.eve.RefTypes().transactions), 3)
+
+    def test_cached(self):
+        self.server.encoding = "gzip"
+        cache = eveapi.MemoryCacheHandler(storeObjects=False)
+        self.api.setcachehandler(cache)
+        self.assertEqual(len(self.api.eve.RefTypes().transactions), 3)
+        doc = cache._entries.values()[0][2]
+        self.assertEqual(doc, _compress(JOURNAL_XML))
+        self.assertEqual(len(self.api.eve.RefTypes().transactions), 3)
+        self.assertEqual(len(self.server.requests), 1)
+
+        cache = eveapi.MemoryCacheHandler()
+        self.api.setcachehandler(cache)
+        result = self.api.eve.RefTypes()
+        self.assertEqual(cache._entries.values()[0][1], len(JOURNAL_XML))
+
+    def test_async(self):
+        for encoding in ("gzip", "deflate"):
+            self.server.encoding = encoding
+            api = eveapi.AsyncEVEAPIConnection(self.url)
+            self.assertEqual(len(api.eve.RefTypes().result(10).transactions), 3)
+
+
+class _Sink(object):
+    # writer handed out by _StreamingCacheHandler.open_store().
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+class _StreamingCacheHandler(object):
+
+    storeCompressed = True
+
+    def __init__(self):
+        self.sinks = []
+        self.stored = []
+
+    def retrieve(self, host, path, params):
+        return None
+
+    def open_store(self, host, path, params):
+        self.sinks.append(_Sink())
+        return self.sinks[-1]
+
+    def store(self, host, path, params, doc, obj):
+        self.stored.append(doc)
+
+
+class StreamingTestCase(ServerTestCase):
+    """
+    Tests that documents are written to the cache while being parsed.
+    """
+
+    def test_open_store(self):
+        cache = _StreamingCacheHandler()
+        self.api.setcachehandler(cache)
+        self.api.eve.RefTypes()
+        self.assertEqual(cache.stored, cache.sinks)
+        self.assertEqual("".join(cache.sinks[0].chunks), JOURNAL_XML)
+
+        self.server.encoding = "gzip"
+        self.api.eve.RefTypes()
+        self.assertEqual("".join(cache.sinks[1].chunks), _compress(JOURNAL_XML))
+
+        self.server.document = ERROR_XML % 520
+        self.assertRaises(eveapi.ServerError, self.api.eve.RefTypes)
+        self.assertEqual(len(cache.stored), 2)
+        self.assertTrue(cache.sinks[2].closed)
+
+    def test_large(self):
+        # big enough to span many reads, with and without compression.
+        rows = "".join('<row date="2015-02-21 11:00:00" refID="%d" refTypeID="54" ownerName1="Foo" amount="-12.50" balance="1000.00" reason="" />' % i for i in xrange(5000))
+        self.server.document = JOURNAL_XML.replace('<row ', rows + '<row ', 1)
+        self.api.setcachehandler(eveapi.SqliteCacheHandler(":memory:"))
+        for encoding in (None, "gzip", "deflate"):
+            self.server.encoding = encoding
+            self.assertEqual(len(self.api.char.WalletJournal(characterID=str(encoding)).transactions), 5003)
+            self.assertEqual(len(self.api.char.WalletJournal(characterID=str(encoding)).transactions), 5003)
+        self.assertEqual(len(self.server.requests), 3)
+
+
+class RowStreamTestCase(ServerTestCase):
+    """
+    Tests streaming the rows of a rowset.
+    """
+
+    def test_parse(self):
+        for doc in (JOURNAL_XML, _compress(JOURNAL_XML), StringIO(JOURNAL_XML)):
+            stream = eveapi.parser.ParseXML(doc, stream="transactions")
+            self.assertEqual(stream.result, None)
+            self.assertEqual([row.refID for row in stream], [1003, 1002, 1001])
+            self.assertEqual(len(stream.result.transactions), 0)
+            self.assertEqual(stream.result._meta.cachedUntil, datetime.datetime(2015, 2, 21, 12, 30))
+
+        stream = eveapi.parser.ParseXML(ERROR_XML % 105, stream="transactions")
+        self.assertRaises(eveapi.RequestError, list, stream)
+
+    def test_context(self):
+        self.server.encoding = "gzip"
+        me = self.api.auth(keyID=1, vCode="abc").character(2)
+        stream = me.WalletJournal.stream("transactions", rowCount=3)
+        self.assertEqual([row.amount for row in stream], [-12.5, 100.0, -1.25])
+        self.assertEqual(stream.result._meta.currentTime, datetime.datetime(2015, 2, 21, 12, 0))
+        self.assertTrue("rowCount=3" in self.server.requests[0][1])
+        self.assertTrue("characterID=2" in self.server.requests[0][1])
+
+        # abandoning a stream must not break the connection.
+        stream = me.WalletJournal.stream("transactions")
+        stream.next()
+        del stream
+        self.assertEqual(len(me.WalletJournal().transactions), 3)
+
+    def test_cached(self):
+        for cache in (eveapi.MemoryCacheHandler(), eveapi.MemoryCacheHandler(storeObjects=False)):
+            self.api.setcachehandler(cache)
+            self.assertEqual(len(list(self.api.eve.RefTypes.stream("transactions"))), 3)
+            self.assertEqual(cache._entries, {})
+            self.api.eve.RefTypes()
+            self.assertEqual(len(list(self.api.eve.RefTypes.stream("transactions"))), 3)
+        self.assertEqual(len(self.server.requests), 4)
+
+
+class QueryTestCase(ServerTestCase):
+    """
+    Tests leaving out rows while parsing.
+    """
+
+    document = """<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2">
+  <currentTime>2015-02-21 12:00:00</currentTime>
+  <result>
+    <rowset name="assets" key="itemID" columns="itemID,locationID,typeID,quantity,flag,singleton">
+      <row itemID="1" locationID="60003760" typeID="587" quantity="1" flag="4" singleton="1">
+        <rowset name="contents" key="itemID" columns="itemID,typeID,quantity,flag,singleton">
+          <row itemID="2" typeID="34" quantity="100" flag="5" singleton="0" />
+          <row itemID="3" typeID="35" quantity="10" flag="5" singleton="0" />
+        </rowset>
+      </row>
+      <row itemID="4" locationID="60008494" typeID="588" quantity="1" flag="4" singleton="1">
+        <rowset name="contents" key="itemID" columns="itemID,typeID,quantity,flag,singleton">
+          <row itemID="5" typeID="34" quantity="5" flag="5" singleton="0"><![CDATA[]]></row>
+        </rowset>
+      </row>
+      <row itemID="6" locationID="60003760" typeID="34" quantity="7" flag="4" singleton="0" />
+    </rowset>
+  </result>
+  <cachedUntil>2015-02-21 12:30:00</cachedUntil>
+</eveapi>
+"""
+
+    def test_parse(self):
+        result = eveapi.parser.ParseXML(self.document, where={"assets": {"locationID": 60003760}})
+        self.assertEqual(list(result.assets.Select("itemID")), [1, 6])
+        self.assertEqual(list(result.assets.Get(1).contents.Select("itemID")), [2, 3])
+        self.assertEqual(result._meta.cachedUntil, datetime.datetime(2015, 2, 21, 12, 30))
+
+        result = eveapi.parser.ParseXML(self.document, where={"contents": [("quantity", ">", 50)], "assets": [("typeID", "!=", 34)]})
+        self.assertEqual([len(row.contents) for row in result.assets], [1, 0])
+
+        stream = eveapi.parser.ParseXML(self.document, stream="assets", where={"assets": [("itemID", ">", 1)]})
+        self.assertEqual([row.itemID for row in stream], [4, 6])
+
+    def test_missing(self):
+        # rowsets with the same columns, but other conditions, whose rows
+        # leave out a column.
+        rowset = """<rowset name="%s" key="x" columns="x,y,z"><row x="1" z="0" /><row x="2" z="0" /></rowset>"""
+        document = """<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2"><currentTime>2015-02-21 12:00:00</currentTime><result>%s%s</result><cachedUntil>2015-02-21 12:30:00</cachedUntil></eveapi>""" % (rowset % "a", rowset % "b")
+        result = eveapi.parser.ParseXML(document, where={"a": {"x": 1}, "b": {"x": 2}})
+        self.assertEqual((list(result.a.Select("x")), list(result.b.Select("x"))), ([1], [2]))
+        self.assertEqual(result.b[0].y, None)
+
+    def test_context(self):
+        cache = eveapi.MemoryCacheHandler()
+        self.api.setcachehandler(cache)
+        where = {"assets": {"locationID": 60003760}}
+        self.assertEqual(len(self.api.char.AssetList.query(where).assets), 2)
+        self.assertEqual(cache._entries, {})
+
+        # cached results are filtered without being changed.
+        self.assertEqual(len(self.api.char.AssetList().assets), 3)
+        result = self.api.char.AssetList.query(where)
+        self.assertEqual(list(result.assets.Select("itemID")), [1, 6])
+        self.assertEqual(result._meta.currentTime, datetime.datetime(2015, 2, 21, 12, 0))
+        self.assertEqual(len(self.api.char.AssetList().assets), 3)
+        self.assertEqual(len(self.server.requests), 2)
+
+        # columns rows don't have are None, whether the result is cached or not.
+        where = {"assets": [("nope", "==", None), ("itemID", "<", 5)]}
+        for cache in (None, eveapi.MemoryCacheHandler(), eveapi.MemoryCacheHandler(storeObjects=False)):
+            self.api.setcachehandler(cache)
+            if cache is not None:
+                self.api.char.AssetList()
+            self.assertEqual(list(self.api.char.AssetList.query(where).assets.Select("itemID")), [1, 4])
+            self.assertEqual(len(self.api.char.AssetList.query({"assets": {"nope": 1}}).assets), 0)
+
+
+def _journalPage(body):
+    # a page of a ten entry journal, walked back from fromID like the API
+    # does, of at most eveapi.paging._MAXROWS rows.
+    params = urlparse.parse_qs(body)
+    fromID = int(params.get("fromID", ["1011"])[0])
+    rowCount = min(int(params.get("rowCount", ["4"])[0]), eveapi.paging._MAXROWS)
+    rows = ['      <row date="2015-02-%d 11:00:00" refID="%d" refTypeID="10" amount="1.00" />' % (refID - 990, refID) for refID in range(fromID - 1, 1000, -1)[:rowCount]]
+    return """<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2">
+  <currentTime>2015-02-21 12:00:00</currentTime>
+  <result>
+    <rowset name="entries" key="refID" columns="date,refID,refTypeID,amount">
+%s
+    </rowset>
+  </result>
+  <cachedUntil>2015-02-21 12:30:00</cachedUntil>
+</eveapi>
+""" % "\n".join(rows)
+
+
+class PagingTestCase(ServerTestCase):
+    """
+    Tests walking through pages with PageWalker.
+    """
+
+    document = staticmethod(_journalPage)
+
+    def test_walk(self):
+        journal = self.api.char.WalletJournal
+        self.assertEqual([row.refID for row in journal.walk(characterID=1)], range(1010, 1000, -1))
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual([urlparse.parse_qs(body).get("fromID") for path, body, address in self.server.requests], [None, ["1007"], ["1003"]])
+
+        walker = journal.walk(rowCount=3)
+        entries = walker.Merge()
+        self.assertTrue(isinstance(entries, eveapi.containers.IndexRowset))
+        self.assertEqual((len(entries), entries.Get(1001).amount, walker.pages), (10, 1.0, 4))
+        self.assertEqual(walker.cachedUntil, datetime.datetime(2015, 2, 21, 12, 30))
+        self.assertRaises(RuntimeError, list, walker)
+
+    def test_stop(self):
+        journal = self.api.char.WalletJournal
+        self.assertEqual([row.refID for row in journal.walk(stopID=1004)], [1010, 1009, 1008, 1007, 1006, 1005])
+        self.assertEqual([row.refID for row in journal.walk(since=datetime.datetime(2015, 2, 18))], [1010, 1009, 1008])
+        walker = journal.walk(maxRows=5)
+        self.assertEqual(len(walker.Merge()), 5)
+        self.assertEqual(walker.pages, 2)
+        self.assertEqual(len(self.server.requests), 5)
+        # the next page isn't asked for once there are enough rows.
+        walker = journal.walk(maxRows=4)
+        self.assertEqual((len(walker.Merge()), walker.pages, len(self.server.requests)), (4, 1, 6))
+
+    def test_capped(self):
+        # asking for more rows than the server returns per page.
+        maxrows, eveapi.paging._MAXROWS = eveapi.paging._MAXROWS, 3
+        try:
+            walker = self.api.char.WalletJournal.walk(rowCount=100)
+            self.assertEqual([row.refID for row in walker], range(1010, 1000, -1))
+        finally:
+            eveapi.paging._MAXROWS = maxrows
+        self.assertEqual(walker.pages, 4)
+        self.assertEqual([urlparse.parse_qs(body)["rowCount"] for path, body, address in self.server.requests], [["3"]] * 4)
+
+    def test_seen(self):
+        # the journal as it was before entries 1008 to 1010 were made.
+        journal = self.api.char.WalletJournal.walk(fromID=1008).Merge()
+        self.assertEqual(len(journal), 7)
+        count = len(self.server.requests)
+
+        delta = eveapi.delta.diff(journal, self.api.char.WalletJournal.walk(rowCount=2, seen=journal).Merge(), partial=True)
+        self.assertEqual(len(self.server.requests), count + 2)
+        self.assertEqual((list(delta.added.Select("refID")), len(delta.removed), len(delta.changed)), ([1010, 1009, 1008], 0, 0))
+        delta.Apply(journal)
+        self.assertEqual(list(journal.Select("refID")), range(1010, 1000, -1))
+        self.assertEqual(journal.Get(1009).amount, 1.0)
+
+    def test_cache(self):
+        self.api.setcachehandler(eveapi.MemoryCacheHandler())
+        for i in range(2):
+            self.assertEqual(len(self.api.char.WalletJournal.walk().Merge()), 10)
+        self.assertEqual(len(self.server.requests), 3)
+
+
+class BatchTestCase(ServerTestCase):
+    """
+    Tests running many calls through EVEAPIConnection.batch().
+    """
+
+    def test_ordered(self):
+        auth = self.api.auth(keyID=1, vCode="abc")
+        calls = [(auth.char.WalletJournal, {"characterID": i}) for i in range(20)]
+        calls.append(("eve/RefTypes", None))
+        results = list(self.api.batch(calls, concurrency=4, ordered=True))
+        self.assertEqual([call for call, result in results], calls)
+        for call, result in results:
+            self.assertEqual(len(result.transactions), 3)
+        self.assertEqual(len(self.server.requests), 21)
+
+    def test_errors(self):
+        calls = [("eve/RefTypes", {}), ("eve/Missing", {}), ("eve/RefTypes", {})]
+        results = dict((call[0], result) for call, result in self.api.batch(calls, concurrency=2))
+        self.assertTrue(isinstance(results["eve/Missing"], AttributeError))
+        self.assertEqual(len(results["eve/RefTypes"].transactions), 3)
+
+
+class _DeferredCacheHandler(object):
+    # cache handler that completes its operations on other threads.
+
+    def __init__(self):
+        self.docs = {}
+
+    def _later(self, func, *args):
+        future = Future()
+        threading.Thread(target=lambda: future.set_result(func(*args))).start()
+        return future
+
+    def retrieve(self, host, path, params):
+        return self._later(self.docs.get, (path, frozenset(params.items())))
+
+    def store(self, host, path, params, doc, obj):
+        return self._later(self.docs.__setitem__, (path, frozenset(params.items())), doc)
+
+
+class AsyncTestCase(ServerTestCase):
+    """
+    Tests the non-blocking client returned by AsyncEVEAPIConnection().
+    """
+
+    def test_calls(self):
+        api = eveapi.AsyncEVEAPIConnection(self.url, maxConnections=8)
+        auth = api.auth(keyID=1, vCode="abc")
+        futures = [auth.character(i).WalletJournal() for i in range(100)]
+        futures.append(api.eve.Missing())
+        for future in futures[:-1]:
+            self.assertEqual(len(future.result(10).transactions), 3)
+        self.assertRaises(AttributeError, futures[-1].result, 10)
+        self.assertEqual(len(self.server.requests), 101)
+        self.assertTrue(len(set(r[2] for r in self.server.requests)) <= 8)
+        self.assertEqual(sorted(set(r[0] for r in self.server.requests)), ["/char/WalletJournal.xml.aspx", "/eve/Missing.xml.aspx"])
+
+    def test_cache(self):
+        api = eveapi.AsyncEVEAPIConnection(self.url, cacheHandler=_DeferredCacheHandler())
+        first = api.eve.RefTypes().result(10)
+        second = api.eve.RefTypes().result(10)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(list(first.transactions), list(second.transactions))
+
+    def test_stream(self):
+        self.server.encoding = "gzip"
+        api = eveapi.AsyncEVEAPIConnection(self.url)
+        stream = api.char.WalletJournal.stream("transactions", characterID=1).result(10)
+        self.assertEqual([row.refID for row in stream], [1003, 1002, 1001])
+        self.assertEqual(stream.result._meta.currentTime, datetime.datetime(2015, 2, 21, 12, 0))
+
+    def test_query(self):
+        api = eveapi.AsyncEVEAPIConnection(self.url, cacheHandler=_DeferredCacheHandler())
+        result = api.char.WalletJournal.query({"transactions": {"refTypeID": 54}}).result(10)
+        self.assertEqual(list(result.transactions.Select("refID")), [1003, 1001])
+        # not stored, the next call is sent too.
+        self.assertEqual(len(api.char.WalletJournal().result(10).transactions), 3)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_callback(self):
+        api = eveapi.AsyncEVEAPIConnection(self.url)
+        called = threading.Event()
+        def callback(future):
+            called.set()
+            raise ValueError("callback")
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            future = api.eve.RefTypes()
+            future.add_done_callback(callback)
+            future.result(10)
+            self.assertTrue(called.wait(10))
+            # the loop carries on.
+            self.assertEqual(len(api.char.WalletJournal(characterID=1).result(10).transactions), 3)
+        finally:
+            output, sys.stderr = sys.stderr.getvalue(), stderr
+        self.assertTrue("ValueError: callback" in output)
+
+    def test_coalesce(self):
+        self.server.delay = 0.2
+        api = eveapi.AsyncEVEAPIConnection(self.url)
+        futures = [api.eve.RefTypes() for i in range(5)]
+        self.assertEqual(len(set(map(id, futures))), 1)
+        futures[0].result(10)
+        self.assertEqual(len(self.server.requests), 1)
+        api.eve.RefTypes().result(10)
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class MemoryCacheHandlerTestCase(ServerTestCase):
+    """
+    Tests the built-in in-memory cache handler.
+    """
+
+    def test_hit(self):
+        self.api.setcachehandler(eveapi.MemoryCacheHandler())
+        auth = self.api.auth(keyID=1, vCode="abc")
+        first = auth.char.WalletJournal(characterID=1)
+        second = auth.char.WalletJournal(characterID="1")
+        self.assertTrue(first is second)
+        auth.char.WalletJournal(characterID=2)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_xml(self):
+        self.api.setcachehandler(eveapi.MemoryCacheHandler(storeObjects=False))
+        first = self.api.eve.RefTypes()
+        second = self.api.eve.RefTypes()
+        self.assertFalse(first is second)
+        self.assertEqual(list(first.transactions), list(second.transactions))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_eviction(self):
+        cache = eveapi.MemoryCacheHandler(maxEntries=2)
+        self.api.setcachehandler(cache)
+        for i in (1, 2, 3, 1):
+            self.api.char.WalletJournal(characterID=i)
+        self.assertEqual(len(cache._entries), 2)
+        self.assertEqual(len(self.server.requests), 4)
+
+        cache = eveapi.MemoryCacheHandler(maxBytes=len(JOURNAL_XML) * 2)
+        self.api.setcachehandler(cache)
+        for i in (1, 2, 3):
+            self.api.char.WalletJournal(characterID=i)
+        self.assertEqual(len(cache._entries), 2)
+
+    def test_expiry(self):
+        cache = eveapi.MemoryCacheHandler()
+        obj = eveapi.parser.ParseXML(JOURNAL_XML)._meta
+        obj.cachedUntil = obj.currentTime + datetime.timedelta(seconds=0.05)
+        cache.store("host", "path", {}, JOURNAL_XML, obj)
+        self.assertTrue(cache.retrieve("host", "path", {}) is obj)
+        time.sleep(0.1)
+        self.assertEqual(cache.retrieve("host", "path", {}), None)
+        self.assertTrue(cache.retrieve_stale("host", "path", {})[0] is obj)
+
+        cache.clear()
+        obj.cachedUntil = obj.currentTime
+        cache.store("host", "path", {}, JOURNAL_XML, obj)
+        self.assertEqual(len(cache._entries), 0)
+
+
+class BackgroundRefreshTestCase(ServerTestCase):
+    """
+    Tests serving stale documents while refreshing them in the background.
+    """
+
+    def _expire(self, cache, seconds):
+        for key, entry in cache._entries.items():
+            cache._entries[key] = (time.time() + seconds,) + entry[1:]
+
+    def _wait(self, api):
+        # waits for background refreshes to finish.
+        deadline = time.time() + 5
+        while api._refresher._pending and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_stale(self):
+        cache = eveapi.MemoryCacheHandler()
+        api = eveapi.EVEAPIConnection(self.url, cacheHandler=cache, staleTime=60)
+        first = api.eve.RefTypes()
+        self._expire(cache, -30)
+        self.server.delay = 0.1
+        self.assertTrue(api.eve.RefTypes() is first)
+        self.assertTrue(api.eve.RefTypes() is first)
+        self._wait(api)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertFalse(api.eve.RefTypes() is first)
+
+        self._expire(cache, -90)
+        api.eve.RefTypes()
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_refresh_ahead(self):
+        cache = eveapi.MemoryCacheHandler()
+        api = eveapi.EVEAPIConnection(self.url, cacheHandler=cache, refreshAhead=60)
+        first = api.eve.RefTypes()
+        self._expire(cache, 120)
+        self.assertTrue(api.eve.RefTypes() is first)
+        self._expire(cache, 30)
+        self.assertTrue(api.eve.RefTypes() is first)
+        self._wait(api)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertFalse(api.eve.RefTypes() is first)
+
+
+class SqliteCacheHandlerTestCase(ServerTestCase):
+    """
+    Tests the SQLite backed cache handler.
+    """
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "cache.db")
+
+    def tearDown(self):
+        ServerTestCase.tearDown(self)
+        shutil.rmtree(self.tempdir)
+
+    def test_shared(self):
+        self.api.setcachehandler(eveapi.SqliteCacheHandler(self.filename))
+        first = self.api.eve.RefTypes()
+        other = eveapi.EVEAPIConnection(self.url, cacheHandler=eveapi.SqliteCacheHandler(self.filename))
+        second = other.eve.RefTypes()
+        self.assertEqual(list(first.transactions), list(second.transactions))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_nonascii(self):
+        self.api.setcachehandler(eveapi.SqliteCacheHandler(self.filename))
+        first = self.api.eve.CharacterID(names="J\xc3\xb6rg")
+        second = self.api.eve.CharacterID(names="J\xc3\xb6rg")
+        self.assertEqual(list(first.transactions), list(second.transactions))
+        self.api.eve.CharacterID(names="J\xc3\xa4rg")
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_compressed(self):
+        self.server.encoding = "gzip"
+        cache = eveapi.SqliteCacheHandler(self.filename)
+        self.api.setcachehandler(cache)
+        self.api.eve.RefTypes()
+        blob = cache._db().execute("SELECT doc FROM documents").fetchone()[0]
+        self.assertEqual(str(blob), _compress(JOURNAL_XML))
+        self.assertEqual(len(self.api.eve.RefTypes().transactions), 3)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_fallback(self):
+        cache = eveapi.SqliteCacheHandler(self.filename)
+        self.api.setcachehandler(cache)
+        first = self.api.eve.RefTypes()
+        cache._db().execute("UPDATE documents SET expires=?", (time.time() - 30,))
+        self.server.document = ERROR_XML % 520
+        second = self.api.eve.RefTypes()
+        self.assertEqual(list(first.transactions), list(second.transactions))
+        self.assertEqual(len(self.server.requests), 2)
+
+        self.server.document = ERROR_XML % 203
+        self.assertRaises(eveapi.AuthenticationError, self.api.eve.RefTypes)
+
+        self.assertEqual(cache.purge(60), 0)
+        self.assertEqual(cache.purge(), 1)
+        cache.vacuum()
+        self.server.document = ERROR_XML % 520
+        self.assertRaises(eveapi.ServerError, self.api.eve.RefTypes)
+
+    def test_binary(self):
+        cache = eveapi.SqliteCacheHandler(self.filename, binary=True)
+        self.api.setcachehandler(cache)
+        first = self.api.eve.RefTypes()
+        doc = cache.retrieve(self.api._host, "/eve/RefTypes.xml.aspx", {})
+        self.assertEqual(eveapi.binary.loads(doc).result.transactions.Get(1002).amount, 100.0)
+        second = self.api.eve.RefTypes()
+        self.assertEqual(list(first.transactions), list(second.transactions))
+        self.assertEqual(second._meta.cachedUntil, datetime.datetime(2015, 2, 21, 12, 30))
+        self.assertEqual([row.refID for row in self.api.eve.RefTypes.stream("transactions")], [1003, 1002, 1001])
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class CoalescingTestCase(ServerTestCase):
+    """
+    Tests that concurrent identical calls are only sent once.
+    """
+
+    def _concurrently(self, func, count=8):
+        results = []
+        def call():
+            try:
+                results.append(func())
+            except Exception, e:
+                results.append(e)
+        threads = [threading.Thread(target=call) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_result(self):
+        self.server.delay = 0.2
+        results = self._concurrently(lambda: self.api.eve.RefTypes())
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(len(set(map(id, results))), 1)
+
+        self.api.eve.RefTypes()
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_exception(self):
+        self.server.delay = 0.2
+        results = self._concurrently(lambda: self.api.eve.Missing())
+        self.assertEqual(len(self.server.requests), 1)
+        for e in results:
+            self.assertTrue(isinstance(e, AttributeError))
+
+    def test_interrupted(self):
+        flight = eveapi.workers._SingleFlight()
+        release = threading.Event()
+        results = []
+
+        def interrupted():
+            release.wait()
+            raise KeyboardInterrupt
+
+        def call(func):
+            try:
+                results.append(flight.do("key", func))
+            except BaseException, e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call, args=(interrupted,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual([type(e) for e in results], [KeyboardInterrupt, KeyboardInterrupt])
+        self.assertEqual(flight.do("key", lambda: 1), 1)
+
+
+class SchedulerTestCase(ServerTestCase):
+    """
+    Tests rate limits and the order in which held back requests are sent.
+    """
+
+    def test_order(self):
+        scheduler = eveapi.scheduler._Scheduler(rate=20)
+        for i in range(20):
+            scheduler.acquire()
+        order = []
+
+        def request(key, priority):
+            scheduler.acquire(key, priority)
+            order.append((key, priority))
+
+        threads = []
+        for key, priority in ((1, 1), (1, 1), (2, 1), (3, 0)):
+            thread = threading.Thread(target=request, args=(key, priority))
+            thread.start()
+            threads.append(thread)
+            while sum(len(queue) for keys, waiters in scheduler._waiting.values() for queue in waiters.values()) < len(threads):
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+        # the interactive request first, then the keys take turns.
+        self.assertEqual(order, [(3, 0), (1, 1), (2, 1), (1, 1)])
+        self.assertEqual(scheduler._waiting, {})
+
+    def test_async(self):
+        api = eveapi.AsyncEVEAPIConnection(self.url, rateLimit=20)
+        start = time.time()
+        futures = [api.char.WalletJournal(characterID=i) for i in range(30)]
+        # the loop isn't held up by requests that have to wait.
+        self.assertEqual(len(futures[0].result(10).transactions), 3)
+        self.assertTrue(time.time() - start < 0.4)
+        for future in futures:
+            self.assertEqual(len(future.result(10).transactions), 3)
+        self.assertTrue(time.time() - start >= 0.45)
+        self.assertEqual(len(self.server.requests), 30)
+
+    def test_limits(self):
+        api = eveapi.EVEAPIConnection(self.url, rateLimit=20)
+        start = time.time()
+        calls = [(api.char.WalletJournal, {"characterID": i}) for i in range(30)]
+        self.assertEqual(len(list(api.batch(calls))), 30)
+        self.assertTrue(time.time() - start >= 0.45)
+
+        # the keys have a limit each.
+        api = eveapi.EVEAPIConnection(self.url, keyRateLimit=20)
+        start = time.time()
+        calls = [(api.auth(keyID=i % 2, vCode="abc").char.WalletJournal, {"characterID": i}) for i in range(30)]
+        self.assertEqual(len(list(api.batch(calls))), 30)
+        self.assertTrue(time.time() - start < 0.45)
+        start = time.time()
+        calls = [(api.auth(keyID=2, vCode="abc").char.WalletJournal, {"characterID": i}) for i in range(30)]
+        self.assertEqual(len(list(api.batch(calls))), 30)
+        self.assertTrue(time.time() - start >= 0.45)
+        self.assertEqual(len(self.server.requests), 90)
+
+
 if __name__ == '__main__':
     unittest.main()